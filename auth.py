@@ -1,55 +1,63 @@
 import sqlite3
-from apscheduler.schedulers.background import BackgroundScheduler
-from passlib.hash import sha256_crypt
 from uuid import uuid4
 from time import time
 
-# This will be a decorator. It gets applied to class functions and modifies them so that a new database
-# connection is created before the function is called. THe connection is then closed. This saves having
-# to write a new with-connect-as block every time I just want to get a cursor. Plus, decorators are cool!
-def createDBConnection(func):
-	def wrapper(self, *args, **kwargs):
-		# If we have an existing connection then we dont want to close it or open a new one
-		if self.con != None:
-			return func(self, *args, **kwargs)
-
-		# Make new connection and store it in the instance so it can be accessed by the passed class func
-		self.con = sqlite3.connect(self.dbPath)
-		result = func(self, *args, **kwargs)
-		self.con.close()
-		self.con = None # Close and reset to none so we know that we no longer have an existing connection
-		return result
-	return wrapper
+from connections import createDBConnection
+from passwords import AttemptLimiter, TooManyAttempts
 
 class Authenticator():
-	def __init__(self, dbPath, emailHandler):
-		self.dbPath = dbPath
-		self.con = None
+	# How many failed logins are allowed in LOGIN_WINDOW seconds, for a single email and for a single IP address.
+	# An IP gets more, because lots of people can share one.
+	MAX_LOGINS_PER_EMAIL = 5
+	MAX_LOGINS_PER_IP = 20
+	LOGIN_WINDOW = 900
+
+	# passwordHasher (a PasswordHasher) does all of the password hashing away from the request thread
+	def __init__(self, connections, emailHandler, passwordHasher):
+		self.connections = connections
 		self.emailHandler = emailHandler
+		self.passwordHasher = passwordHasher
+		self.emailLimiter = AttemptLimiter(connections, "email", self.MAX_LOGINS_PER_EMAIL, self.LOGIN_WINDOW)
+		self.ipLimiter = AttemptLimiter(connections, "ip", self.MAX_LOGINS_PER_IP, self.LOGIN_WINDOW)
 
-		# This will schedule a job that purges any accounts that have not been verified within half an hour
-		self.scheduler = BackgroundScheduler()
-		self.scheduler.add_job(self.removeExpiredTokens, "interval", seconds=120)
-		self.scheduler.start()
-
-	# Free scheduler resources when all references to the authenticator have been deleted
-	def __del__(self):
-		self.scheduler.shutdown()
+	# The database connection for whichever thread is running (requests and the scheduler run on different threads)
+	@property
+	def con(self):
+		return self.connections.getConnection()
 
 	# Validates the login details - return true if they are correct
+	# Raises TooManyAttempts if this email or IP address has failed too many times recently, without checking the
+	# password at all. That way a flood of logins can't keep the hashing processes busy.
 	@createDBConnection
-	def verifyLogin(self, email, passwordAttempt: str):
+	def verifyLogin(self, email, passwordAttempt: str, ipAddress):
+		if not self.emailLimiter.isAllowed(email) or not self.ipLimiter.isAllowed(ipAddress):
+			raise TooManyAttempts()
+
 		result = self.userExists(email)
 		# This user does not exist
 		if not result:
+			self.recordFailedLogin(email, ipAddress)
 			return False
 
 		# If the username is there, then we verify the password for it
-		if sha256_crypt.verify(passwordAttempt, result["password"]):
-			return result["id"]    # The ID is needed for other things - pass it back
-		else:
+		valid, newHash = self.passwordHasher.verifyAndUpdate(passwordAttempt, result["password"])
+		if not valid:
+			self.recordFailedLogin(email, ipAddress)
 			return False
 
+		# The hash was made with old settings (like fewer rounds), so swap it for one made with the current settings
+		if newHash:
+			cur = self.con.cursor()
+			cur.execute("UPDATE users SET password = ? WHERE id = ?", [newHash, result["id"]])
+			cur.close()
+
+		self.emailLimiter.reset(email)
+		return result["id"]    # The ID is needed for other things - pass it back
+
+	def recordFailedLogin(self, email, ipAddress):
+		self.emailLimiter.recordFailure(email)
+		self.ipLimiter.recordFailure(ipAddress)
+
 	@createDBConnection
 	def createNewUser(self, verificationToken):
 		cur = self.con.cursor()
@@ -94,14 +102,16 @@ class Authenticator():
 			return False
 
 		# If the user doesn't already exist, then we can generate a new confirmation token and insert
-		# it with the registration details into the database.
+		# it with the registration details into the database. The password is hashed first, so the database isn't
+		# locked while we wait for it.
+		passwordHash = self.passwordHasher.hash(password)
 		cur = self.con.cursor()
 		# If there is already a pending user with this email, then the person has gone back,
 		# changed their password and resubmitted their registration form. It will be the same person
 		# because obviously email address wont be assigned to more than one person. This means we can delete
 		# their previous request as it is no longer needed since they changed their details.
 		cur.execute("DELETE FROM pending_users WHERE email = ?", [email])
-		cur.execute("INSERT INTO pending_users (email, password, verification_token, time_created) VALUES (?, ?, ?, ?)", [email, sha256_crypt.hash(password), uuid4().hex, time()])
+		cur.execute("INSERT INTO pending_users (email, password, verification_token, time_created) VALUES (?, ?, ?, ?)", [email, passwordHash, uuid4().hex, time()])
 		self.con.commit()
 		cur.close()
 		
@@ -127,8 +137,9 @@ class Authenticator():
 	# Updates password for specified user
 	@createDBConnection
 	def updatePassword(self, userID, password):
+		passwordHash = self.passwordHasher.hash(password)
 		cur = self.con.cursor()
-		cur.execute("UPDATE users SET password = ? WHERE id = ?", [sha256_crypt.hash(password), userID])
+		cur.execute("UPDATE users SET password = ? WHERE id = ?", [passwordHash, userID])
 		cur.execute("DELETE FROM password_resets WHERE user_id = ?", [userID])
 		self.con.commit()
 		cur.close()
@@ -183,14 +194,11 @@ class Authenticator():
 
 	# Purges any accounts that have not been verified within half an hour
 	# Does the ame thing with password resets
+	# Failed logins that no longer count towards the limits are forgotten as well
+	@createDBConnection
 	def removeExpiredTokens(self):
-		# Cant use the decorator because this runs in another thread
-		con = sqlite3.connect(self.dbPath)
-		cur = con.cursor()
-
-		cur.execute("DELETE FROM pending_users WHERE ? - time_created > 1800", [time()])
-		cur.execute("DELETE FROM password_resets WHERE ? - time_created > 1800", [time()])
-
-		con.commit()
-		cur.close()
-		con.close()
\ No newline at end of file
+		cur = self.con.cursor()
+		cur.execute("DELETE FROM pending_users WHERE time_created < ?", [time() - 1800])
+		cur.execute("DELETE FROM password_resets WHERE time_created < ?", [time() - 1800])
+		cur.execute("DELETE FROM login_failures WHERE time_created <= ?", [time() - self.LOGIN_WINDOW])
+		cur.close()
\ No newline at end of file
@@ -0,0 +1,170 @@
+from json import dumps, loads
+from time import time, sleep
+from urllib.parse import quote, urlparse, parse_qs
+from urllib3 import PoolManager, Timeout, Retry
+from urllib3.exceptions import HTTPError
+
+from scraper import BrowserManager
+from parsing import EXTRACT_EVENTS_SCRIPT, extractEventsFromHTML, extractEventsFromShipment
+from errors import FetchError
+from metrics import SCRAPE_DURATION
+# These are for waiting for the package data to appear
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import StaleElementReferenceException, WebDriverException
+
+# Where the tracking pages live. The tracking number goes on the end.
+TRACKING_URL = "https://parcelsapp.com/en/tracking/"
+# parcelsapp's tracking API, which sends back the events as JSON
+API_URL = "https://parcelsapp.com/api/v3/shipments/tracking"
+# Where each backend fetches from when TRACKER_URL isn't set
+DEFAULT_URLS = {"selenium": TRACKING_URL, "http": TRACKING_URL, "api": API_URL}
+
+# A backend is how a scraper worker gets the events for a tracking number. Every backend has the same 3 functions:
+# - urlFor(trackingNumber): the page that is fetched, which is what the upstream limiter limits on
+# - fetchEvents(url): returns the raw events on the page, in the same format as EXTRACT_EVENTS_SCRIPT. Raises FetchError.
+# - close(): frees up whatever the backend is holding on to
+# Each worker gets its own backend, so a backend doesn't need to be thread safe.
+# fetchEvents records how long loading the page and pulling the events out of it took, as the load and extract stages.
+
+# Loads the page in a real browser and waits for the javascript on it to render the events
+class SeleniumBackend():
+	def __init__(self, chromeDriverName, timeout, trackingURL=TRACKING_URL):
+		self.browserManager = BrowserManager(chromeDriverName)
+		self.timeout = timeout
+		self.trackingURL = trackingURL
+
+	def urlFor(self, trackingNumber):
+		return self.trackingURL + trackingNumber
+
+	def fetchEvents(self, url):
+		try:
+			# This makes sure the browser is still alive, and restarts it if it has been running for too long. A restart
+			# that fails is a failed scrape like any other, so it has to be inside the try.
+			browser = self.browserManager.getBrowser()
+			with SCRAPE_DURATION.time("load"):
+				browser.get(url)
+				# Wait until the data has been fetched - a <ul> element will appear on the page. If it doesn't turn up in
+				# time then we give up on this number for now, rather than blocking the worker.
+				unorderedList = WebDriverWait(browser, self.timeout, ignored_exceptions=(StaleElementReferenceException,)).until(EC.presence_of_element_located(("css selector", ".list-unstyled.events")))
+			# Pull every event out of the list in a single call to the browser
+			with SCRAPE_DURATION.time("extract"):
+				events = browser.execute_script(EXTRACT_EVENTS_SCRIPT, unorderedList)
+		# TimeoutException is a WebDriverException
+		except WebDriverException as e:
+			raise FetchError(repr(e)) from e
+		finally:
+			self.browserManager.pageDone()
+		return events
+
+	def close(self):
+		self.browserManager.quit()
+
+# Fetches the page with a plain HTTP request and parses the events out of the HTML, without running a browser at all.
+# Connections are pooled and kept alive between requests, so most scrapes don't even need a new TCP/TLS handshake.
+# This only works when the events are in the HTML that is sent back, like with the fake tracking site in fixtures/.
+# parcelsapp renders its events with javascript, so this can't be pointed at the real website (see createBackend), but
+# ParcelsAppAPIBackend can.
+class HTTPBackend():
+	HEADERS = {
+		"User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/90.0.4430.93 Safari/537.36",
+		"Accept": "text/html",
+		"Accept-Language": "en",
+	}
+
+	def __init__(self, timeout, trackingURL):
+		self.trackingURL = trackingURL
+		# Failed requests are retried by the queue's backoff instead, so the only thing followed here is redirects
+		self.pool = PoolManager(num_pools=4, maxsize=1, headers=self.HEADERS, timeout=Timeout(connect=10, read=timeout), retries=Retry(total=None, connect=0, read=0, status=0, other=0, redirect=3))
+
+	def urlFor(self, trackingNumber):
+		return self.trackingURL + trackingNumber
+
+	def fetchEvents(self, url):
+		try:
+			with SCRAPE_DURATION.time("load"):
+				response = self.pool.request("GET", url)
+		except HTTPError as e:
+			raise FetchError(repr(e)) from e
+
+		if response.status != 200:
+			raise FetchError("Got HTTP " + str(response.status) + " from " + url)
+		with SCRAPE_DURATION.time("extract"):
+			events = extractEventsFromHTML(response.data.decode("utf-8", "replace"))
+		if not events:
+			raise FetchError("There are no events on " + url)
+		return events
+
+	def close(self):
+		self.pool.clear()
+
+# Gets the events from parcelsapp's tracking API as JSON over the same pooled connections as HTTPBackend, so the real
+# website can be tracked without a browser. The API needs a key (PARCELSAPP_API_KEY). A tracking request starts a
+# search and answers with a uuid, which is polled until the search is done. Numbers that parcelsapp has looked up
+# recently are done straight away. Polling keeps the worker's upstream limiter slot, so it counts as one page load.
+class ParcelsAppAPIBackend(HTTPBackend):
+	POLL_INTERVAL = 1
+
+	def __init__(self, timeout, apiURL, apiKey):
+		super().__init__(timeout, apiURL)
+		self.timeout = timeout
+		self.apiKey = apiKey
+
+	# The API is sent the tracking number in the request body. It goes in the URL as well, so the scrape errors and
+	# fetchEvents know which number it is.
+	def urlFor(self, trackingNumber):
+		return self.trackingURL + "?trackingId=" + quote(trackingNumber)
+
+	def fetchEvents(self, url):
+		trackingNumber = parse_qs(urlparse(url).query)["trackingId"][0]
+		with SCRAPE_DURATION.time("load"):
+			result = self.requestJSON("POST", body=dumps({"shipments": [{"trackingId": trackingNumber, "language": "en"}], "language": "en", "apiKey": self.apiKey}))
+			giveUpAt = time() + self.timeout
+			while not result.get("done"):
+				if "uuid" not in result:
+					raise FetchError("parcelsapp didn't start tracking " + trackingNumber + ": " + str(result.get("error")))
+				if time() >= giveUpAt:
+					raise FetchError("parcelsapp was still looking for " + trackingNumber + " after " + str(self.timeout) + " seconds")
+				sleep(self.POLL_INTERVAL)
+				result = self.requestJSON("GET", fields={"uuid": result["uuid"], "apiKey": self.apiKey})
+
+		with SCRAPE_DURATION.time("extract"):
+			shipments = [shipment for shipment in result.get("shipments") or [] if shipment.get("trackingId") == trackingNumber]
+			return extractEventsFromShipment(shipments[0] if shipments else None)
+
+	# Sends a request to the API and returns the JSON it answers with
+	def requestJSON(self, method, **requestArgs):
+		headers = dict(self.HEADERS, **{"Accept": "application/json", "Content-Type": "application/json"})
+		try:
+			response = self.pool.request(method, self.trackingURL, headers=headers, **requestArgs)
+		except HTTPError as e:
+			raise FetchError(repr(e)) from e
+
+		if response.status != 200:
+			raise FetchError("Got HTTP " + str(response.status) + " from " + self.trackingURL)
+		try:
+			return loads(response.data)
+		except ValueError as e:
+			raise FetchError("parcelsapp sent back something that isn't JSON") from e
+
+# Raises ValueError if createBackend can't make a working backend from these. The worker checks this when it starts,
+# since the backends themselves are only created later on the scraper threads.
+def checkBackendSettings(name, trackingURL=None, apiKey=None):
+	if name not in DEFAULT_URLS:
+		raise ValueError("Unknown tracker backend: " + name)
+	# Every page from parcelsapp would be a failed fetch, so refuse to start rather than dead letter the whole queue
+	if name == "http" and (trackingURL or TRACKING_URL) == TRACKING_URL:
+		raise ValueError("The http tracker backend needs TRACKER_URL pointing at a site with the events in its HTML. Use the api backend for parcelsapp.")
+	if name == "api" and not apiKey:
+		raise ValueError("The api tracker backend needs PARCELSAPP_API_KEY")
+
+# Creates a backend from its name. TRACKER_BACKEND in the environment picks which one is used. trackingURL defaults to
+# the backend's own URL from DEFAULT_URLS.
+def createBackend(name, chromeDriverName, timeout, trackingURL=None, apiKey=None):
+	checkBackendSettings(name, trackingURL, apiKey)
+	trackingURL = trackingURL or DEFAULT_URLS[name]
+	if name == "selenium":
+		return SeleniumBackend(chromeDriverName, timeout, trackingURL)
+	if name == "api":
+		return ParcelsAppAPIBackend(timeout, trackingURL, apiKey)
+	return HTTPBackend(timeout, trackingURL)
@@ -0,0 +1,184 @@
+import sqlite3
+from argparse import ArgumentParser
+from os import path, unlink
+from random import Random
+from sys import exit
+from time import time
+
+from database.migrate import migrate
+from packages import fingerprintEvent
+from parsing import formatStoredEvent
+from passwords import createCryptContext
+
+# Fills a database with made up users, packages and events, so the benchmarks have something realistic to run against.
+# It starts from a fresh database (the same way dbCreator does) and the numbers are chosen so every scheduled job has
+# work to do: some numbers are due for a refresh, some are delivered, and some packages are old enough to be reminded
+# about or deleted. The tracking numbers are made so the fake tracking site in fixtures/ gives the right page for them.
+# Run it from the root of the project: python -m benchmarks.generateData --users 100000 --packages 1000000 --events 20000000
+ROOT_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+DAY = 86400
+
+# Rows are inserted this many at a time, each lot in its own transaction
+CHUNK_SIZE = 50000
+
+# What happens to a package on its way, in order. Delivered numbers finish with the last one.
+EVENT_DESCRIPTIONS = [
+	"Shipment information received",
+	"Accepted at origin facility",
+	"Departed from origin facility",
+	"Arrived at sorting center",
+	"Departed from sorting center",
+	"Handed over to airline",
+	"Arrived at destination country",
+	"Customs clearance completed",
+	"In transit to local depot",
+	"Arrived at local depot",
+	"Out for delivery",
+	"Delivered",
+]
+
+def insertInChunks(con, statement, rows, label):
+	inserted = 0
+	chunk = []
+	for row in rows:
+		chunk.append(row)
+		if len(chunk) == CHUNK_SIZE:
+			con.executemany(statement, chunk)
+			con.commit()
+			inserted += len(chunk)
+			chunk = []
+			print("\r" + label + ": " + str(inserted), end="", flush=True)
+	con.executemany(statement, chunk)
+	con.commit()
+	print("\r" + label + ": " + str(inserted + len(chunk)))
+
+class DataGenerator():
+	def __init__(self, users, packages, events, sharedFraction, deliveredFraction, noInformationFraction, seed):
+		self.userCount = users
+		self.packageCount = packages
+		self.eventCount = events
+		# Some packages track a number that someone else is already tracking, so there are fewer numbers than packages
+		self.numberCount = max(1, int(packages * (1 - sharedFraction)))
+		self.deliveredFraction = deliveredFraction
+		self.noInformationFraction = noInformationFraction
+		self.seed = seed
+		self.now = int(time())
+
+	# Everything about a tracking number comes from its own random generator, so the numbers and their events can be
+	# generated separately and still agree with each other
+	def numberRandom(self, numberID):
+		return Random(self.seed * 1000003 + numberID)
+
+	# Returns the tracking number, when it was added, when it last got new data and whether it has been delivered
+	def describeNumber(self, numberID):
+		random = self.numberRandom(numberID)
+		kind = random.random()
+		delivered = kind < self.deliveredFraction
+		noInformation = not delivered and kind < self.deliveredFraction + self.noInformationFraction
+		number = ("NOINFO" if noInformation else "BM") + str(numberID).zfill(10) + ("DLV" if delivered else "")
+		# Up to 45 days old, so some of them are past the reminder and deletion ages
+		added = self.now - random.randint(0, 45 * DAY)
+		lastNewData = random.randint(added, self.now)
+		return number, added, lastNewData, delivered, noInformation
+
+	def eventCountFor(self, numberID):
+		perNumber, remainder = divmod(self.eventCount, self.numberCount)
+		return perNumber + (1 if numberID <= remainder else 0)
+
+	def users(self):
+		# Every user gets the same password, so it only needs hashing once
+		passwordHash = createCryptContext(1000).hash("benchmark-password")
+		for userID in range(1, self.userCount + 1):
+			yield (userID, "user" + str(userID) + "@example.com", passwordHash)
+
+	def trackingNumbers(self):
+		for numberID in range(1, self.numberCount + 1):
+			number, added, lastNewData, delivered, noInformation = self.describeNumber(numberID)
+			# Numbers are due at some point in the next few hours, or a bit in the past. Delivered ones never are.
+			nextDueAt = None if delivered else self.now + self.numberRandom(numberID).randint(-3600, 6 * 3600)
+			yield (numberID, number, lastNewData, lastNewData, nextDueAt)
+
+	def events(self):
+		for numberID in range(1, self.numberCount + 1):
+			number, added, lastNewData, delivered, noInformation = self.describeNumber(numberID)
+			count = self.eventCountFor(numberID)
+			if noInformation:
+				count = min(count, 1)
+			random = self.numberRandom(numberID)
+			for position in range(count):
+				# Spread out between when the number was added and when it last got new data, oldest first
+				eventTimestamp = added + (lastNewData - added) * (position + 1) // count
+				hasTime = random.random() > 0.1
+				if not hasTime:
+					eventTimestamp -= eventTimestamp % DAY
+				if noInformation:
+					data = "There is no tracking information for your package. Please make sure the tracking code is correct."
+				elif delivered and position == count - 1:
+					data = EVENT_DESCRIPTIONS[-1]
+				elif position == 0:
+					data = EVENT_DESCRIPTIONS[0]
+				# Long journeys go round the middle of the list again. Every event says where it happened, so no two
+				# events of a number are the same (they would have the same fingerprint).
+				else:
+					data = EVENT_DESCRIPTIONS[1 + (position - 1) % (len(EVENT_DESCRIPTIONS) - 2)] + " - Hub " + str(position)
+				date, eventTime = formatStoredEvent(eventTimestamp)
+				yield (numberID, date, eventTime, eventTimestamp, int(hasTime), data, fingerprintEvent(date, eventTime, data))
+
+	def packages(self):
+		random = Random(self.seed)
+		for packageID in range(1, self.packageCount + 1):
+			numberID = packageID if packageID <= self.numberCount else random.randint(1, self.numberCount)
+			number, added, lastNewData, delivered, noInformation = self.describeNumber(numberID)
+			title = "Package " + str(packageID) if random.random() < 0.5 else None
+			yield (packageID, title, number, numberID, random.randint(1, self.userCount), lastNewData)
+
+	def generate(self, con):
+		insertInChunks(con, "INSERT INTO users (id, email, password) VALUES (?, ?, ?)", self.users(), "Users")
+		insertInChunks(con, "INSERT INTO tracking_numbers (id, number, last_updated, last_new_data, next_due_at) VALUES (?, ?, ?, ?, ?)", self.trackingNumbers(), "Tracking numbers")
+		insertInChunks(con, "INSERT INTO package_data (tracking_number_id, date, time, event_ts, has_time, data, fingerprint) VALUES (?, ?, ?, ?, ?, ?, ?)", self.events(), "Events")
+		insertInChunks(con, "INSERT INTO packages (id, title, trackingNumber, tracking_number_id, user_id, last_new_data) VALUES (?, ?, ?, ?, ?, ?)", self.packages(), "Packages")
+
+		# Copy the newest event onto every package, the same way migration 0010 does
+		for firstID in range(1, self.packageCount + 1, CHUNK_SIZE):
+			con.execute("UPDATE packages SET latest_event = (SELECT data FROM package_data WHERE package_data.tracking_number_id = packages.tracking_number_id ORDER BY event_ts DESC, id DESC LIMIT 1), latest_event_ts = (SELECT event_ts FROM package_data WHERE package_data.tracking_number_id = packages.tracking_number_id ORDER BY event_ts DESC, id DESC LIMIT 1), latest_event_has_time = (SELECT has_time FROM package_data WHERE package_data.tracking_number_id = packages.tracking_number_id ORDER BY event_ts DESC, id DESC LIMIT 1) WHERE id >= ? AND id < ?", [firstID, firstID + CHUNK_SIZE])
+			con.commit()
+		print("Latest events copied onto packages")
+
+if __name__ == "__main__":
+	argParser = ArgumentParser(description="Fills a database with made up data for the benchmarks")
+	argParser.add_argument("--db", default=path.join(ROOT_DIR, "database", "database.db"))
+	argParser.add_argument("--users", type=int, default=1000)
+	argParser.add_argument("--packages", type=int, default=10000)
+	argParser.add_argument("--events", type=int, default=200000)
+	argParser.add_argument("--shared-fraction", type=float, default=0.1, help="The fraction of packages that track a number someone else also tracks")
+	argParser.add_argument("--delivered-fraction", type=float, default=0.3)
+	argParser.add_argument("--no-information-fraction", type=float, default=0.05)
+	argParser.add_argument("--seed", type=int, default=1)
+	argParser.add_argument("--overwrite", action="store_true", help="Replace the database even if it already has users in it")
+	args = argParser.parse_args()
+
+	# Don't throw away a database someone is actually using unless they say so
+	if path.exists(args.db):
+		with sqlite3.connect(args.db) as con:
+			hasUsers = con.execute("SELECT name FROM sqlite_master WHERE name = 'users'").fetchone() and con.execute("SELECT 1 FROM users LIMIT 1").fetchone()
+		con.close()
+		if hasUsers and not args.overwrite:
+			exit(args.db + " already has users in it. Pass --overwrite to replace it.")
+		for filePath in [args.db, args.db + "-wal", args.db + "-shm"]:
+			if path.exists(filePath):
+				unlink(filePath)
+
+	with sqlite3.connect(args.db) as con:
+		with open(path.join(ROOT_DIR, "database", "database_schema.sql")) as schemaFile:
+			con.executescript(schemaFile.read())
+	con.close()
+	migrate(args.db)
+
+	start = time()
+	con = sqlite3.connect(args.db)
+	# Nothing else is using the database while it is being filled, so it doesn't need to survive a crash
+	con.execute("PRAGMA synchronous = OFF")
+	con.execute("PRAGMA cache_size = -262144")
+	DataGenerator(args.users, args.packages, args.events, args.shared_fraction, args.delivered_fraction, args.no_information_fraction, args.seed).generate(con)
+	con.close()
+	print("Generated in " + str(round(time() - start, 1)) + " seconds")
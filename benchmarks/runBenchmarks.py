@@ -0,0 +1,241 @@
+import sqlite3
+import subprocess
+import sys
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from json import dumps, load
+from os import environ, path
+from random import Random
+from shutil import copyfile
+from statistics import mean, median
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import time, perf_counter
+
+# The app needs these to be set, but they aren't used for anything here
+environ.setdefault("FLASK_KEY", "benchmark")
+environ.setdefault("EMAIL_ADDRESS", "benchmark@example.com")
+
+import main
+from backends import HTTPBackend
+from connections import ConnectionManager
+from emails import EmailHandler
+from packages import PackageHandler
+from scraper import UpstreamLimiter
+from fixtures.fakeTrackingSite import createServer, PATH_PREFIX
+
+# Times the busiest parts of the app against a copy of a database (fill one with benchmarks/generateData.py first).
+# Scrapes go to the fake tracking site in fixtures/, which is started here. The results are written to JSON, and can be
+# compared against an earlier run to catch anything that got slower.
+# Run it from the root of the project: python -m benchmarks.runBenchmarks --output results.json [--compare old.json]
+ROOT_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+
+# Times runs calls of function and returns a summary of how long they took, in milliseconds. setup is called before
+# each one (untimed) and returns the arguments for it, and teardown is called after each one (also untimed).
+# There is one extra run at the start that isn't counted, so things that only happen once (like loading the handlers
+# or compiling a template) don't end up in the results.
+def measure(function, runs, setup=None, teardown=None):
+	times = []
+	for i in range(runs + 1):
+		args = setup() if setup else ()
+		start = perf_counter()
+		function(*args)
+		times.append((perf_counter() - start) * 1000)
+		if teardown:
+			teardown()
+	times = sorted(times[1:])
+	return {
+		"runs": runs,
+		"median_ms": median(times),
+		"mean_ms": mean(times),
+		"p95_ms": times[min(len(times) - 1, int(len(times) * 0.95))],
+		"min_ms": times[0],
+		"max_ms": times[-1],
+	}
+
+# Some jobs change the database in a way that leaves nothing to do the next time (like deleting the dead packages),
+# so their changes are thrown away after each run. Making the decorated function think it is nested inside another one
+# stops it from committing (see createDBConnection), and then everything it did is rolled back.
+class RolledBack():
+	def __init__(self, connections):
+		self.connections = connections
+
+	def setup(self):
+		threadData = self.connections.threadData
+		threadData.depth = getattr(threadData, "depth", 0) + 1
+		return ()
+
+	def teardown(self):
+		self.connections.threadData.depth -= 1
+		self.connections.getConnection().rollback()
+
+class Benchmarks():
+	def __init__(self, dbPath, runs, scrapes, trackingURL, seed):
+		self.dbPath = dbPath
+		self.runs = runs
+		self.scrapes = scrapes
+		self.trackingURL = trackingURL
+		self.random = Random(seed)
+
+		self.connections = ConnectionManager(dbPath)
+		self.packageHandler = PackageHandler(self.connections, EmailHandler(self.connections))
+		self.app = main.create_app(dbPath)
+		self.client = self.app.test_client()
+
+		# Picked once up front, the benchmarks then choose from these at random
+		con = sqlite3.connect(dbPath)
+		self.userIDs = [row[0] for row in con.execute("SELECT DISTINCT user_id FROM packages ORDER BY RANDOM() LIMIT 1000")]
+		self.packages = con.execute("SELECT id, user_id FROM packages ORDER BY RANDOM() LIMIT 1000").fetchall()
+		self.counts = {table: con.execute("SELECT COUNT(*) FROM " + table).fetchone()[0] for table in ["users", "tracking_numbers", "packages", "package_data"]}
+		con.close()
+		if not self.packages:
+			raise ValueError(dbPath + " has no packages in it. Fill it with benchmarks/generateData.py first.")
+
+	def randomPackage(self):
+		return self.random.choice(self.packages)
+
+	def logIn(self, userID):
+		with self.client.session_transaction() as session:
+			session["userID"] = userID
+
+	def run(self):
+		results = {}
+		rolledBack = RolledBack(self.connections)
+		packageHandler = self.packageHandler
+
+		# The scheduled jobs
+		results["addOldPackagesToQueue"] = measure(packageHandler.addOldPackagesToQueue, self.runs, rolledBack.setup, rolledBack.teardown)
+		results["checkForDeadPackages"] = measure(packageHandler.checkForDeadPackages, self.runs, rolledBack.setup, rolledBack.teardown)
+
+		# The package list and the package data, straight from the package handler
+		results["getListOfPackages"] = measure(packageHandler.getListOfPackages, self.runs, lambda: (self.random.choice(self.userIDs),))
+		def coldPackage():
+			packageID, userID = self.randomPackage()
+			packageHandler.packageDataCache.invalidate(packageID)
+			return packageID, userID
+		results["getPackageData (cold)"] = measure(packageHandler.getPackageData, self.runs, coldPackage)
+		def warmPackage():
+			packageID, userID = self.randomPackage()
+			packageHandler.getPackageData(packageID, userID)
+			return packageID, userID
+		results["getPackageData (warm)"] = measure(packageHandler.getPackageData, self.runs, warmPackage)
+
+		# Scraping, against the fake tracking site. Each run scrapes one random number, which is put at the front of the queue.
+		backend = HTTPBackend(30, self.trackingURL)
+		upstreamLimiter = UpstreamLimiter(1)
+		def queueRandomNumber():
+			packageID, userID = self.randomPackage()
+			con = self.connections.getConnection()
+			con.execute("INSERT INTO queue (tracking_number_id, priority, queued_at) SELECT tracking_number_id, 1, ? FROM packages WHERE id = ? ON CONFLICT (tracking_number_id) DO UPDATE SET priority = 1, attempts = 0, dead = 0, lease_expires = 0, claimed_by = NULL", [time(), packageID])
+			con.commit()
+			return backend, "benchmark", upstreamLimiter
+		results["scrapeNextInQueue"] = measure(packageHandler.scrapeNextInQueue, self.scrapes, queueRandomNumber)
+		backend.close()
+
+		# The website, through flask. These include rendering and everything else a real request does.
+		def get(url):
+			response = self.client.get(url)
+			assert response.status_code in (200, 304), url + " returned " + str(response.status_code)
+		def post(url, data):
+			response = self.client.post(url, data=data)
+			assert response.status_code == 200, url + " returned " + str(response.status_code)
+
+		def packageListPage():
+			packageID, userID = self.randomPackage()
+			self.logIn(userID)
+			return ("/packageList",)
+		results["GET /packageList"] = measure(get, self.runs, packageListPage)
+		def nextPage():
+			packageID, userID = self.randomPackage()
+			self.logIn(userID)
+			return ("/packageListPage?before=" + str(packageID + 1),)
+		results["GET /packageListPage"] = measure(get, self.runs, nextPage)
+		def packageData():
+			packageID, userID = self.randomPackage()
+			self.logIn(userID)
+			return ("/packageData?packageID=" + str(packageID),)
+		results["GET /packageData"] = measure(get, self.runs, packageData)
+		def packageDataBatch():
+			packageID, userID = self.randomPackage()
+			self.logIn(userID)
+			# The first page of the user's packages, the same as the package list prefetches
+			packageIDs = [str(row[0]) for row in self.connections.getConnection().execute("SELECT id FROM packages WHERE user_id = ? ORDER BY id DESC LIMIT 50", [userID])]
+			return ("/packageDataBatch", {"packageIDs": ",".join(packageIDs)})
+		results["POST /packageDataBatch"] = measure(post, self.runs, packageDataBatch)
+		importNumbers = iter(range(10 ** 9))
+		def importPackages():
+			packageID, userID = self.randomPackage()
+			self.logIn(userID)
+			return ("/importPackages", "\n".join("IMPORT" + str(next(importNumbers)).zfill(8) for i in range(100)))
+		results["POST /importPackages (100 numbers)"] = measure(post, self.runs, importPackages)
+
+		return results
+
+def gitCommit():
+	try:
+		return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+# Prints how every benchmark compares to the same one in an earlier run. Returns the names of the ones whose median
+# got more than threshold (a fraction) slower.
+def compareResults(results, previousResults, threshold):
+	regressions = []
+	for name, result in results.items():
+		previous = previousResults.get(name)
+		if previous is None:
+			continue
+		change = result["median_ms"] / previous["median_ms"] - 1 if previous["median_ms"] else 0
+		regressed = change > threshold
+		if regressed:
+			regressions.append(name)
+		print(name.ljust(40) + (str(round(previous["median_ms"], 2)) + " -> " + str(round(result["median_ms"], 2)) + " ms").ljust(28) + ("+" if change >= 0 else "") + str(round(change * 100, 1)) + "%" + ("  SLOWER" if regressed else ""))
+	return regressions
+
+if __name__ == "__main__":
+	argParser = ArgumentParser(description="Times the scheduled jobs, the scraper and the website against a copy of a database")
+	argParser.add_argument("--db", default=path.join(ROOT_DIR, "database", "database.db"))
+	argParser.add_argument("--runs", type=int, default=50)
+	argParser.add_argument("--scrapes", type=int, default=50, help="How many numbers to scrape")
+	argParser.add_argument("--latency", type=float, default=0, help="Seconds the fake tracking site takes to answer")
+	argParser.add_argument("--seed", type=int, default=1)
+	argParser.add_argument("--output", help="Write the results to this JSON file")
+	argParser.add_argument("--compare", help="A results file from an earlier run to compare against")
+	argParser.add_argument("--threshold", type=float, default=0.25, help="How much slower (as a fraction) counts as a regression")
+	args = argParser.parse_args()
+
+	server = createServer(port=0, delay=args.latency)
+	Thread(target=server.serve_forever, daemon=True).start()
+	trackingURL = "http://127.0.0.1:" + str(server.server_address[1]) + PATH_PREFIX
+
+	# The benchmarks change the data, so they get their own copy of it
+	with TemporaryDirectory() as tempDir:
+		dbPath = path.join(tempDir, "benchmark.db")
+		copyfile(args.db, dbPath)
+		benchmarks = Benchmarks(dbPath, args.runs, args.scrapes, trackingURL, args.seed)
+		results = benchmarks.run()
+		benchmarks.connections.closeConnection()
+		benchmarks.app.handlers.load().updateRelay.stop()
+	server.shutdown()
+
+	for name, result in results.items():
+		print(name.ljust(40) + "median " + str(round(result["median_ms"], 2)).ljust(10) + "p95 " + str(round(result["p95_ms"], 2)) + " ms")
+
+	if args.output:
+		with open(args.output, "w") as outputFile:
+			outputFile.write(dumps({
+				"time": datetime.now(timezone.utc).isoformat(),
+				"commit": gitCommit(),
+				"python": sys.version.split()[0],
+				"sqlite": sqlite3.sqlite_version,
+				"rows": benchmarks.counts,
+				"settings": {"runs": args.runs, "scrapes": args.scrapes, "latency": args.latency, "seed": args.seed},
+				"results": results,
+			}, indent=4))
+
+	if args.compare:
+		with open(args.compare) as previousFile:
+			previous = load(previousFile)
+		print("\nCompared to " + args.compare + " (" + str(previous.get("commit")) + "):")
+		if compareResults(results, previous["results"], args.threshold):
+			sys.exit(1)
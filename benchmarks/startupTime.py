@@ -0,0 +1,69 @@
+import subprocess
+import sys
+from argparse import ArgumentParser
+from json import dumps, loads
+from os import environ, path
+from shutil import copyfile
+from statistics import median
+from tempfile import TemporaryDirectory
+
+# Measures how long the website takes to start, so slow imports or work creeping back into startup get noticed.
+# Every run is a fresh python process (so nothing is already imported), against a copy of the database.
+# Run it from the root of the project: python benchmarks/startupTime.py [--runs 10] [--output results.json]
+ROOT_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+
+# This runs in the fresh process. It prints the timings (in seconds) as JSON.
+RUN_SCRIPT = """
+from time import perf_counter
+from json import dumps
+import sys
+
+start = perf_counter()
+import main
+imported = perf_counter()
+app = main.create_app(sys.argv[1])
+created = perf_counter()
+response = app.test_client().get("/")
+firstRequest = perf_counter()
+assert response.status_code == 200
+app.handlers.load()
+handlersLoaded = perf_counter()
+
+print(dumps({
+	"import": imported - start,
+	"create_app": created - imported,
+	"first_request": firstRequest - created,
+	"time_to_first_request": firstRequest - start,
+	"handlers_load": handlersLoaded - firstRequest,
+}))
+"""
+
+def runOnce(dbPath):
+	env = dict(environ)
+	# The app needs these to be set, but they aren't used for anything here
+	env.setdefault("FLASK_KEY", "startup-benchmark")
+	env.setdefault("EMAIL_ADDRESS", "benchmark@example.com")
+	output = subprocess.run([sys.executable, "-c", RUN_SCRIPT, dbPath], cwd=ROOT_DIR, env=env, capture_output=True, text=True, check=True).stdout
+	# The timings are always the last line
+	return loads(output.strip().splitlines()[-1])
+
+if __name__ == "__main__":
+	argParser = ArgumentParser(description="Measures the startup time of the website")
+	argParser.add_argument("--runs", type=int, default=10)
+	argParser.add_argument("--output", help="Also write the results to this JSON file")
+	args = argParser.parse_args()
+
+	with TemporaryDirectory() as tempDir:
+		dbPath = path.join(tempDir, "database.db")
+		copyfile(path.join(ROOT_DIR, "database", "database.db"), dbPath)
+		# Migrating is a deploy step rather than part of startup (see gunicorn.conf.py), so it happens before the runs
+		subprocess.run([sys.executable, path.join("database", "migrate.py"), dbPath], cwd=ROOT_DIR, check=True, capture_output=True)
+		runs = [runOnce(dbPath) for i in range(args.runs)]
+
+	results = {name: median(run[name] for run in runs) for name in runs[0]}
+	for name, seconds in results.items():
+		print(name.ljust(24) + str(round(seconds * 1000, 1)) + " ms")
+
+	if args.output:
+		with open(args.output, "w") as outputFile:
+			outputFile.write(dumps({"runs": args.runs, "median_seconds": results}, indent=4))
@@ -0,0 +1,60 @@
+from collections import OrderedDict
+from threading import Lock
+
+# A dictionary that holds at most maxSize items. When it is full, the item that was used the longest time ago is
+# thrown out to make room. It is safe to use from several threads at once.
+# It counts its hits, misses and evictions, so we can see if it is actually doing anything.
+class LRUCache():
+	def __init__(self, maxSize):
+		self.maxSize = maxSize
+		self.items = OrderedDict() # Least recently used first
+		self.lock = Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	# Returns the item for the passed key, or None if it isn't cached. isValid can be passed to check that the
+	# item isn't out of date - if it returns False the item is thrown out and counted as a miss.
+	def get(self, key, isValid=None):
+		with self.lock:
+			value = self.items.get(key)
+			if value is not None and isValid is not None and not isValid(value):
+				del self.items[key]
+				value = None
+
+			if value is None:
+				self.misses += 1
+				return None
+			self.items.move_to_end(key)
+			self.hits += 1
+			return value
+
+	def put(self, key, value):
+		with self.lock:
+			self.items[key] = value
+			self.items.move_to_end(key)
+			while len(self.items) > self.maxSize:
+				self.items.popitem(last=False)
+				self.evictions += 1
+
+	def invalidate(self, key):
+		with self.lock:
+			self.items.pop(key, None)
+
+	# Throws out every item that the passed function returns True for
+	def invalidateWhere(self, matches):
+		with self.lock:
+			for key in [key for key, value in self.items.items() if matches(value)]:
+				del self.items[key]
+
+	def stats(self):
+		with self.lock:
+			lookups = self.hits + self.misses
+			return {
+				"size": len(self.items),
+				"maxSize": self.maxSize,
+				"hits": self.hits,
+				"misses": self.misses,
+				"evictions": self.evictions,
+				"hitRate": self.hits / lookups if lookups else 0,
+			}
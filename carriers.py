@@ -0,0 +1,98 @@
+from re import compile
+
+# Works out which carrier a tracking number belongs to from its format alone, without loading any pages. It is used
+# to turn away things that can't be tracking numbers at all, to flag numbers that have the wrong check digit for their
+# carrier (usually a typo), and to show the user which carrier their package is with.
+
+# Every tracking number is made of these characters (with at least one letter or digit), and is somewhere between these lengths
+POSSIBLE_TRACKING_NUMBER = compile(r"(?=.*[A-Z0-9])[A-Z0-9-]{6,40}")
+
+# UPS: the 15 characters after 1Z, with letters turned into digits. Every second one counts double.
+def upsCheckDigitIsValid(match):
+	characters = match.group(1)
+	total = 0
+	for position, character in enumerate(characters[:-1]):
+		value = int(character) if character.isdigit() else (ord(character) - 63) % 10
+		total += value * 2 if position % 2 else value
+	return (10 - total % 10) % 10 == int(characters[-1])
+
+# The GS1 mod 10 check used by USPS (and lots of barcodes): going from the right, every other digit counts triple
+def mod10CheckDigitIsValid(match):
+	digits = match.group(1)
+	total = sum(int(digit) * (3 if position % 2 == 0 else 1) for position, digit in enumerate(reversed(digits[:-1])))
+	return (10 - total % 10) % 10 == int(digits[-1])
+
+# FedEx Express: the first 11 digits weighted 3, 1, 7 over and over
+def fedexCheckDigitIsValid(match):
+	digits = match.group(1)
+	total = sum(int(digit) * (3, 1, 7)[position % 3] for position, digit in enumerate(digits[:11]))
+	return total % 11 % 10 == int(digits[11])
+
+# DHL Express: the first 9 digits as a number, mod 7
+def dhlCheckDigitIsValid(match):
+	digits = match.group(1)
+	return int(digits[:9]) % 7 == int(digits[9])
+
+# The international postal format (UPU S10), like RR123456785NZ. The 9th digit checks the 8 before it.
+def s10CheckDigitIsValid(match):
+	digits = match.group(1)
+	checkDigit = 11 - sum(int(digit) * weight for digit, weight in zip(digits, (8, 6, 4, 2, 3, 5, 9, 7))) % 11
+	return {10: 0, 11: 5}.get(checkDigit, checkDigit) == int(digits[8])
+
+# The postal service that goes with the country code on the end of an S10 number
+POSTAL_SERVICES = {
+	"NZ": "NZ Post",
+	"AU": "Australia Post",
+	"CN": "China Post",
+	"HK": "Hongkong Post",
+	"SG": "Singapore Post",
+	"JP": "Japan Post",
+	"US": "USPS",
+	"GB": "Royal Mail",
+	"CA": "Canada Post",
+	"DE": "Deutsche Post",
+	"FR": "La Poste",
+	"NL": "PostNL",
+}
+
+# Every format we know, as (carrier, pattern, check digit function, strict) tuples, checked in this order. Each pattern
+# has to match the whole number, and its first group is what the check digit function looks at (None means there is no
+# check digit). The carrier can be a function of the match, for formats shared by several carriers.
+# strict formats are distinctive enough that failing the check digit means the number has a typo in it. Formats that
+# are only a certain number of digits are used by plenty of other couriers as well, so failing the check just means it
+# isn't that carrier's number, and the next format is tried.
+CARRIER_FORMATS = [
+	("UPS", compile(r"1Z([0-9A-Z]{16})"), upsCheckDigitIsValid, True),
+	(lambda match: POSTAL_SERVICES.get(match.group(2), "Postal service"), compile(r"[A-Z]{2}(\d{9})([A-Z]{2})"), s10CheckDigitIsValid, True),
+	# An IMpb barcode, sometimes with the 420 + ZIP code routing part in front of it
+	("USPS", compile(r"(?:420\d{5}(?:\d{4})?)?(9[1-5]\d{18,20})"), mod10CheckDigitIsValid, True),
+	("Amazon Logistics", compile(r"(TBA\d{12})"), None, True),
+	("Cainiao", compile(r"(LP\d{14})"), None, True),
+	("YunExpress", compile(r"(YT\d{16})"), None, True),
+	("DHL eCommerce", compile(r"(GM\d{16,18})"), None, True),
+	("FedEx", compile(r"(\d{12})"), fedexCheckDigitIsValid, False),
+	("FedEx", compile(r"(96\d{20})"), mod10CheckDigitIsValid, False),
+	("DHL Express", compile(r"(\d{10})"), dhlCheckDigitIsValid, False),
+]
+
+# Returns True if the passed normalised tracking number could be a tracking number at all
+def isPossibleTrackingNumber(trackingNumber):
+	return POSSIBLE_TRACKING_NUMBER.fullmatch(trackingNumber) is not None
+
+# Returns (carrier, malformed) for the passed normalised tracking number. carrier is None if it isn't in a format we
+# know - lots of smaller couriers aren't in the table, and parcelsapp still finds those. malformed is True if the number
+# is in a format that only one carrier uses but the check digit is wrong.
+def detectCarrier(trackingNumber):
+	# Numbers are often written with dashes in them, but the check digits don't include them
+	trackingNumber = trackingNumber.replace("-", "")
+	for carrier, pattern, checkDigitIsValid, strict in CARRIER_FORMATS:
+		match = pattern.fullmatch(trackingNumber)
+		if match is None:
+			continue
+
+		carrier = carrier(match) if callable(carrier) else carrier
+		if checkDigitIsValid is None or checkDigitIsValid(match):
+			return carrier, False
+		if strict:
+			return carrier, True
+	return None, False
@@ -0,0 +1,72 @@
+import sqlite3
+from threading import local
+from time import perf_counter
+
+from metrics import DB_CALL_DURATION
+
+# Keeps one open sqlite connection per thread, so we don't pay for opening the file, parsing the schema and warming
+# up the page cache on every single request. Every connection is set up with the same tuned pragmas:
+# - WAL journal, so the scrapers writing to the db don't block the website reading from it (and vice versa)
+# - synchronous=NORMAL, which is safe with WAL and saves an fsync on every commit
+# - a bigger page cache and memory mapped IO, so hot pages stay in memory
+# - a busy timeout, so a writer waits for the lock instead of failing straight away
+class ConnectionManager():
+	def __init__(self, dbPath, cacheSizeKB=16384, mmapSize=268435456, busyTimeoutMS=5000, statementCacheSize=256):
+		self.dbPath = dbPath
+		self.cacheSizeKB = cacheSizeKB
+		self.mmapSize = mmapSize
+		self.busyTimeoutMS = busyTimeoutMS
+		self.statementCacheSize = statementCacheSize
+		self.threadData = local()
+
+	# Returns the connection for the thread that calls this, opening it first if this thread doesn't have one yet
+	def getConnection(self):
+		con = getattr(self.threadData, "con", None)
+		if con is None:
+			# cached_statements is the size of sqlite3's prepared statement cache. Our queries are all fixed strings,
+			# so after warming up they never need to be parsed again.
+			con = sqlite3.connect(self.dbPath, timeout=self.busyTimeoutMS / 1000, cached_statements=self.statementCacheSize)
+			con.execute("PRAGMA journal_mode = WAL")
+			con.execute("PRAGMA synchronous = NORMAL")
+			con.execute("PRAGMA cache_size = -" + str(self.cacheSizeKB)) # Negative means KB instead of pages
+			con.execute("PRAGMA mmap_size = " + str(self.mmapSize))
+			con.execute("PRAGMA busy_timeout = " + str(self.busyTimeoutMS))
+			self.threadData.con = con
+		return con
+
+	# Closes the connection for the thread that calls this. The next getConnection on this thread opens a new one.
+	def closeConnection(self):
+		con = getattr(self.threadData, "con", None)
+		if con is not None:
+			con.close()
+			self.threadData.con = None
+
+# This will be a decorator. It gets applied to class functions that use the database. The class needs to have a
+# connections attribute (a ConnectionManager). The function gets this thread's connection through self.con, and the
+# transaction is committed when it returns or rolled back if it raises. Decorated functions can call each other - only
+# the outermost one commits, so everything they do ends up in one transaction. This saves having to write a new
+# with-connect-as block every time I just want to get a cursor. Plus, decorators are cool!
+# How long each call takes (including the commit) is recorded in the metrics, under the function's name.
+def createDBConnection(func):
+	name = func.__qualname__
+	def wrapper(self, *args, **kwargs):
+		start = perf_counter()
+		try:
+			con = self.connections.getConnection()
+			threadData = self.connections.threadData
+			threadData.depth = getattr(threadData, "depth", 0) + 1
+			try:
+				result = func(self, *args, **kwargs)
+			except:
+				if threadData.depth == 1:
+					con.rollback()
+				raise
+			finally:
+				threadData.depth -= 1
+
+			if threadData.depth == 0:
+				con.commit()
+			return result
+		finally:
+			DB_CALL_DURATION.observe(perf_counter() - start, name)
+	return wrapper
@@ -0,0 +1,74 @@
+import ast
+import sqlite3
+from os import path
+from re import match
+from sys import exit
+from tempfile import TemporaryDirectory
+
+from database.migrate import migrate
+
+# Runs EXPLAIN QUERY PLAN on every query in the files below, against an empty database at the latest schema version.
+# If any query has to scan a whole table then it is printed and the script fails, so a missing index gets caught
+# before it gets anywhere near the real database. tests/test_queryPlans.py runs the same check as part of the tests.
+# It can also be run by itself from the root of the project: python -m database.checkQueryPlans
+ROOT_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+CHECKED_FILES = ["packages.py", "auth.py", "passwords.py", "worker.py", "updates.py"]
+
+# Builds the SQL string passed to an execute call. Bits of the query that are built at runtime (like a list of
+# placeholders for an IN clause) are replaced with a single placeholder. Returns None if it isn't a query string.
+def buildQuery(node):
+	if isinstance(node, ast.Constant) and isinstance(node.value, str):
+		return node.value
+	if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+		left, right = buildQuery(node.left), buildQuery(node.right)
+		return (left if left is not None else "?") + (right if right is not None else "?")
+	return None
+
+# Finds every query passed to execute or executemany in the passed file, as (line number, query) tuples
+def findQueries(filePath):
+	with open(filePath) as sourceFile:
+		tree = ast.parse(sourceFile.read())
+
+	queries = []
+	for node in ast.walk(tree):
+		if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr in ("execute", "executemany") and node.args:
+			query = buildQuery(node.args[0])
+			if query is not None and match(r"\s*(SELECT|INSERT|UPDATE|DELETE)\b", query):
+				queries.append((node.lineno, query))
+	return sorted(queries)
+
+# A full scan shows up as "SCAN <table>". "SCAN <table> USING INDEX" walks an index in order, which is fine.
+def isFullScan(planDetail):
+	return match(r"SCAN (TABLE )?\w+( AS \w+)?$", planDetail) is not None and not planDetail.startswith("SCAN CONSTANT")
+
+def checkQueryPlans(con, filePaths):
+	failures = []
+	for filePath in filePaths:
+		for lineNumber, query in findQueries(filePath):
+			# The values don't matter for the plan, so every placeholder just gets a NULL
+			plan = con.execute("EXPLAIN QUERY PLAN " + query, [None] * query.count("?")).fetchall()
+			for row in plan:
+				if isFullScan(row[-1]):
+					failures.append((path.basename(filePath), lineNumber, row[-1], query))
+	return failures
+
+if __name__ == "__main__":
+	# Build an empty database the same way dbCreator does
+	with TemporaryDirectory() as tempDir:
+		dbPath = path.join(tempDir, "queryPlans.db")
+		with sqlite3.connect(dbPath) as con:
+			with open(path.join(ROOT_DIR, "database", "database_schema.sql")) as schemaFile:
+				con.executescript(schemaFile.read())
+		migrate(dbPath)
+
+		con = sqlite3.connect(dbPath)
+		failures = checkQueryPlans(con, [path.join(ROOT_DIR, fileName) for fileName in CHECKED_FILES])
+		con.close()
+
+	for fileName, lineNumber, planDetail, query in failures:
+		print(fileName + ":" + str(lineNumber) + " " + planDetail + "\n\t" + query)
+
+	if failures:
+		print(str(len(failures)) + " queries do a full table scan")
+		exit(1)
+	print("No full table scans")
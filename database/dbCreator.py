@@ -1,7 +1,13 @@
 import sqlite3
 from os import unlink
 
+from migrate import migrate
+
 unlink("./database/database.db")
 with sqlite3.connect("./database/database.db") as con:
 	with open("./database/database_schema.sql") as schemaFile:
-		con.executescript(schemaFile.read())
\ No newline at end of file
+		con.executescript(schemaFile.read())
+con.close()
+
+# The schema file is the starting point, every change since then is a migration
+migrate("./database/database.db")
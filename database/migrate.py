@@ -0,0 +1,92 @@
+import sqlite3
+from importlib.util import spec_from_file_location, module_from_spec
+from os import listdir, path
+from sys import argv
+
+# Each migration is a .sql file in this folder, named like 0001_description.sql. The number at the start is the schema
+# version that the migration upgrades the database to. The current version of a database is kept in PRAGMA user_version.
+# Migrations that need to do more than SQL can do (like working through a big table a bit at a time) can be a .py file
+# instead, see runPythonMigration.
+MIGRATIONS_DIR = path.join(path.dirname(path.abspath(__file__)), "migrations")
+
+# Returns every migration as a (version, filePath) tuple, in the order they need to be applied
+def getMigrations():
+	migrations = []
+	for fileName in listdir(MIGRATIONS_DIR):
+		if fileName.endswith(".sql") or fileName.endswith(".py"):
+			migrations.append((int(fileName.split("_")[0]), path.join(MIGRATIONS_DIR, fileName)))
+	return sorted(migrations)
+
+def latestVersion():
+	migrations = getMigrations()
+	return migrations[-1][0] if migrations else 0
+
+# Splits a script into its separate statements so they can be run one by one inside our own transaction.
+# executescript can't be used because it always commits before it starts.
+def splitStatements(script):
+	statements = []
+	current = ""
+	for line in script.splitlines(keepends=True):
+		current += line
+		if sqlite3.complete_statement(current):
+			statements.append(current.strip())
+			current = ""
+	if current.strip() and not current.strip().startswith("--"):
+		statements.append(current.strip())
+	return statements
+
+# Applies every migration that the database at dbPath doesn't have yet. Each migration runs in its own transaction
+# together with the version bump, so a failed migration leaves the database exactly as it was. The write lock is taken
+# before the version is checked, so several processes starting up at once wont apply the same migration twice.
+# Returns the version the database ended up at.
+def migrate(dbPath):
+	con = sqlite3.connect(dbPath, isolation_level=None) # We handle the transactions ourselves
+	try:
+		for version, filePath in getMigrations():
+			if filePath.endswith(".py"):
+				runPythonMigration(con, version, filePath)
+				continue
+
+			con.execute("BEGIN IMMEDIATE")
+			try:
+				if con.execute("PRAGMA user_version").fetchone()[0] >= version:
+					con.execute("COMMIT")
+					continue
+
+				with open(filePath) as migrationFile:
+					for statement in splitStatements(migrationFile.read()):
+						con.execute(statement)
+				con.execute("PRAGMA user_version = " + str(version))
+				con.execute("COMMIT")
+				print("Applied migration " + path.basename(filePath))
+			except:
+				con.execute("ROLLBACK")
+				raise
+
+		return con.execute("PRAGMA user_version").fetchone()[0]
+	finally:
+		con.close()
+
+# A .py migration has an upgrade(con) function. Unlike a .sql migration it isn't run inside one big transaction - it
+# starts and commits its own, so it can work through a big table in small chunks without locking the database for the
+# whole time. That means it can be stopped halfway (or run by two processes at once), so it has to be safe to run
+# again from the start. The version is only bumped once upgrade has finished.
+def runPythonMigration(con, version, filePath):
+	if con.execute("PRAGMA user_version").fetchone()[0] >= version:
+		return
+
+	spec = spec_from_file_location("migration_" + str(version), filePath)
+	migration = module_from_spec(spec)
+	spec.loader.exec_module(migration)
+	migration.upgrade(con)
+
+	con.execute("BEGIN IMMEDIATE")
+	if con.execute("PRAGMA user_version").fetchone()[0] < version:
+		con.execute("PRAGMA user_version = " + str(version))
+		print("Applied migration " + path.basename(filePath))
+	con.execute("COMMIT")
+
+# Can be run by itself to upgrade a live database: python database/migrate.py [path to db]
+if __name__ == "__main__":
+	dbPath = argv[1] if len(argv) > 1 else "./database/database.db"
+	print("Database is at version " + str(migrate(dbPath)))
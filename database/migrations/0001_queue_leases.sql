@@ -0,0 +1,4 @@
+-- Queue rows are leased to the scraper worker that claims them, so several workers can share the queue without
+-- scraping the same package twice. A row whose lease has run out (because its worker died) can be claimed again.
+ALTER TABLE 'queue' ADD COLUMN 'claimed_by' TEXT(32) DEFAULT NULL;
+ALTER TABLE 'queue' ADD COLUMN 'lease_expires' INTEGER(15) NOT NULL  DEFAULT 0;
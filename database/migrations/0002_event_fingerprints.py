@@ -0,0 +1,44 @@
+from hashlib import sha1
+
+# Every event gets a fingerprint (see fingerprintEvent in packages.py), and each package can only have one event with
+# the same fingerprint, so a scrape only has to insert the events that are new. Existing events are fingerprinted
+# CHUNK_SIZE at a time, each chunk in its own short transaction. The old scraper could store the same event twice, so
+# the copies are removed (keeping the first one) before the unique index goes on.
+CHUNK_SIZE = 1000
+
+def columnNames(con, table):
+	return [row[1] for row in con.execute("PRAGMA table_info('" + table + "')")]
+
+# Runs the passed statements in a single transaction
+def runInTransaction(con, statements):
+	con.execute("BEGIN IMMEDIATE")
+	try:
+		for statement, parameters in statements:
+			con.execute(statement, parameters)
+		con.execute("COMMIT")
+	except:
+		con.execute("ROLLBACK")
+		raise
+
+# The same as fingerprintEvent in packages.py. It is copied here so this migration keeps doing exactly what it does now,
+# whatever happens to packages.py later.
+def fingerprintEvent(date, eventTime, data):
+	return sha1("\x1f".join([date, eventTime, data]).encode("utf-8")).hexdigest()
+
+def upgrade(con):
+	if "fingerprint" not in columnNames(con, "package_data"):
+		runInTransaction(con, [("ALTER TABLE 'package_data' ADD COLUMN 'fingerprint' TEXT(40) NOT NULL  DEFAULT ''", [])])
+
+	# Rows that already have a fingerprint are skipped, which covers chunks done by an earlier run that was stopped
+	lastID = 0
+	while True:
+		rows = con.execute("SELECT id, date, time, data FROM package_data WHERE id > ? AND fingerprint = '' ORDER BY id LIMIT ?", [lastID, CHUNK_SIZE]).fetchall()
+		if not rows:
+			break
+		runInTransaction(con, [("UPDATE package_data SET fingerprint = ? WHERE id = ?", [fingerprintEvent(date, eventTime, data), eventID]) for eventID, date, eventTime, data in rows])
+		lastID = rows[-1][0]
+
+	runInTransaction(con, [
+		("DELETE FROM package_data WHERE id NOT IN (SELECT MIN(id) FROM package_data GROUP BY package_id, fingerprint)", []),
+		("CREATE UNIQUE INDEX IF NOT EXISTS 'package_data_fingerprint' ON 'package_data' ('package_id', 'fingerprint')", []),
+	])
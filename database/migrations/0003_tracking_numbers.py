@@ -0,0 +1,100 @@
+# Tracking numbers get a table of their own, and the events (package_data) and the queue are keyed on the tracking number
+# instead of on each user's package. A number is then scraped once and its events stored once, however many users track
+# it. Numbers are normalised (no whitespace, upper case) so "1z 999" and "1Z999" end up as the same number.
+# Existing data is moved across:
+# - every distinct normalised number in packages becomes a tracking number, last updated when its newest package was
+# - packages point at their number (and drop their own last_updated)
+# - each number's events are the events of all of its packages, with the copies of the same event merged into one
+# - each number is queued once if any of its packages was queued, at the highest priority any of them had
+# Events and queue rows of packages that no longer exist are dropped.
+# Every table is rebuilt in a single transaction, so this either happens completely or not at all. SQLite can't add a
+# NOT NULL column without a default or change a column's foreign key in place, so the tables have to be rebuilt.
+
+def tableNames(con):
+	return [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+
+# The same as normaliseTrackingNumber in packages.py, copied so this migration doesn't change if that does
+def normaliseTrackingNumber(trackingNumber):
+	return "".join(trackingNumber.split()).upper()
+
+# Rebuilding a table with AUTOINCREMENT starts its sequence again from the biggest id that was copied across. This puts
+# back the old sequence, so the ids of deleted rows (like packages in old reminder emails) are never handed out again.
+def restoreSequence(con, table, sequence):
+	if sequence is None:
+		return
+	if con.execute("SELECT 1 FROM sqlite_sequence WHERE name = ?", [table]).fetchone():
+		con.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", [sequence, table])
+	else:
+		con.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", [table, sequence])
+
+def upgrade(con):
+	if "tracking_numbers" in tableNames(con):
+		return
+
+	con.execute("BEGIN IMMEDIATE")
+	try:
+		sequences = {name: seq for name, seq in con.execute("SELECT name, seq FROM sqlite_sequence WHERE name IN ('packages', 'package_data')")}
+
+		con.execute("""CREATE TABLE 'tracking_numbers' (
+'id' INTEGER NOT NULL  PRIMARY KEY AUTOINCREMENT,
+'number' TEXT NOT NULL ,
+'last_updated' INTEGER(15) NOT NULL  DEFAULT 0
+)""")
+		con.execute("CREATE UNIQUE INDEX 'tracking_numbers_number' ON 'tracking_numbers' ('number')")
+
+		# Which number each package tracks. The normalising is done here because SQL can't split on any whitespace.
+		con.execute("CREATE TEMP TABLE 'package_numbers' ('package_id' INTEGER NOT NULL  PRIMARY KEY, 'number' TEXT NOT NULL )")
+		con.executemany("INSERT INTO package_numbers (package_id, number) VALUES (?, ?)", [(packageID, normaliseTrackingNumber(trackingNumber)) for packageID, trackingNumber in con.execute("SELECT id, trackingNumber FROM packages").fetchall()])
+		con.execute("INSERT INTO tracking_numbers (number, last_updated) SELECT package_numbers.number, MAX(packages.last_updated) FROM package_numbers INNER JOIN packages ON packages.id = package_numbers.package_id GROUP BY package_numbers.number ORDER BY MIN(packages.id)")
+		# From here on package_numbers also has the id of the number, so the other tables can be joined straight onto it
+		con.execute("ALTER TABLE package_numbers ADD COLUMN 'tracking_number_id' INTEGER")
+		con.execute("UPDATE package_numbers SET tracking_number_id = (SELECT id FROM tracking_numbers WHERE tracking_numbers.number = package_numbers.number)")
+
+		con.execute("""CREATE TABLE 'packages_new' (
+'id' INTEGER NOT NULL  PRIMARY KEY AUTOINCREMENT,
+'title' TEXT(50) DEFAULT NULL,
+'trackingNumber' TEXT NOT NULL ,
+'tracking_number_id' INTEGER NOT NULL  REFERENCES 'tracking_numbers' ('id'),
+'user_id' INTEGER NOT NULL  REFERENCES 'users' ('id'),
+'last_new_data' INTEGER(15) NOT NULL ,
+'email_sent' INTEGER(1) NOT NULL  DEFAULT 0
+)""")
+		con.execute("INSERT INTO packages_new (id, title, trackingNumber, tracking_number_id, user_id, last_new_data, email_sent) SELECT packages.id, packages.title, package_numbers.number, package_numbers.tracking_number_id, packages.user_id, packages.last_new_data, packages.email_sent FROM packages INNER JOIN package_numbers ON package_numbers.package_id = packages.id ORDER BY packages.id")
+
+		con.execute("""CREATE TABLE 'queue_new' (
+'id' INTEGER NOT NULL  PRIMARY KEY AUTOINCREMENT,
+'tracking_number_id' INTEGER NOT NULL  REFERENCES 'tracking_numbers' ('id'),
+'priority' INTEGER(1) NOT NULL  DEFAULT 0,
+'claimed_by' TEXT(32) DEFAULT NULL,
+'lease_expires' INTEGER(15) NOT NULL  DEFAULT 0
+)""")
+		# Any leases are dropped, the workers are stopped while the database is upgraded
+		con.execute("INSERT INTO queue_new (tracking_number_id, priority) SELECT package_numbers.tracking_number_id, MAX(queue.priority) FROM queue INNER JOIN package_numbers ON package_numbers.package_id = queue.package_id GROUP BY package_numbers.tracking_number_id ORDER BY MIN(queue.id)")
+
+		con.execute("""CREATE TABLE 'package_data_new' (
+'id' INTEGER NOT NULL  PRIMARY KEY AUTOINCREMENT,
+'tracking_number_id' INTEGER NOT NULL  REFERENCES 'tracking_numbers' ('id'),
+'date' TEXT(12) NOT NULL ,
+'time' TEXT(8) NOT NULL ,
+'data' TEXT NOT NULL ,
+'fingerprint' TEXT(40) NOT NULL
+)""")
+		# Packages tracking the same number have copies of the same events. The copy with the smallest id is kept (sqlite
+		# takes the other columns from the row that MIN picked), so the events stay in the order they were inserted.
+		con.execute("INSERT INTO package_data_new (id, tracking_number_id, date, time, data, fingerprint) SELECT MIN(package_data.id), package_numbers.tracking_number_id, package_data.date, package_data.time, package_data.data, package_data.fingerprint FROM package_data INNER JOIN package_numbers ON package_numbers.package_id = package_data.package_id GROUP BY package_numbers.tracking_number_id, package_data.fingerprint ORDER BY MIN(package_data.id)")
+
+		for table in ["packages", "queue", "package_data"]:
+			con.execute("DROP TABLE '" + table + "'")
+			con.execute("ALTER TABLE '" + table + "_new' RENAME TO '" + table + "'")
+		for table, sequence in sequences.items():
+			restoreSequence(con, table, sequence)
+		con.execute("DROP TABLE package_numbers")
+
+		con.execute("CREATE UNIQUE INDEX 'queue_tracking_number' ON 'queue' ('tracking_number_id')")
+		con.execute("CREATE UNIQUE INDEX 'package_data_fingerprint' ON 'package_data' ('tracking_number_id', 'fingerprint')")
+		# Finding the packages that track a number is needed straight away by the next migration. 0005 makes it as well.
+		con.execute("CREATE INDEX 'packages_tracking_number_id' ON 'packages' ('tracking_number_id')")
+		con.execute("COMMIT")
+	except:
+		con.execute("ROLLBACK")
+		raise
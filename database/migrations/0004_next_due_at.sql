@@ -0,0 +1,9 @@
+-- Every tracking number is scraped again at its own next_due_at, which is worked out after each scrape from how
+-- recently it got new data (see calculateNextRefresh). Numbers that are already stored take the newest last_new_data
+-- of their packages, and are due straight away so they are all rescheduled by their next scrape.
+ALTER TABLE 'tracking_numbers' ADD COLUMN 'last_new_data' INTEGER(15) NOT NULL  DEFAULT 0;
+ALTER TABLE 'tracking_numbers' ADD COLUMN 'next_due_at' INTEGER(15) DEFAULT 0;
+
+UPDATE 'tracking_numbers' SET 'last_new_data' = COALESCE((SELECT MAX(last_new_data) FROM packages WHERE packages.tracking_number_id = tracking_numbers.id), 0);
+
+CREATE INDEX 'tracking_numbers_next_due_at' ON 'tracking_numbers' ('next_due_at');
@@ -0,0 +1,17 @@
+-- Every hot lookup had to scan its whole table. These indexes cover the queries in packages.py and auth.py.
+CREATE INDEX IF NOT EXISTS 'users_email' ON 'users' ('email');
+
+CREATE INDEX IF NOT EXISTS 'packages_user_id' ON 'packages' ('user_id');
+CREATE INDEX IF NOT EXISTS 'packages_user_tracking_number' ON 'packages' ('user_id', 'trackingNumber');
+CREATE INDEX IF NOT EXISTS 'packages_tracking_number_id' ON 'packages' ('tracking_number_id');
+CREATE INDEX IF NOT EXISTS 'packages_last_new_data' ON 'packages' ('last_new_data');
+
+CREATE INDEX IF NOT EXISTS 'queue_lease_expires' ON 'queue' ('lease_expires');
+CREATE INDEX IF NOT EXISTS 'queue_claimed_by' ON 'queue' ('claimed_by');
+
+CREATE INDEX IF NOT EXISTS 'pending_users_verification_token' ON 'pending_users' ('verification_token');
+CREATE INDEX IF NOT EXISTS 'pending_users_email' ON 'pending_users' ('email');
+CREATE INDEX IF NOT EXISTS 'pending_users_time_created' ON 'pending_users' ('time_created');
+
+CREATE INDEX IF NOT EXISTS 'password_resets_token' ON 'password_resets' ('token');
+CREATE INDEX IF NOT EXISTS 'password_resets_time_created' ON 'password_resets' ('time_created');
@@ -0,0 +1,15 @@
+-- Emails are queued here and sent by a background sender instead of during the request
+CREATE TABLE 'email_outbox' (
+'id' INTEGER NOT NULL  PRIMARY KEY AUTOINCREMENT,
+'recipient' TEXT(254) NOT NULL ,
+'subject' TEXT NOT NULL ,
+'template' TEXT NOT NULL ,
+'context' TEXT NOT NULL ,
+'status' TEXT(7) NOT NULL  DEFAULT 'pending',
+'attempts' INTEGER NOT NULL  DEFAULT 0,
+'next_attempt_at' INTEGER(15) NOT NULL  DEFAULT 0,
+'last_error' TEXT DEFAULT NULL,
+'time_created' INTEGER(15) NOT NULL 
+);
+
+CREATE INDEX 'email_outbox_pending' ON 'email_outbox' ('status', 'next_attempt_at');
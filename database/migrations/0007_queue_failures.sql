@@ -0,0 +1,4 @@
+-- Scrapes that fail are retried with a backoff, and numbers that keep failing are moved to a dead letter state
+ALTER TABLE 'queue' ADD COLUMN 'attempts' INTEGER NOT NULL  DEFAULT 0;
+ALTER TABLE 'queue' ADD COLUMN 'last_error' TEXT DEFAULT NULL;
+ALTER TABLE 'queue' ADD COLUMN 'dead' INTEGER(1) NOT NULL  DEFAULT 0;
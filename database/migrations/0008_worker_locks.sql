@@ -0,0 +1,9 @@
+-- Lock rows that worker processes hold with a lease. Only the worker holding the 'scheduler' lock runs the scheduled
+-- jobs and sends emails, so running several workers doesn't run every job several times.
+CREATE TABLE 'worker_locks' (
+'name' TEXT NOT NULL  PRIMARY KEY,
+'holder' TEXT(32) DEFAULT NULL,
+'lease_expires' INTEGER(15) NOT NULL  DEFAULT 0
+);
+
+INSERT INTO 'worker_locks' ('name') VALUES ('scheduler');
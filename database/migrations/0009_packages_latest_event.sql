@@ -0,0 +1,8 @@
+-- The newest event of each package is copied onto the package, so the package list can show the status of every
+-- package without reading package_data. The scraper keeps these up to date.
+ALTER TABLE 'packages' ADD COLUMN 'latest_event' TEXT DEFAULT NULL;
+ALTER TABLE 'packages' ADD COLUMN 'latest_event_time' TEXT DEFAULT NULL;
+
+UPDATE 'packages' SET
+'latest_event' = (SELECT data FROM package_data WHERE package_data.tracking_number_id = packages.tracking_number_id ORDER BY package_data.id DESC LIMIT 1),
+'latest_event_time' = (SELECT date || ' ' || time FROM package_data WHERE package_data.tracking_number_id = packages.tracking_number_id ORDER BY package_data.id DESC LIMIT 1);
@@ -0,0 +1,69 @@
+from calendar import timegm
+from time import strptime
+
+# Events get an event_ts column (the time of the event as an epoch integer) and a has_time flag, so they can be sorted
+# and range queried in SQL instead of relying on the order they were inserted in. The newest event copied onto each
+# package gets the same treatment. Existing rows are converted CHUNK_SIZE at a time, each chunk in its own short
+# transaction, so this can run against a big live database without holding the write lock for long.
+# The old date and time text columns are left where they are (dropping them would rewrite the whole table in one go).
+# They are still written for new events, because the event fingerprints are made from them.
+CHUNK_SIZE = 1000
+
+def columnNames(con, table):
+	return [row[1] for row in con.execute("PRAGMA table_info('" + table + "')")]
+
+# Runs the passed statements in a single transaction
+def runInTransaction(con, statements):
+	con.execute("BEGIN IMMEDIATE")
+	try:
+		for statement, parameters in statements:
+			con.execute(statement, parameters)
+		con.execute("COMMIT")
+	except:
+		con.execute("ROLLBACK")
+		raise
+
+# Events used to be stored as "Mon 05 Jul 2021" and "03:12 PM". Date only events were stored with a time of 12:00 AM,
+# so that is the only way to tell them apart. A real event at exactly midnight will end up as date only.
+def convertEvent(date, eventTime):
+	parsedTime = strptime(date + " " + eventTime, "%a %d %b %Y %I:%M %p")
+	return timegm(parsedTime), 0 if eventTime == "12:00 AM" else 1
+
+def upgrade(con):
+	# Adding a column is instant in sqlite, it doesn't touch the existing rows
+	if "event_ts" not in columnNames(con, "package_data"):
+		runInTransaction(con, [
+			("ALTER TABLE 'package_data' ADD COLUMN 'event_ts' INTEGER(15) DEFAULT NULL", []),
+			("ALTER TABLE 'package_data' ADD COLUMN 'has_time' INTEGER(1) NOT NULL  DEFAULT 1", []),
+		])
+	if "latest_event_ts" not in columnNames(con, "packages"):
+		runInTransaction(con, [
+			("ALTER TABLE 'packages' ADD COLUMN 'latest_event_ts' INTEGER(15) DEFAULT NULL", []),
+			("ALTER TABLE 'packages' ADD COLUMN 'latest_event_has_time' INTEGER(1) DEFAULT NULL", []),
+		])
+
+	# Convert the events in chunks, walking through them by ID. Rows that already have an event_ts are skipped, which
+	# covers new events written since this started and chunks done by an earlier run that was stopped.
+	lastID = 0
+	while True:
+		rows = con.execute("SELECT id, date, time FROM package_data WHERE id > ? AND event_ts IS NULL ORDER BY id LIMIT ?", [lastID, CHUNK_SIZE]).fetchall()
+		if not rows:
+			break
+		runInTransaction(con, [("UPDATE package_data SET event_ts = ?, has_time = ? WHERE id = ? AND event_ts IS NULL", list(convertEvent(date, eventTime)) + [eventID]) for eventID, date, eventTime in rows])
+		lastID = rows[-1][0]
+
+	# Sorting a number's events by time (the only way they are ever read) comes straight out of this index
+	runInTransaction(con, [("CREATE INDEX IF NOT EXISTS 'package_data_event_ts' ON 'package_data' ('tracking_number_id', 'event_ts')", [])])
+
+	# Then copy the newest event onto the packages again, also in chunks
+	lastID = 0
+	while True:
+		rows = con.execute("SELECT id FROM packages WHERE id > ? ORDER BY id LIMIT ?", [lastID, CHUNK_SIZE]).fetchall()
+		if not rows:
+			break
+		runInTransaction(con, [("UPDATE packages SET latest_event = (SELECT data FROM package_data WHERE package_data.tracking_number_id = packages.tracking_number_id ORDER BY event_ts DESC, id DESC LIMIT 1), latest_event_ts = (SELECT event_ts FROM package_data WHERE package_data.tracking_number_id = packages.tracking_number_id ORDER BY event_ts DESC, id DESC LIMIT 1), latest_event_has_time = (SELECT has_time FROM package_data WHERE package_data.tracking_number_id = packages.tracking_number_id ORDER BY event_ts DESC, id DESC LIMIT 1) WHERE id >= ? AND id <= ?", [rows[0][0], rows[-1][0]])])
+		lastID = rows[-1][0]
+
+	# The packages table is small compared to package_data, so the old text copy of the time can just be dropped
+	if "latest_event_time" in columnNames(con, "packages"):
+		runInTransaction(con, [("ALTER TABLE 'packages' DROP COLUMN 'latest_event_time'", [])])
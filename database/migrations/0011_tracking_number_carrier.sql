@@ -0,0 +1,3 @@
+-- The carrier each tracking number belongs to, worked out from its format by carriers.py. Numbers that are already
+-- stored get theirs the next time they are scraped.
+ALTER TABLE 'tracking_numbers' ADD COLUMN 'carrier' TEXT DEFAULT NULL;
@@ -0,0 +1,9 @@
+-- A row is added every time a scrape changes a tracking number's events. The website processes watch this table to
+-- tell browsers about the update straight away, and the worker clears out rows that are a few minutes old.
+CREATE TABLE 'package_updates' (
+'id' INTEGER NOT NULL  PRIMARY KEY AUTOINCREMENT,
+'tracking_number_id' INTEGER NOT NULL  REFERENCES 'tracking_numbers' ('id'),
+'time_created' INTEGER(15) NOT NULL
+);
+
+CREATE INDEX 'package_updates_time_created' ON 'package_updates' ('time_created');
@@ -0,0 +1,6 @@
+-- When each number was added to the queue, so the metrics can show how long the oldest one has been waiting. Numbers
+-- that are already queued are counted from now.
+ALTER TABLE 'queue' ADD COLUMN 'queued_at' INTEGER(15) NOT NULL  DEFAULT 0;
+UPDATE 'queue' SET 'queued_at' = CAST(strftime('%s', 'now') AS INTEGER);
+
+CREATE INDEX 'queue_dead_queued_at' ON 'queue' ('dead', 'queued_at');
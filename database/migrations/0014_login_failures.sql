@@ -0,0 +1,12 @@
+-- Failed logins, counted by AttemptLimiter. They used to be kept in each website process's memory, so every process
+-- had its own count and an attacker got the limit once per process. kind is the limiter ('email' or 'ip') and key is
+-- the address it counts. The worker clears out failures that are older than the login window.
+CREATE TABLE 'login_failures' (
+'id' INTEGER NOT NULL  PRIMARY KEY AUTOINCREMENT,
+'kind' TEXT NOT NULL ,
+'key' TEXT NOT NULL ,
+'time_created' INTEGER(15) NOT NULL
+);
+
+CREATE INDEX 'login_failures_kind_key' ON 'login_failures' ('kind', 'key', 'time_created');
+CREATE INDEX 'login_failures_time_created' ON 'login_failures' ('time_created');
@@ -1,5 +1,8 @@
 from os import environ
 from ssl import create_default_context
+from json import dumps, loads
+from threading import Thread, Event
+from time import time
 
 import smtplib
 from email.mime.text import MIMEText
@@ -7,36 +10,124 @@ from email.mime.multipart import MIMEMultipart
 
 from jinja2 import Environment, FileSystemLoader
 
+from connections import createDBConnection
+from metrics import EMAIL_SEND_DURATION, EMAILS
+
 class EmailHandler:
-	# When the class is initiated it will create a connection to google's smtp server
-	def __init__(self):
+	# How many emails are sent from the outbox at once, and how many times a failing email is retried before giving up
+	BATCH_SIZE = 20
+	MAX_ATTEMPTS = 5
+	# A failed email waits RETRY_DELAY * 2^attempts seconds before it is tried again
+	RETRY_DELAY = 30
+
+	# Emails are not sent straight away. They are put in the outbox table, and a background sender sends them over
+	# a single connection to the email server. The server details can be changed so a local test server can be used.
+	# The sender only runs in the worker process (see startSender), the web process just queues emails.
+	def __init__(self, connections):
 		# Constants - makes it easier to modify them if they are up here
 		self.emailAddress = environ["EMAIL_ADDRESS"]
 		self.hostname = "http://127.0.0.1:5000"
+		self.smtpHost = environ.get("SMTP_HOST", "smtp.gmail.com")
+		self.smtpPort = int(environ.get("SMTP_PORT", 465))
+		self.smtpSSL = environ.get("SMTP_SSL", "1") == "1"
 
-		# Connect to email server
-		self.sslContext = create_default_context()
-		self.emailServer = smtplib.SMTP_SSL("smtp.gmail.com", 465, context=self.sslContext)
-		self.emailServer.login(self.emailAddress, environ["EMAIL_PASSWORD"])
+		self.connections = connections
+		self.emailServer = None # Connected the first time something needs sending
 
 		# Use jinja environment to pass variables to email templates
 		self.jinjaEnv = Environment(loader=FileSystemLoader("templates/emails"))
 
+		self.sender = None
+
 	def __del__(self):
-		self.emailServer.close()
+		self.stopSender()
+		self.disconnect()
+
+	# Starts sending everything in the outbox in the background. canSend is checked before every batch, so that only
+	# one process sends emails when there are several of them.
+	def startSender(self, canSend=lambda: True):
+		self.sender = OutboxSender(self, canSend)
+		self.sender.start()
+
+	def stopSender(self):
+		if self.sender is not None:
+			self.sender.stop()
+			self.sender = None
+
+	@property
+	def con(self):
+		return self.connections.getConnection()
 
 	# Sends an html email to the passed address asking them to click a link which wil verify their account
 	def sendVerificationEmail(self, recipient, token):
-		html = self.jinjaEnv.get_template("verifyEmail.html").render(hostname=self.hostname, token=token)
-		self.sendMail(recipient, "Account verification", html)
+		self.queueMail(recipient, "Account verification", "verifyEmail.html", {"token": token})
 
 	def sendPasswordResetEmail(self, recipient, token):
-		html = self.jinjaEnv.get_template("resetPassword.html").render(hostname=self.hostname, token=token)
-		self.sendMail(recipient, "Password reset request", html)
+		self.queueMail(recipient, "Password reset request", "resetPassword.html", {"token": token})
+
+	# Tells the user that their packages will soon be deleted. packages is a list of dicts with the id and title of each package.
+	def sendPackageReminderEmail(self, recipient, packages):
+		self.queueMail(recipient, "Outdated package" if len(packages) == 1 else "Outdated packages", "packageReminder.html", {"packages": packages})
+
+	# Puts an email in the outbox. The template is rendered by the sender, so none of the work happens on the request.
+	# This uses the calling thread's connection, so the email is only queued if the caller's transaction commits.
+	@createDBConnection
+	def queueMail(self, recipient, subject, template, context):
+		cur = self.con.cursor()
+		cur.execute("INSERT INTO email_outbox (recipient, subject, template, context, time_created) VALUES (?, ?, ?, ?, ?)", [recipient, subject, template, dumps(context), time()])
+		cur.close()
+		# If the sender is in another process it will find the email the next time it checks the outbox
+		if self.sender is not None:
+			self.sender.wake()
+
+	# Sends the next batch of emails in the outbox. Emails that fail are retried later with an exponential backoff, and
+	# are marked as failed once they have used up all of their attempts. Returns how many emails were in the batch.
+	@createDBConnection
+	def sendQueuedEmails(self):
+		cur = self.con.cursor()
+		cur.execute("SELECT id, recipient, subject, template, context, attempts FROM email_outbox WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at, id LIMIT ?", [time(), self.BATCH_SIZE])
+		batch = cur.fetchall()
+
+		for emailID, recipient, subject, template, context, attempts in batch:
+			try:
+				html = self.jinjaEnv.get_template(template).render(hostname=self.hostname, **loads(context))
+				self.sendMail(recipient, subject, html)
+				cur.execute("DELETE FROM email_outbox WHERE id = ?", [emailID])
+				EMAILS.inc("sent")
+			except Exception as e:
+				EMAILS.inc("failed")
+				attempts += 1
+				status = "failed" if attempts >= self.MAX_ATTEMPTS else "pending"
+				cur.execute("UPDATE email_outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?", [status, attempts, time() + self.RETRY_DELAY * 2 ** attempts, repr(e), emailID])
+				# Whatever went wrong might have left the connection in a bad state, so start fresh next time
+				self.disconnect()
 
-	def sendPackageReminderEmail(self, recipient, packageTitle, packageID):
-		html = self.jinjaEnv.get_template("packageReminder.html").render(hostname=self.hostname, packageID=packageID, packageTitle=packageTitle)
-		self.sendMail(recipient, "Outdated package", html)
+			# Commit after every email so that a crash halfway through a batch doesn't send the same emails twice
+			self.con.commit()
+
+		cur.close()
+		return len(batch)
+
+	# Returns the connection to the email server, connecting (and logging in) first if we aren't connected
+	def getServer(self):
+		if self.emailServer is None:
+			if self.smtpSSL:
+				server = smtplib.SMTP_SSL(self.smtpHost, self.smtpPort, context=create_default_context(), timeout=30)
+			else:
+				server = smtplib.SMTP(self.smtpHost, self.smtpPort, timeout=30)
+			# Local test servers don't need a login
+			if environ.get("EMAIL_PASSWORD"):
+				server.login(self.emailAddress, environ["EMAIL_PASSWORD"])
+			self.emailServer = server
+		return self.emailServer
+
+	def disconnect(self):
+		if self.emailServer is not None:
+			try:
+				self.emailServer.quit()
+			except (smtplib.SMTPException, OSError):
+				pass # It was probably already gone
+			self.emailServer = None
 
 	# This will send the actual mail to someone
 	def sendMail(self, recipient, subject, body):
@@ -46,5 +137,44 @@ class EmailHandler:
 		message["From"] = self.emailAddress
 		message["To"] = recipient
 		# Add the content and send it
-		message.attach(MIMEText(body, "html"))
-		self.emailServer.sendmail(self.emailAddress, recipient, message.as_string())
\ No newline at end of file
+		message.attach(MIMEText(body, "html", "utf-8")) # utf-8 means base64, which keeps the lines short enough for SMTP
+
+		# Timed including any reconnecting, since that is part of what a slow mail server costs us
+		with EMAIL_SEND_DURATION.time():
+			try:
+				self.getServer().sendmail(self.emailAddress, recipient, message.as_string())
+			except smtplib.SMTPServerDisconnected:
+				# The server closes connections that have been idle for a while, so reconnect and try once more
+				self.disconnect()
+				self.getServer().sendmail(self.emailAddress, recipient, message.as_string())
+
+# Runs on its own thread and keeps sending emails from the outbox. It sleeps when the outbox is empty and is woken
+# up when a new email is queued in the same process.
+class OutboxSender(Thread):
+	def __init__(self, emailHandler, canSend, pollInterval=5):
+		super().__init__(daemon=True)
+		self.emailHandler = emailHandler
+		self.canSend = canSend
+		self.pollInterval = pollInterval
+		self.wakeEvent = Event()
+		self.stopped = False
+
+	def run(self):
+		while not self.stopped:
+			try:
+				sent = self.emailHandler.sendQueuedEmails() if self.canSend() else 0
+			except Exception as e:
+				print("Email sender failed: " + repr(e))
+				sent = 0
+
+			# If the whole batch was used up then there is probably more waiting, so go straight round again
+			if sent < self.emailHandler.BATCH_SIZE:
+				self.wakeEvent.wait(self.pollInterval)
+				self.wakeEvent.clear()
+
+	def wake(self):
+		self.wakeEvent.set()
+
+	def stop(self):
+		self.stopped = True
+		self.wakeEvent.set()
@@ -0,0 +1,11 @@
+# These live on their own so that the website can use them without importing selenium (which is slow to import)
+
+# Raised by a backend when the tracking page couldn't be fetched or didn't have an events list on it
+class FetchError(Exception):
+	pass
+
+# Raised when a tracking number couldn't be scraped because of the website (or the browser), rather than because of a bug
+class ScrapeError(Exception):
+	def __init__(self, trackingNumber, cause):
+		super().__init__("Couldn't scrape " + trackingNumber + ": " + repr(cause))
+		self.trackingNumber = trackingNumber
@@ -0,0 +1,141 @@
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps, loads
+from os import path
+from random import random, uniform
+from time import sleep, strftime, strptime
+from urllib.parse import urlparse, parse_qs
+
+from parsing import extractEventsFromHTML, NO_INFORMATION_PREFIX
+
+# A stand-in for parcelsapp that serves the recorded tracking pages in fixtures/pages, so the scrapers can be run and
+# tested without touching the real website. Run it from the root of the project with python -m fixtures.fakeTrackingSite
+# and point the app at it with:
+#   TRACKER_BACKEND=http TRACKER_URL=http://127.0.0.1:8001/en/tracking/
+# It also answers like parcelsapp's tracking API, with the same events as JSON:
+#   TRACKER_BACKEND=api TRACKER_URL=http://127.0.0.1:8001/api/v3/shipments/tracking PARCELSAPP_API_KEY=anything
+# The page that is served depends on the tracking number:
+# - numbers ending in DLV get a delivered package
+# - numbers starting with NOINFO get the "no information" page
+# - numbers starting with FAIL get a 500 error
+# - everything else gets a package that is in transit
+# The API never makes the client poll more than once: the uuid it hands out is just the tracking number, and looking it
+# up is always done.
+# It can also pretend to be slow (delay, give or take jitter seconds) and flaky (failureRate of the requests get a 503).
+PAGES_DIR = path.join(path.dirname(path.abspath(__file__)), "pages")
+PATH_PREFIX = "/en/tracking/"
+API_PATH = "/api/v3/shipments/tracking"
+
+# The pages are small, so they are all read once up front
+def loadPages():
+	pages = {}
+	for name in ["inTransit", "delivered", "noInformation"]:
+		with open(path.join(PAGES_DIR, name + ".html"), encoding="utf-8") as pageFile:
+			pages[name] = pageFile.read()
+	return pages
+
+def pageNameFor(trackingNumber):
+	if trackingNumber.endswith("DLV"):
+		return "delivered"
+	if trackingNumber.startswith("NOINFO"):
+		return "noInformation"
+	return "inTransit"
+
+# The events on a page as a shipment from the API. Its "no information" event isn't a real state, so it is left out.
+def shipmentFor(trackingNumber, page):
+	states = []
+	for event in extractEventsFromHTML(page):
+		if event["data"].startswith(NO_INFORMATION_PREFIX):
+			continue
+		eventTime = strptime(event["date"] + " " + (event["time"] or "00:00"), "%d %b %Y %H:%M")
+		states.append({"date": strftime("%Y-%m-%dT%H:%M:00.000Z", eventTime), "status": event["data"], "location": ""})
+	return {"trackingId": trackingNumber, "states": states}
+
+class TrackingPageHandler(BaseHTTPRequestHandler):
+	# Keep-alive, so the HTTP backend's pooled connections actually get reused
+	protocol_version = "HTTP/1.1"
+	# The headers and the body are written separately. Without this the body waits for the client to acknowledge the
+	# headers, which adds 40ms to every request.
+	disable_nagle_algorithm = True
+	pages = {}
+	delay = 0
+	jitter = 0
+	failureRate = 0
+
+	def do_GET(self):
+		url = urlparse(self.path)
+		if url.path == API_PATH:
+			query = parse_qs(url.query)
+			if "apiKey" not in query or "uuid" not in query:
+				return self.sendJSON(400, {"error": "Missing apiKey or uuid"})
+			return self.sendShipment(query["uuid"][0])
+		if not self.path.startswith(PATH_PREFIX):
+			return self.sendPage(404, "Not found")
+
+		trackingNumber = self.path[len(PATH_PREFIX):]
+		if not self.answerLikeARealWebsite(trackingNumber):
+			return
+		self.sendPage(200, self.pages[pageNameFor(trackingNumber)].replace("{trackingNumber}", trackingNumber))
+
+	# Starts tracking the number in the body, which is answered with its uuid
+	def do_POST(self):
+		if self.path != API_PATH:
+			return self.sendPage(404, "Not found")
+		request = loads(self.rfile.read(int(self.headers["Content-Length"])))
+		if not request.get("apiKey"):
+			return self.sendJSON(401, {"error": "Missing apiKey"})
+		self.sendJSON(200, {"uuid": request["shipments"][0]["trackingId"], "done": False})
+
+	def sendShipment(self, trackingNumber):
+		if self.answerLikeARealWebsite(trackingNumber):
+			self.sendJSON(200, {"done": True, "shipments": [shipmentFor(trackingNumber, self.pages[pageNameFor(trackingNumber)])]})
+
+	# Pretend to be a real website that takes a while to answer, and sometimes falls over. Returns False if the request
+	# has already been answered with an error.
+	def answerLikeARealWebsite(self, trackingNumber):
+		if trackingNumber.startswith("FAIL"):
+			self.sendPage(500, "Internal server error")
+			return False
+		if self.delay or self.jitter:
+			sleep(max(0, self.delay + uniform(-self.jitter, self.jitter)))
+		if self.failureRate and random() < self.failureRate:
+			self.sendPage(503, "Service unavailable")
+			return False
+		return True
+
+	def sendJSON(self, status, result):
+		self.sendPage(status, dumps(result), "application/json")
+
+	def sendPage(self, status, body, contentType="text/html; charset=utf-8"):
+		body = body.encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", contentType)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	# Don't print a line for every single request
+	def log_message(self, format, *args):
+		pass
+
+# Creates the server without starting it. Call serve_forever on it (in a thread if need be) and shutdown to stop it.
+# Port 0 picks any free port, server.server_address has the one that was picked.
+def createServer(host="127.0.0.1", port=8001, delay=0, jitter=0, failureRate=0):
+	TrackingPageHandler.pages = loadPages()
+	TrackingPageHandler.delay = delay
+	TrackingPageHandler.jitter = jitter
+	TrackingPageHandler.failureRate = failureRate
+	return ThreadingHTTPServer((host, port), TrackingPageHandler)
+
+if __name__ == "__main__":
+	argParser = ArgumentParser(description="Serves recorded parcelsapp tracking pages")
+	argParser.add_argument("--host", default="127.0.0.1")
+	argParser.add_argument("--port", type=int, default=8001)
+	argParser.add_argument("--delay", type=float, default=0, help="Seconds to wait before answering each request")
+	argParser.add_argument("--jitter", type=float, default=0, help="The delay varies by up to this many seconds either way")
+	argParser.add_argument("--failure-rate", type=float, default=0, help="The fraction of requests that get a 503 error")
+	args = argParser.parse_args()
+
+	server = createServer(args.host, args.port, args.delay, args.jitter, args.failure_rate)
+	print("Serving tracking pages on http://" + args.host + ":" + str(args.port) + PATH_PREFIX)
+	server.serve_forever()
@@ -0,0 +1,36 @@
+from multiprocessing import cpu_count
+from os import environ
+
+from database.migrate import migrate
+
+# Settings for running the website with gunicorn (see wsgi.py). Every process has its own handlers, connections, package
+# data cache and update relay. Nothing is shared between them except the database, so any number of them can run.
+
+bind = environ.get("WEB_BIND", "127.0.0.1:8000")
+# Only a reverse proxy on the same machine can reach that address, so trust the X-Forwarded-For header it adds (see
+# create_app). The proxy has to set the header, otherwise every client looks like 127.0.0.1. This file is read before
+# the app is loaded, so the app sees it.
+environ.setdefault("PROXY_HOPS", "1")
+workers = int(environ.get("WEB_WORKERS", cpu_count() * 2 + 1))
+# Each open package list holds a thread while its update stream is open (see the packageUpdates route), so the
+# processes need plenty of threads for the normal requests to still get through. The thread budget of each process:
+# - UPDATE_STREAMS_PER_PROCESS threads (default half of WEB_THREADS) at most are held by update streams. Any more
+#   streams get a 503 and those pages poll for updates every 30 seconds instead.
+# - the rest (8 by default) are left for the normal requests, which are quick apart from password hashing
+#   (up to 10 seconds while the hashing processes are busy).
+# Raising WEB_THREADS raises both.
+worker_class = "gthread"
+threads = int(environ.get("WEB_THREADS", 16))
+
+# The app is built once, before the processes are forked, so its modules are only imported once. This is safe because
+# create_app doesn't open anything - each process creates its own handlers when its first request comes in.
+preload_app = True
+
+# Applies any schema changes the database doesn't have yet. This runs once in the master process, before the app is
+# loaded, so none of it is on the website's startup path.
+def on_starting(server):
+	migrate("database/database.db")
+
+# The update streams send a keepalive every 15 seconds, so they are never idle for longer than this
+timeout = 60
+keepalive = 5
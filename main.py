@@ -1,27 +1,93 @@
 from os import environ
 from dotenv import load_dotenv
+from codecs import iterdecode
 from functools import wraps
+from hmac import compare_digest
+from itertools import islice
 from json import dumps, load
+from threading import Lock
+from time import perf_counter
 
-from flask import Flask, render_template, session, flash, redirect, url_for, request
+from flask import Flask, Blueprint, Response, current_app, render_template, session, flash, redirect, url_for, request, make_response, abort, g
+from werkzeug.middleware.proxy_fix import ProxyFix
+from flask_wtf.csrf import validate_csrf
+from wtforms.validators import ValidationError
 import forms
 
-from auth import Authenticator
-from packages import PackageHandler
-from emails import EmailHandler
-
-# Will load the variables from the .env file into the environment. You will need to create your own .env file
-load_dotenv()
-
-app = Flask(__name__)
-# A key is needed for some operations. In particular, for WTForms to protect against CSRF
-app.secret_key = environ["FLASK_KEY"]
-
-emailHandler = EmailHandler()
-authenticator = Authenticator("database/database.db", emailHandler)
-packageHandler = PackageHandler("database/database.db", environ["CHROMEDRIVER_PATH"], emailHandler)
-
-@app.route('/')
+from connections import ConnectionManager
+from parsing import formatEventDate, formatEventTime, readTrackingNumbers
+from passwords import PasswordHasher, TooManyAttempts, PasswordHasherBusy
+from updates import UpdateStreamsFull
+import metrics
+
+# Creates the handlers the first time a request needs them instead of when the app starts, so the app starts quickly
+# and a request that doesn't touch the database (or emails) never waits for any of it. They are imported in here as
+# well, because importing them pulls in a lot of other modules.
+class Handlers():
+	def __init__(self, dbPath):
+		self.dbPath = dbPath
+		self.lock = Lock()
+		self.connections = None
+
+	def load(self):
+		if self.connections is None:
+			# Two requests might arrive at the same time, only one of them should create everything
+			with self.lock:
+				if self.connections is None:
+					from auth import Authenticator
+					from packages import PackageHandler
+					from emails import EmailHandler
+					from updates import UpdateBroker, UpdateRelay
+
+					# Shared by everything that talks to the database. Every thread gets its own persistent connection from it.
+					connections = ConnectionManager(self.dbPath)
+					self.emailHandler = EmailHandler(connections)
+					# Passwords are hashed in a few separate processes. PASSWORD_HASH_ROUNDS can be changed at any time,
+					# everyone's hash is upgraded to it the next time they log in.
+					self.passwordHasher = PasswordHasher(int(environ.get("PASSWORD_HASH_ROUNDS", 535000)), int(environ.get("PASSWORD_HASH_WORKERS", 2)))
+					self.authenticator = Authenticator(connections, self.emailHandler, self.passwordHasher)
+					# This process only serves the website. Scraping, the scheduled jobs and sending emails are done by
+					# worker.py, which needs to be running as well.
+					self.packageHandler = PackageHandler(connections, self.emailHandler)
+					# Tells the browsers that have the package list open when the worker scrapes one of their packages.
+					# Every stream holds a thread, so by default only half of gunicorn's threads can be used for them.
+					self.updateBroker = UpdateBroker(int(environ.get("UPDATE_STREAMS_PER_USER", 4)), maxSubscriptions=int(environ.get("UPDATE_STREAMS_PER_PROCESS", int(environ.get("WEB_THREADS", 16)) // 2)))
+					self.updateRelay = UpdateRelay(connections, self.updateBroker, self.packageHandler)
+					self.updateRelay.start()
+					# Set last, so other threads only skip the lock once everything above exists
+					self.connections = connections
+		return self
+
+# The handlers for the app that is serving the current request
+def handlers():
+	return current_app.handlers.load()
+
+# Every page of the website. They are added to the app in create_app.
+routes = Blueprint("main", __name__)
+
+# Event times are stored as timestamps and only turned into text when a page is rendered
+@routes.app_template_filter("eventDate")
+def eventDateFilter(eventTimestamp):
+	return formatEventDate(eventTimestamp)
+
+@routes.app_template_filter("eventTime")
+def eventTimeFilter(eventTimestamp, hasTime):
+	return formatEventTime(eventTimestamp, hasTime)
+
+# Every request is timed for the metrics, by the endpoint that handled it. Requests that didn't match any page (like
+# a 404) are all put together, so made up URLs can't create new series.
+@routes.before_app_request
+def startRequestTimer():
+	g.requestStart = perf_counter()
+
+@routes.after_app_request
+def recordRequestTime(response):
+	endpoint = request.endpoint or "unmatched"
+	metrics.REQUEST_DURATION.observe(perf_counter() - g.requestStart, endpoint, request.method)
+	metrics.REQUESTS.inc(endpoint, str(response.status_code))
+	return response
+
+@routes.route('/')
 def homePage():
 	return render_template("homePage.html")
 
@@ -35,14 +101,29 @@ def login_required(func):
 			return func(*args, **kwargs)
 		else:
 			flash("You need to log in to do that!", "danger")
-			return redirect(url_for("login"))
+			return redirect(url_for(".login"))
 
 	# wrapper is the new function that will be put in place of any function that uses this decorator
 	return wrapper
 
+# For the pages that are only for whoever runs the website, like the metrics. They are served to requests from the
+# server itself that didn't come through the proxy (the proxy adds X-Forwarded-For, see create_app), so a request from
+# the internet can't get in even if the proxy is on the same machine. A Prometheus on another machine can send
+# METRICS_TOKEN as a bearer token instead, if one is set. Anyone else gets a 404, as if the page wasn't there.
+def server_only(func):
+	@wraps(func)
+	def wrapper(*args, **kwargs):
+		token = environ.get("METRICS_TOKEN")
+		if token and compare_digest(request.headers.get("Authorization", ""), "Bearer " + token):
+			return func(*args, **kwargs)
+		if request.remote_addr != "127.0.0.1" or "X-Forwarded-For" in request.headers:
+			abort(404)
+		return func(*args, **kwargs)
+	return wrapper
+
 # Add an optional URL param - this will tell us that we need to redirect somewhere else after login
-@app.route("/login", methods=["GET", "POST"])
-@app.route("/login/<int:redirectToRenew>/<int:packageID>", methods=["GET", "POST"])
+@routes.route("/login", methods=["GET", "POST"])
+@routes.route("/login/<int:redirectToRenew>/<int:packageID>", methods=["GET", "POST"])
 def login(redirectToRenew=0, packageID=0):
 	# The form instance will be automatically filled with data if there is data
 	form = forms.LoginForm()
@@ -51,7 +132,14 @@ def login(redirectToRenew=0, packageID=0):
 
 		# Returns valid user ID if successfull. Since user ID's start from 1, the if statment will
 		# always evaluate to true if a user ID is returned
-		userID = authenticator.verifyLogin(form.email.data, form.password.data)
+		try:
+			userID = handlers().authenticator.verifyLogin(form.email.data, form.password.data, request.remote_addr)
+		except TooManyAttempts:
+			flash("Too many failed logins. Please wait a few minutes and try again.", "danger")
+			return redirect(url_for(".login", redirectToRenew=redirectToRenew, packageID=packageID))
+		except PasswordHasherBusy:
+			flash("We are really busy right now. Please try again in a moment.", "warning")
+			return redirect(url_for(".login", redirectToRenew=redirectToRenew, packageID=packageID))
 		if userID:
 			# If the login was successfull then we can store the user ID as we will need it later for
 			# querying all of the packages for the user. We redirect them to the list of their packages
@@ -62,28 +150,28 @@ def login(redirectToRenew=0, packageID=0):
 			print(redirectToRenew)
 			print(packageID)
 			if redirectToRenew == 1:
-				return redirect(url_for("renewPackage", packageID=packageID))
+				return redirect(url_for(".renewPackage", packageID=packageID))
 			# If they just logged in then we send them to the main page of their list
 			else:
-				return redirect(url_for("packageList"))
+				return redirect(url_for(".packageList"))
 		else:
 			flash("Incorrect username or password. Please try again.", "danger")
 			# Need to redirect them back to this page so that if they reload it,
 			# the form wont be cached and wont resubmit. Then they wont have to click that popup every time
-			return redirect(url_for("login", redirectToRenew=redirectToRenew, packageID=packageID))
+			return redirect(url_for(".login", redirectToRenew=redirectToRenew, packageID=packageID))
 	
 	return render_template("login.html", form=form)
 
 # When they log out we remove all session data
-@app.route("/logout")
+@routes.route("/logout")
 @login_required
 def logout():
 	session["userID"] = 0
 	session.clear()
 	flash("You have been logged out!", "primary")
-	return redirect(url_for("login"))
+	return redirect(url_for(".login"))
 
-@app.route("/register", methods=["GET", "POST"])
+@routes.route("/register", methods=["GET", "POST"])
 def register():
 	# The form instance will be automatically filled with data if there is data
 	form = forms.RegisterForm()
@@ -91,7 +179,12 @@ def register():
 	# Validate the form and check that it was submitted (POST request). We dont want to make a new
 	# user for a get request (not submitted).
 	if form.validate_on_submit():
-		if authenticator.createNewPendingUser(form.email.data, form.password.data):
+		try:
+			created = handlers().authenticator.createNewPendingUser(form.email.data, form.password.data)
+		except PasswordHasherBusy:
+			flash("We are really busy right now. Please try again in a moment.", "warning")
+			return redirect(url_for(".register"))
+		if created:
 			# If the user does not already exist then it was a success and we can redirect them
 			# to the next page, which will tell them that they need to verify their email address
 			return render_template("verifyYourEmail.html", email=form.email.data)
@@ -99,75 +192,131 @@ def register():
 			flash("That user already exists!", "danger")
 			# Need to redirect them back to this page so that if they reload it,
 			# the form wont be cached and wont resubmit. Then they wont have to click that popup every time
-			return redirect(url_for("register"))
+			return redirect(url_for(".register"))
 
 	# If the request was not submitted (or the user already exists) then we can just render the form normally.
 	return render_template("register.html", form=form)
 
-@app.route("/packageList", methods=["GET", "POST"])
+@routes.route("/packageList", methods=["GET", "POST"])
 @login_required
 def packageList():
 	form = forms.AddPackageForm()
 	# If the form was submitted with a POST request then the user is adding a package
 	if form.validate_on_submit():
-		if packageHandler.createNewPackage(form.trackingCode.data, session["userID"]):
+		result = handlers().packageHandler.createNewPackage(form.trackingCode.data, session["userID"])
+		if result == "added":
 			flash("Package added successfully!", "success")
 			form.trackingCode.data = ""
-		else:
+		elif result == "flagged":
+			flash("Package added, but that tracking number doesn't look right. Please check it for typos!", "warning")
+			form.trackingCode.data = ""
+		elif result == "alreadyTracked":
 			flash("You have already added that package!", "warning")
+		else:
+			flash("That isn't a valid tracking number!", "danger")
 		# Need to redirect them back to this page so that if they reload it,
 		# the form wont be cached and wont resubmit. Then they wont have to click that popup every time
-		return redirect(url_for("packageList"))
+		return redirect(url_for(".packageList"))
+
+	# If the request is just a get request, then we can just render the first page of packages. The rest are loaded by
+	# packageListPage as the user scrolls down.
+	packageListDict, before = handlers().packageHandler.getListOfPackages(session["userID"])
+	return render_template("packageList.html", form=form, packageList=packageListDict, before=before)
+
+# This endpoint is for handling ajax requests from the UI. It sends the next page of the package list as html, ready to
+# be added to the accordion, along with the before value for the page after that (null if this is the last page).
+@routes.route("/packageListPage")
+def packageListPage():
+	if "userID" not in session or "before" not in request.args:
+		return dumps({"success": False})
+
+	try:
+		before = int(request.args["before"])
+	except ValueError:
+		return dumps({"success": False})
+
+	packageListDict, before = handlers().packageHandler.getListOfPackages(session["userID"], before)
+	return dumps({"success": True, "html": render_template("includes/packageListItems.html", packageList=packageListDict), "before": before})
+
+# This endpoint adds lots of packages at once, like a list of tracking numbers pasted from an order export. The body
+# is either the numbers themselves (one per line, or a CSV with the numbers in the first column) or a file uploaded as
+# "file". The body is read a line at a time as it comes in, and nothing past the import limit is read at all.
+# The response has the result for each line (see PackageHandler.importPackages), and truncated is true if the list was
+# too long and the rest of it was left out.
+# A plain text body can be sent by a form on any website, so the request has to carry the CSRF token from one of our
+# forms, either in the X-CSRFToken header or as the "csrf_token" field of an upload.
+@routes.route("/importPackages", methods=["POST"])
+def importPackages():
+	if "userID" not in session:
+		return dumps({"success": False})
+
+	csrfToken = request.headers.get("X-CSRFToken")
+	if csrfToken is None and request.mimetype == "multipart/form-data":
+		csrfToken = request.form.get("csrf_token")
+	try:
+		validate_csrf(csrfToken)
+	except ValidationError:
+		return dumps({"success": False})
+
+	if request.mimetype == "multipart/form-data":
+		if "file" not in request.files:
+			return dumps({"success": False})
+		upload = request.files["file"].stream
+	else:
+		upload = request.stream
 
-	# If the request is just a get request, then we can just render the list of packages
-	packageListDict = packageHandler.getListOfPackages(session["userID"])
-	return render_template("packageList.html", form=form, packageList=packageListDict)
+	# utf-8-sig drops the byte order mark that spreadsheet programs like to put at the start of CSV files
+	packageHandler = handlers().packageHandler
+	lines = list(islice(readTrackingNumbers(iterdecode(upload, "utf-8-sig", "replace")), packageHandler.MAX_IMPORT_SIZE + 1))
+	truncated = len(lines) > packageHandler.MAX_IMPORT_SIZE
+	results = packageHandler.importPackages(lines[:packageHandler.MAX_IMPORT_SIZE], session["userID"])
+	return dumps({"success": True, "results": results, "truncated": truncated})
 
-# @app.route("/packageDetails/<int:packageID>")
+# @routes.route("/packageDetails/<int:packageID>")
 # @login_required
 # def viewPackage(packageID):
-# 	packageData = packageHandler.getPackageData(packageID, session["userID"])
+# 	packageData = handlers().packageHandler.getPackageData(packageID, session["userID"])
 
 # 	# Make sure that the supplied package id is in the list of packages that this user is tracking
 # 	# thr getPackageData function does this automatically for us
 # 	if not packageData:
 # 		flash("You are not tracking that package. Add it!", "primary")
-# 		return redirect(url_for("packageList"))
+# 		return redirect(url_for(".packageList"))
 
 # 	# Pass the data to the template where it will be iterated over and rendered
 # 	return render_template("packageData.html", packageData=packageData)
 
-@app.route("/confirmUserEmail/<string:token>")
+@routes.route("/confirmUserEmail/<string:token>")
 def confirmUserEmail(token):
 	# Returns false if failed, otherwise returns the ID of the new user
-	userID = authenticator.createNewUser(token)
+	userID = handlers().authenticator.createNewUser(token)
 	if not userID:
 		flash("This link is either invalid or has expired. Please re-register.", "warning")
-		return redirect(url_for("register"))
+		return redirect(url_for(".register"))
 	# If it was a success then we can log them in
 	else:
 		# We can store the user ID as we will need it later for querying all of the packages for the user.
 		# We then redirect them to the list of their packages
 		session["userID"] = userID
 		flash("Verification successful! You are now logged in.", "success")
-		return redirect(url_for("packageList"))
+		return redirect(url_for(".packageList"))
 
 # Will resend the email for a password reset or email verification.
 # The resend type specifies whether it is for a pending user or password reset.
-@app.route("/resendEmail/<int:resendType>/<string:email>")
+@routes.route("/resendEmail/<int:resendType>/<string:email>")
 def resendEmail(resendType, email):
 	# Email verification
 	if resendType == 1:
-		if not authenticator.sendEmailVerificationEmail(email):
+		if not handlers().authenticator.sendEmailVerificationEmail(email):
 			flash("Something went wrong and we couldn't resend the email. You may need to re-register.", "danger")
 		return render_template("verifyYourEmail.html", email=email)
 	# Password reset
 	elif resendType == 2:
-		if not authenticator.sendPasswordResetEmail(email):
+		if not handlers().authenticator.sendPasswordResetEmail(email):
 			flash("Something went wrong and we couldn't resend the email. You may need to redo the passwod reset.", "danger")
 		return render_template("forgotPasswordStep2.html", email=email)
 
-@app.route("/forgotPassword", methods=["GET", "POST"])
+@routes.route("/forgotPassword", methods=["GET", "POST"])
 def forgotPassword():
 	# As the form inherits from flask form, the constructor will use flasks request variable to
 	# automatically fill the form with data. If it is just a get request then nothing will happen
@@ -175,39 +324,43 @@ def forgotPassword():
 
 	# If the form is a post request (and validated) then the user is sending it to reset their password
 	if form.validate_on_submit():
-		if authenticator.createPasswordResetRequest(form.email.data):
+		if handlers().authenticator.createPasswordResetRequest(form.email.data):
 			# If it was successfull then we can show them what to do next
 			return render_template("forgotPasswordStep2.html", email=form.email.data)
 		else:
 			# If it wasn't successull, then there is one reason: the passed email does not exist
 			flash("There is no account with that email!", "danger")
-			return redirect(url_for("forgotPassword")) # Redirect so we can go to the GET side of page
+			return redirect(url_for(".forgotPassword")) # Redirect so we can go to the GET side of page
 
 	# If it was just a get request or a failed post request then we just render the form with it's errors
 	return render_template("forgotPassword.html", form=form)
 
-@app.route("/resetPassword/<string:token>", methods=["GET", "POST"])
+@routes.route("/resetPassword/<string:token>", methods=["GET", "POST"])
 def resetPassword(token):
 	# If the token is still valid then this will return user ID. Otherwise it will return false
-	userID = authenticator.verifyPasswordResetToken(token)
+	userID = handlers().authenticator.verifyPasswordResetToken(token)
 	# We cant do anything if the token isnt valid - redirect back to forgot pasword page so they can redo it
 	if not userID:
 		flash("That link is either invalid or expired. You will need to redo the reset proccess.", "danger")
-		return redirect(url_for("forgotPassword"))
+		return redirect(url_for(".forgotPassword"))
 
 	# Now that we have validated the token, we create a form. If the request is a POST then the inherited
 	# constructor will automatically fill out the form with the correct data.
 	form = forms.ResetPasswordForm()
 	# We do the logic on a POST request because that means the user has filled out the form and submitted it
 	if form.validate_on_submit():
-		authenticator.updatePassword(userID, form.password.data)
-		return redirect(url_for("login"))
+		try:
+			handlers().authenticator.updatePassword(userID, form.password.data)
+		except PasswordHasherBusy:
+			flash("We are really busy right now. Please try again in a moment.", "warning")
+			return redirect(url_for(".resetPassword", token=token))
+		return redirect(url_for(".login"))
 
 	return render_template("enterNewPassword.html", form=form)
 
 # This endpoint is for handling ajax requests from the UI.
 # the ajax request is initiated when the user wants to change the title for one of their packages.
-@app.route("/updatePackageTitle", methods=["POST"])
+@routes.route("/updatePackageTitle", methods=["POST"])
 def updatePackageTitle():
 	# If they dont have a user ID in their session then they are not logged in, which means they are
 	# manipulating the URL. HAXXXXX block them from it.
@@ -216,11 +369,11 @@ def updatePackageTitle():
 
 	# Update the package with the data. We just pass on what the updatePackage function returned.
 	# it will send back "0" if it failed or the new package title on a success.
-	return packageHandler.updatePackageTitle(request.form["packageID"], session["userID"], request.form["newTitle"])
+	return handlers().packageHandler.updatePackageTitle(request.form["packageID"], session["userID"], request.form["newTitle"])
 
 # This endpoint is for handling ajax requests from the UI.
 # the ajax request is initiated when the user wants to delete one of their packages.
-@app.route("/deletePackage", methods=["POST"])
+@routes.route("/deletePackage", methods=["POST"])
 def deletePackage():
 	# If they dont have a user ID in their session then they are not logged in, which means they are
 	# manipulating the URL. HAXXXXX block them from it.
@@ -229,35 +382,174 @@ def deletePackage():
 
 	# Request for the package to be deleted. The function will first check if the user is authorised.
 	# Returns either "0" or "1" for success and failiure. We can just pass on this value.
-	return packageHandler.deletePackage(request.form["packageID"], session["userID"])
+	return handlers().packageHandler.deletePackage(request.form["packageID"], session["userID"])
 
 # This route handles requests from users wanting to renew their packages
-@app.route("/renewPackage/<int:packageID>")
+@routes.route("/renewPackage/<int:packageID>")
 def renewPackage(packageID):
 	# If they aren't logged in then we redirect them to the login page.
 	# Specify the target so when they log in they get redirected back here
 	if "userID" not in session:
-		return redirect(url_for("login", redirectToRenew=1, packageID=packageID))
+		return redirect(url_for(".login", redirectToRenew=1, packageID=packageID))
 
-	if packageHandler.renewPackage(packageID, session["userID"]) == True:
+	if handlers().packageHandler.renewPackage(packageID, session["userID"]) == True:
 		flash("Package renewed!", "success")
 	else:
 		flash("You cannot renew that package as you do not own it!", "danger")
-	return redirect(url_for("packageList"))
+	return redirect(url_for(".packageList"))
 
 # This endpoint is for handling ajax requests from the UI.
 # the ajax request is initiated when the user wants to see the data of one of their packages.
 # Return value will be in JSON
-@app.route("/packageData", methods=["POST"])
+@routes.route("/packageData", methods=["POST"])
 def postPackageData():
 	# If they dont have a user ID in their session then they are not logged in, which means they are
 	# manipulating the URL. HAXXXXX block them from it.
 	if "userID" not in session or "packageID" not in request.form:
 		return dumps({"success": False})
 
-	packageData = packageHandler.getPackageData(request.form["packageID"], session["userID"])
-	return dumps(packageData)
+	packageData = handlers().packageHandler.getPackageData(request.form["packageID"], session["userID"])
+	if not packageData:
+		return dumps({"success": False})
+	return packageData[1]
+
+# Same as the POST version, but the response has an ETag. When the package list asks for a package it already has
+# (possibly out of date) data for, it sends the ETag back, and if nothing has changed it gets an empty 304 response
+# instead of all of the data again.
+@routes.route("/packageData", methods=["GET"])
+def getPackageData():
+	if "userID" not in session or "packageID" not in request.args:
+		return dumps({"success": False})
+
+	# The page sends the last_updated it has for the package, so cached data from an older scrape isn't sent back
+	try:
+		lastUpdated = float(request.args.get("lastUpdated", 0))
+	except ValueError:
+		return dumps({"success": False})
+
+	packageData = handlers().packageHandler.getPackageData(request.args["packageID"], session["userID"], lastUpdated)
+	if not packageData:
+		return dumps({"success": False})
+
+	etag, json = packageData
+	response = make_response(json)
+	response.mimetype = "application/json"
+	# private - only the user's own browser can keep it. no-cache - the browser has to check with us before reusing it.
+	response.headers["Cache-Control"] = "private, no-cache"
+	response.set_etag(etag)
+	return response.make_conditional(request)
+
+# This endpoint is for handling ajax requests from the UI. The package list page uses it to load the data of lots of
+# packages in one request (packageIDs is a comma separated list), so it is ready before the user opens them.
+@routes.route("/packageDataBatch", methods=["POST"])
+def packageDataBatch():
+	if "userID" not in session or "packageIDs" not in request.form:
+		return dumps({"success": False})
+
+	try:
+		packageIDs = [int(packageID) for packageID in request.form["packageIDs"].split(",") if packageID]
+	except ValueError:
+		return dumps({"success": False})
+
+	response = make_response(handlers().packageHandler.getPackageDataBatch(packageIDs, session["userID"]))
+	response.mimetype = "application/json"
+	return response
+
+# A stream of server-sent events for the package list page. Whenever the worker scrapes new data for one of the user's
+# packages, a packageUpdated event is sent with the package's ID, its new last_updated and its newest event, so the page
+# can update itself instead of the user having to reload it. A comment is sent every so often while nothing is
+# happening, so a connection to a browser that has gone away gets noticed and closed.
+UPDATE_KEEPALIVE_INTERVAL = 15
+
+@routes.route("/packageUpdates")
+def packageUpdates():
+	# 204 tells the browser to stop reconnecting
+	if "userID" not in session:
+		return "", 204
+
+	# Either way the browser gives up on the stream, and the page polls packageUpdatesSince instead
+	try:
+		subscription = handlers().updateBroker.subscribe(session["userID"])
+	except UpdateStreamsFull:
+		return "Too many update streams", 503
+	if subscription is None:
+		return "Too many open pages", 429
+
+	def stream():
+		try:
+			# How long the browser waits before reconnecting if the connection drops, in milliseconds
+			yield "retry: 5000\n\n"
+			while True:
+				update = subscription.get(UPDATE_KEEPALIVE_INTERVAL)
+				if update is None:
+					yield ": keepalive\n\n"
+				else:
+					yield "event: packageUpdated\ndata: " + dumps(update) + "\n\n"
+		# Runs when the browser disconnects
+		finally:
+			subscription.close()
+
+	response = Response(stream(), mimetype="text/event-stream")
+	response.headers["Cache-Control"] = "no-cache"
+	# Stops nginx from buffering the events
+	response.headers["X-Accel-Buffering"] = "no"
+	return response
+
+# The same updates as packageUpdates, for pages that couldn't get a stream. The page asks every so often with the after
+# value from its last response, and gets the updates since then. The first request (without after) only gets an after.
+@routes.route("/packageUpdatesSince")
+def packageUpdatesSince():
+	if "userID" not in session:
+		return dumps({"success": False})
+
+	try:
+		afterID = int(request.args["after"]) if "after" in request.args else None
+	except ValueError:
+		return dumps({"success": False})
+
+	updates, afterID = handlers().packageHandler.getPackageUpdates(session["userID"], afterID)
+	return dumps({"success": True, "updates": updates, "after": afterID})
+
+# Shows how well the package data cache is doing. Only available from the server itself.
+@routes.route("/cacheStats")
+@server_only
+def cacheStats():
+	return dumps({"packageData": handlers().packageHandler.packageDataCache.stats()})
+
+# The metrics for this process, for Prometheus to scrape. Only available from the server itself, like cacheStats.
+# The queue and cache numbers are only looked up when this is requested.
+@routes.route("/metrics")
+@server_only
+def metricsPage():
+	packageHandler = handlers().packageHandler
+	for stat, value in packageHandler.packageDataCache.stats().items():
+		metrics.PACKAGE_DATA_CACHE.set(value, stat)
+	metrics.collectQueueStats(packageHandler)
+	return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+# Builds the app. Nothing slow happens in here - the handlers are only created once the first request needs them.
+# flask run finds this by itself, or it can be used with a WSGI server. The database has to be migrated before the app
+# starts (gunicorn.conf.py does it, otherwise run database/migrate.py), the app never does it itself.
+def create_app(dbPath="database/database.db"):
+	# Will load the variables from the .env file into the environment. You will need to create your own .env file
+	load_dotenv()
+
+	app = Flask(__name__)
+	# A key is needed for some operations. In particular, for WTForms to protect against CSRF
+	app.secret_key = environ["FLASK_KEY"]
+	# Behind a reverse proxy every request seems to come from the proxy, so the client's real address is taken from
+	# the X-Forwarded-For header instead. PROXY_HOPS is how many proxies are in front of the app (gunicorn.conf.py
+	# makes it 1). It has to stay 0 without a proxy, otherwise anyone could pick their own address with the header.
+	proxyHops = int(environ.get("PROXY_HOPS", 0))
+	if proxyHops:
+		app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxyHops)
+
+	app.handlers = Handlers(dbPath)
+	app.register_blueprint(routes)
+	return app
 
 if __name__ == "__main__":
+	from database.migrate import migrate
+	migrate("database/database.db")
 	#TODO: Make sure to change this to non-debg on production
-	app.run(debug=True, use_reloader=False, host="0.0.0.0", port=5000)
\ No newline at end of file
+	create_app().run(debug=True, use_reloader=False, host="0.0.0.0", port=5000)
\ No newline at end of file
@@ -0,0 +1,178 @@
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock
+from time import time, perf_counter
+
+# Counters and histograms that the hot paths record into, shown in the Prometheus text format by the website's /metrics
+# endpoint and by the worker's metrics server (see startMetricsServer). Every process has its own set of numbers.
+# Recording something is a lock and a couple of additions, so it costs next to nothing. Anything that needs a database
+# query (like the queue depth) is only worked out by a collector when the metrics are actually asked for.
+
+# Every metric that has been created, in the order they are shown
+registeredMetrics = []
+# Functions that are called just before the metrics are shown, to fill in gauges that are expensive to keep up to date.
+# They are stored by name, so setting one up again replaces the old one.
+collectors = {}
+
+# How long things take, in seconds. Good for anything from a database query to a slow page load.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def escapeLabelValue(value):
+	return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def formatLabels(labelNames, labelValues, extra=""):
+	labels = [name + "=\"" + escapeLabelValue(value) + "\"" for name, value in zip(labelNames, labelValues)]
+	if extra:
+		labels.append(extra)
+	return "{" + ",".join(labels) + "}" if labels else ""
+
+def formatValue(value):
+	if value == float("inf"):
+		return "+Inf"
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric():
+	TYPE = None
+
+	def __init__(self, name, description, labelNames=()):
+		self.name = name
+		self.description = description
+		self.labelNames = labelNames
+		self.series = {} # Label values -> the numbers for that set of labels
+		self.lock = Lock()
+		registeredMetrics.append(self)
+
+	def render(self):
+		lines = ["# HELP " + self.name + " " + self.description, "# TYPE " + self.name + " " + self.TYPE]
+		with self.lock:
+			series = list(self.series.items())
+		for labelValues, value in series:
+			lines.extend(self.renderSeries(labelValues, value))
+		return lines
+
+	def renderSeries(self, labelValues, value):
+		return [self.name + formatLabels(self.labelNames, labelValues) + " " + formatValue(value)]
+
+# A number that only ever goes up, like how many scrapes have failed
+class Counter(Metric):
+	TYPE = "counter"
+
+	def inc(self, *labelValues, amount=1):
+		with self.lock:
+			self.series[labelValues] = self.series.get(labelValues, 0) + amount
+
+# A number that goes up and down, like how long the queue is
+class Gauge(Metric):
+	TYPE = "gauge"
+
+	def set(self, value, *labelValues):
+		with self.lock:
+			self.series[labelValues] = value
+
+# Counts how many observations fell into each bucket, along with their total. Prometheus works out the percentiles.
+class Histogram(Metric):
+	TYPE = "histogram"
+
+	def __init__(self, name, description, labelNames=(), buckets=DEFAULT_BUCKETS):
+		super().__init__(name, description, labelNames)
+		self.buckets = buckets
+
+	def observe(self, value, *labelValues):
+		# The first bucket that is at least as big as the value. Anything bigger than every bucket goes in the last slot.
+		bucketIndex = bisect_left(self.buckets, value)
+		with self.lock:
+			series = self.series.get(labelValues)
+			if series is None:
+				# A count for each bucket (plus +Inf), then the sum of every value
+				series = self.series[labelValues] = [0] * (len(self.buckets) + 1) + [0]
+			series[bucketIndex] += 1
+			series[-1] += value
+
+	# Times the code inside a with block
+	def time(self, *labelValues):
+		return Timer(self, labelValues)
+
+	def renderSeries(self, labelValues, series):
+		lines = []
+		total = 0
+		for bucket, count in zip(self.buckets + (float("inf"),), series[:-1]):
+			total += count
+			lines.append(self.name + "_bucket" + formatLabels(self.labelNames, labelValues, "le=\"" + formatValue(bucket) + "\"") + " " + str(total))
+		lines.append(self.name + "_sum" + formatLabels(self.labelNames, labelValues) + " " + formatValue(series[-1]))
+		lines.append(self.name + "_count" + formatLabels(self.labelNames, labelValues) + " " + str(total))
+		return lines
+
+class Timer():
+	def __init__(self, histogram, labelValues):
+		self.histogram = histogram
+		self.labelValues = labelValues
+
+	def __enter__(self):
+		self.start = perf_counter()
+		return self
+
+	def __exit__(self, exceptionType, exception, traceback):
+		self.histogram.observe(perf_counter() - self.start, *self.labelValues)
+
+# Fills in the queue gauges from the passed PackageHandler whenever the metrics are shown
+def collectQueueStats(packageHandler):
+	def collect():
+		stats = packageHandler.getQueueStats()
+		QUEUE_DEPTH.set(stats["waiting"])
+		QUEUE_DEAD.set(stats["dead"])
+		QUEUE_OLDEST_AGE.set(max(0, time() - stats["oldestQueuedAt"]) if stats["oldestQueuedAt"] is not None else 0)
+	collectors["queue"] = collect
+
+# Every metric, in the Prometheus text format
+def render():
+	for collector in list(collectors.values()):
+		try:
+			collector()
+		except Exception as e:
+			print("Metrics collector failed: " + repr(e))
+	lines = []
+	for metric in registeredMetrics:
+		lines.extend(metric.render())
+	return "\n".join(lines) + "\n"
+
+# The content type Prometheus expects the metrics to have
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path != "/metrics":
+			self.send_response(404)
+			self.end_headers()
+			return
+		body = render().encode("utf-8")
+		self.send_response(200)
+		self.send_header("Content-Type", CONTENT_TYPE)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	# Don't print a line every time the metrics are scraped
+	def log_message(self, format, *args):
+		pass
+
+# Serves /metrics from a background thread, for processes that don't have a website of their own (like the worker)
+def startMetricsServer(port, host="127.0.0.1"):
+	server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+	Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+# The metrics themselves. They are all made here, so every part of the app records into the same ones.
+DB_CALL_DURATION = Histogram("package_tracker_db_call_duration_seconds", "Time spent in each database function, including the commit", ("function",))
+REQUEST_DURATION = Histogram("package_tracker_request_duration_seconds", "Time taken to handle each request to the website", ("endpoint", "method"))
+REQUESTS = Counter("package_tracker_requests_total", "Requests to the website, by response status", ("endpoint", "status"))
+SCRAPE_DURATION = Histogram("package_tracker_scrape_duration_seconds", "Time taken by each stage of a scrape: loading the page, extracting the events and storing them", ("stage",))
+SCRAPES = Counter("package_tracker_scrapes_total", "Scrapes that finished, by whether they worked", ("result",))
+QUEUE_DEPTH = Gauge("package_tracker_queue_depth", "Tracking numbers waiting to be scraped, not counting dead lettered ones")
+QUEUE_DEAD = Gauge("package_tracker_queue_dead", "Tracking numbers that failed too many times and won't be scraped again")
+QUEUE_OLDEST_AGE = Gauge("package_tracker_queue_oldest_age_seconds", "How long the oldest tracking number in the queue has been waiting")
+EMAIL_SEND_DURATION = Histogram("package_tracker_email_send_duration_seconds", "Time taken to send each email over SMTP")
+EMAILS = Counter("package_tracker_emails_total", "Emails the sender tried to send, by whether they were sent", ("result",))
+JOB_DURATION = Histogram("package_tracker_job_duration_seconds", "Time taken by each run of a scheduled job", ("job",))
+JOB_ERRORS = Counter("package_tracker_job_errors_total", "Scheduled job runs that raised an exception", ("job",))
+JOB_MISFIRES = Counter("package_tracker_job_misfires_total", "Scheduled job runs that were skipped because they couldn't start on time or the last run was still going", ("job",))
+PACKAGE_DATA_CACHE = Gauge("package_tracker_package_data_cache", "The package data cache's size, hits, misses and evictions", ("stat",))
@@ -1,186 +1,386 @@
 import sqlite3
-from apscheduler.schedulers.background import BackgroundScheduler
-from time import time, strftime, strptime, gmtime
-
-# These create the browser and set the required options needed for it to function with parcelsapp
-from selenium.webdriver import Chrome
-from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
-from selenium.webdriver.chrome.options import Options
-# These are for waiting for the package data to appear
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import StaleElementReferenceException
-
-# This will be a decorator. It gets applied to class functions and modifies them so that a new database
-# connection is created before the function is called. The connection is then closed. This saves having
-# to write a new with-connect-as block every time I just want to get a cursor. Plus, decorators are cool!
-def createDBConnection(func):
-	def wrapper(self, *args, **kwargs):
-		# Make new connection and store it in the instance so it can be accessed by the passed class func
-		with sqlite3.connect(self.dbPath) as con:
-			self.con = con
-			return func(self, *args, **kwargs)
-	return wrapper
+from hashlib import sha1
+from json import dumps
+from time import time, strftime, gmtime, perf_counter
+
+from connections import createDBConnection
+from caches import LRUCache
+from errors import ScrapeError, FetchError
+from parsing import parseEvents, isDeliveredEvent, formatEventDate, formatEventTime, formatStoredEvent, NO_INFORMATION_MESSAGE
+from carriers import isPossibleTrackingNumber, detectCarrier
+from metrics import SCRAPE_DURATION, SCRAPES
+from updates import formatUpdate
+
+# Identifies a single event of a package. The same event scraped twice gets the same fingerprint.
+def fingerprintEvent(date, eventTime, data):
+	return sha1("\x1f".join([date, eventTime, data]).encode("utf-8")).hexdigest()
+
+# Turns an event row from the db into what is sent to the browser. Events that only had a date get an empty time.
+def formatEventRow(row):
+	return {"id": row["id"], "date": formatEventDate(row["event_ts"]), "time": formatEventTime(row["event_ts"], row["has_time"]), "data": row["data"]}
+
+# Removes any spaces and makes it uppercase. Tracking numbers are not case sensitive and people often copy them with spaces in them.
+def normaliseTrackingNumber(trackingNumber):
+	return "".join(trackingNumber.split()).upper()
+
+# Works out when a tracking number should next be scraped, based on what state it is in. Returns None if it never needs
+# scraping again. Numbers that are moving get scraped often, and numbers that have gone quiet get scraped less and less.
+# invalid numbers are ones that nobody seems to know about (see scrapeNextInQueue), and they are hardly ever scraped.
+def calculateNextRefresh(now, lastNewData, delivered, invalid=False):
+	# Delivered packages wont get any more updates, so there is no point polling them
+	if delivered:
+		return None
+
+	# A real number that parcelsapp hasn't heard of yet normally turns up within a day, so invalid numbers get the same
+	# treatment as everything else for their first day. After that they are most likely typos.
+	quietFor = now - lastNewData
+	if invalid and quietFor >= 86400:
+		return now + PackageHandler.INVALID_REFRESH_INTERVAL
+
+	# If there has been new data in the last day then the package is on the move
+	if quietFor < 86400:
+		return now + PackageHandler.ACTIVE_REFRESH_INTERVAL
+
+	# Otherwise back off exponentially - double the interval for every day it has been quiet, up to a limit
+	interval = PackageHandler.QUIET_REFRESH_INTERVAL * 2 ** (int(quietFor // 86400) - 1)
+	return now + min(interval, PackageHandler.MAX_REFRESH_INTERVAL)
 
 class PackageHandler():
-	# The constructor creates the schedulers
-	def __init__(self, dbPath, chromeDriverName, emailHandler):
+	# How long a scraper worker gets to finish a package before other workers are allowed to take it off them
+	LEASE_DURATION = 300
+	# A failed scrape is retried after RETRY_DELAY * 2^(attempts - 1) seconds, up to MAX_RETRY_DELAY. After
+	# MAX_SCRAPE_ATTEMPTS failures in a row the number is dead lettered and not scraped again.
+	RETRY_DELAY = 60
+	MAX_RETRY_DELAY = 21600
+	MAX_SCRAPE_ATTEMPTS = 6
+	# Refresh intervals (in seconds) used by calculateNextRefresh
+	ACTIVE_REFRESH_INTERVAL = 7200
+	QUIET_REFRESH_INTERVAL = 21600
+	MAX_REFRESH_INTERVAL = 172800
+	INVALID_REFRESH_INTERVAL = 604800
+	# How long getPackageData trusts a cached package without looking at the database at all. A scrape that changes a
+	# number's events throws its cached packages out within a second (see UpdateRelay), and changing the title or
+	# deleting a package throws it out of this process straight away. This is how long the other website processes can
+	# take to notice a title change or a deletion, and how far behind the last updated date at the top can get.
+	PACKAGE_DATA_MAX_AGE = 60
+
+	# Nothing runs in the background here. The scraper workers and the scheduled jobs are run by worker.py.
+	# packageDataCacheSize is how many packages' event lists are kept ready to send (see getPackageData).
+	def __init__(self, connections, emailHandler, packageDataCacheSize=1000):
 		self.emailHandler = emailHandler
-		self.dbPath = dbPath
-		self.con = None
-
-		self.scheduler = BackgroundScheduler()
-		self.scheduler.add_job(self.addOldPackagesToQueue, "interval", seconds=15)
-		self.scheduler.add_job(self.scrapeNextInQueue, "interval", seconds=60)
-		self.scheduler.add_job(self.checkForDeadPackages, "interval", seconds=300)
-		self.scheduler.start()
-
-		# Dont wait for full page load
-		caps = DesiredCapabilities().CHROME
-		caps["pageLoadStrategy"] = "none"
-		# This option needs to be set otherwise the automated browser will be detected by the website
-		opts = Options()
-		opts.add_argument("--disable-blink-features=AutomationControlled")
-		opts.add_argument("--headless") # Runs faster - no rendering
-		# Startup the browser
-		self.browser = Chrome(chromeDriverName, desired_capabilities=caps, chrome_options=opts)
-		self.browser.get("https://google.com")
-		#self.browser = None
-
-	# Acts like a destructor
-	def __del__(self):
-		self.scheduler.shutdown()
-		self.browser.close()
-		#pass
-
-	# Gets the top package on the queue - next in line. Proceeds to scrape the data for that package and add it to the db. Package is then removed from the queue and updated
-	# Cant use the decorator here becase the sqlite connection will be on another thread
-	def scrapeNextInQueue(self):
-		# Get the package that is next in line for being scraped
-		# Order by priority so we get new packages first
-		con = sqlite3.connect(self.dbPath)
+		self.connections = connections
+		self.packageDataCache = LRUCache(packageDataCacheSize)
+
+	# The database connection for whichever thread is running. The web requests, schedulers and scraper workers all
+	# run on different threads, and each one gets its own connection from the connection manager.
+	@property
+	def con(self):
+		return self.connections.getConnection()
+
+	# Claims the tracking number that is next in line for being scraped. The queue row is leased to the worker so no other
+	# worker will scrape the same number. If the worker dies, the lease runs out and the row can be claimed again.
+	# Returns the claimed tracking number (queue id, tracking number id and tracking number), or None if there is nothing to scrape.
+	# Numbers that failed recently are skipped until their backoff runs out, and dead lettered numbers are never claimed.
+	def claimNextInQueue(self, con, workerID):
 		cur = con.cursor()
 		cur.row_factory = sqlite3.Row # Dictionary format
-		cur.execute("SELECT queue.package_id AS id, packages.trackingNumber AS trackingNumber FROM queue INNER JOIN packages ON queue.package_id = packages.id ORDER BY queue.priority DESC, packages.id LIMIT 1")
+
+		# A single UPDATE is atomic, so even if two workers run this at the same time only one of them gets the row.
+		# Rows that nobody has claimed have a lease_expires of 0 (or the end of their backoff if they failed), so one
+		# indexed comparison finds both unclaimed rows and rows whose lease has run out. Order by priority so we get new packages first
+		now = time()
+		cur.execute("UPDATE queue SET claimed_by = ?, lease_expires = ? WHERE id = (SELECT id FROM queue WHERE lease_expires < ? AND dead = 0 ORDER BY priority DESC, tracking_number_id LIMIT 1)", [workerID, now + self.LEASE_DURATION, now])
+		con.commit()
+		if cur.rowcount == 0:
+			cur.close()
+			return None
+
+		cur.execute("SELECT queue.id AS queue_id, queue.tracking_number_id AS id, queue.attempts AS attempts, tracking_numbers.number AS trackingNumber, tracking_numbers.last_new_data AS last_new_data FROM queue INNER JOIN tracking_numbers ON queue.tracking_number_id = tracking_numbers.id WHERE queue.claimed_by = ? ORDER BY queue.lease_expires DESC LIMIT 1", [workerID])
 		package = cur.fetchone()
+		cur.close()
+		return package
 
+	# Claims the top tracking number on the queue - next in line. Proceeds to scrape the data for that number and add it to the db.
+	# The number is then removed from the queue, and every package that tracks it is updated - one scrape serves all of its watchers.
+	# Returns True if a number was scraped, or False if the queue was empty.
+	# If the page can't be fetched or read, the failure is recorded and a ScrapeError is raised.
+	@createDBConnection
+	def scrapeNextInQueue(self, backend, workerID, upstreamLimiter):
+		con = self.con
+		package = self.claimNextInQueue(con, workerID)
 		if not package:
-			return
+			return False
 
-		# Browse to the page that tracks our package
-		self.browser.get("https://parcelsapp.com/en/tracking/" + package["trackingNumber"])
-		# Wait until the data has been fetched - a <ul> element will appear on the page
-		unorderedList = WebDriverWait(self.browser, 30000, ignored_exceptions=(StaleElementReferenceException,)).until(EC.presence_of_element_located(("css selector", ".list-unstyled.events")))
-		unorderedListItems = unorderedList.find_elements_by_tag_name("li")
-
-		# Get the number of package rout data points for this package
-		cur.execute("SELECT COUNT(*) AS count FROM package_data WHERE package_id = ?", [package["id"]])
-		packageDataCount = cur.fetchone()["count"]
-		cur.execute("DELETE FROM package_data WHERE package_id = ?", [package["id"]]) # Remove all old data
-
-		for listItem in unorderedListItems:
-			# This div holds 2 child elements containing the date and time of the package stage
-			dateTimeDiv = listItem.find_element_by_css_selector("div.event-time")
-
-			# We join the date and time together in 1 string, then pass it to this time parsing function
-			# If the package number is incorrect or something, then the scraping will return something
-			# along the lines of "no package data for <<country>>". If this happens it doesn't return a time,
-			# only a date. If there is only a date then this block will catch it.
-			try:
-				parsedTime = strptime(dateTimeDiv.find_element_by_tag_name("strong").text + " " + dateTimeDiv.find_element_by_tag_name("span").text, "%d %b %Y %H:%M")
-			except ValueError:
-				parsedTime = strptime(dateTimeDiv.find_element_by_tag_name("strong").text, "%d %b %Y")
-
-			# The data is what the package stage is actually about, things like Delivered, In Transit To Local Depot, Arrive at destination country etc.
-			data = listItem.find_element_by_css_selector("div.event-content").find_element_by_tag_name("strong").text
-			if(data.startswith("No information about your package. We've checked all relevant couriers")):
-				data = "There is no tracking information for your package. Please make sure the tracking code is correct."
-
-			# Once we have all of the info we can insert it into the db
-			cur.execute("INSERT INTO package_data (package_id, date, time, data) VALUES (?, ?, ?, ?)", [package["id"], strftime("%a %d %b %Y", parsedTime), strftime("%I:%M %p", parsedTime), data])
-
-		# This package doesn't need to be updated for another 6 hours
-		# Also set the last_new_data field to the current time if the amount of new data is bigger than the amount of old data
-		cur.execute("DELETE FROM queue WHERE package_id = ?", [package["id"]])
-		cur.execute("UPDATE packages SET last_updated = ?, last_new_data = CASE WHEN ? > 0 THEN ? ELSE (SELECT last_new_data FROM packages WHERE id = ?) END WHERE id = ?", [time(), len(unorderedListItems) - packageDataCount, time(), package["id"], package["id"]])
+		# Fetch the page that tracks our package. Only a limited number of workers are allowed to load pages from
+		# the same website at once.
+		url = backend.urlFor(package["trackingNumber"])
+		try:
+			with upstreamLimiter.forURL(url):
+				events = parseEvents(backend.fetchEvents(url))
+			# A tracking page always has at least one event, even if it's only "no information". A page without any
+			# didn't load properly, and storing it would delete every event we already have for the number.
+			if not events:
+				raise FetchError("There are no events on " + url)
+		# ValueError means the page had a date we couldn't read
+		except (FetchError, ValueError) as e:
+			self.recordScrapeFailure(package, e)
+			con.commit() # Keep the failure even though the exception will make the decorator roll back
+			SCRAPES.inc("failure")
+			raise ScrapeError(package["trackingNumber"], e) from e
+
+		storeStart = perf_counter()
+
+		# Every event has a fingerprint, and the (tracking_number_id, fingerprint) pair is unique. Events we already have are skipped
+		# by the upsert, so only the genuinely new ones get written. Most scrapes find nothing new and write nothing.
+		# The page lists the newest event first, so we insert in reverse. That way newer events always have bigger IDs.
+		delivered = len(events) > 0 and isDeliveredEvent(events[0][2])
+		# A number is invalid if parcelsapp has no information about it, or if it has the wrong check digit for its
+		# carrier and there is nothing on the page. Once a real event turns up it isn't invalid any more.
+		carrier, malformed = detectCarrier(package["trackingNumber"])
+		noInformation = all(data == NO_INFORMATION_MESSAGE for eventTimestamp, hasTime, data in events)
+		invalid = noInformation and (len(events) > 0 or malformed)
+		events.reverse()
+		# The date and time text columns (and so the fingerprints) are made the same way they always have been
+		storedEvents = [formatStoredEvent(eventTimestamp) + (eventTimestamp, hasTime, data) for eventTimestamp, hasTime, data in events]
+		fingerprints = [fingerprintEvent(date, eventTime, data) for date, eventTime, eventTimestamp, hasTime, data in storedEvents]
+		cur = con.cursor()
+		# Removing our queue row takes the write lock, so nothing can change underneath us from here on. If the row has
+		# already gone then our lease ran out and the number was taken by another worker or deleted by
+		# checkForDeadPackages, so there is nothing left for us to write.
+		cur.execute("DELETE FROM queue WHERE id = ? AND claimed_by = ?", [package["queue_id"], workerID])
+		if cur.rowcount == 0:
+			cur.close()
+			con.commit()
+			return True
+		cur.executemany("INSERT INTO package_data (tracking_number_id, date, time, event_ts, has_time, data, fingerprint) VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (tracking_number_id, fingerprint) DO NOTHING", [[package["id"]] + list(storedEvent) + [fingerprint] for storedEvent, fingerprint in zip(storedEvents, fingerprints)])
+		insertedCount = cur.rowcount
+
+		# Events that have disappeared from the tracking page are removed. This happens when parcelsapp finally finds the
+		# package and replaces its "no information" event with the real ones.
+		cur.execute("DELETE FROM package_data WHERE tracking_number_id = ? AND fingerprint NOT IN (" + ", ".join("?" * len(fingerprints)) + ")", [package["id"]] + fingerprints)
+		deletedCount = cur.rowcount
+
+		# Work out when this number needs to be updated again, based on whether it is moving, quiet or delivered
+		# Also set the last_new_data field of every package tracking it to the current time if any new events were inserted
+		now = time()
+		lastNewData = now if insertedCount > 0 else package["last_new_data"]
+		cur.execute("UPDATE tracking_numbers SET last_updated = ?, last_new_data = ?, next_due_at = ?, carrier = ? WHERE id = ?", [now, lastNewData, calculateNextRefresh(now, lastNewData, delivered, invalid), carrier, package["id"]])
+		if insertedCount > 0:
+			cur.execute("UPDATE packages SET last_new_data = ? WHERE tracking_number_id = ?", [now, package["id"]])
+		# Every package tracking the number also gets a copy of its newest event, for the package list to show.
+		# The events were reversed above, so the newest one is at the end.
+		if insertedCount > 0 or deletedCount > 0:
+			latestEventTimestamp, latestEventHasTime, latestEvent = events[-1] if events else (None, None, None)
+			cur.execute("UPDATE packages SET latest_event = ?, latest_event_ts = ?, latest_event_has_time = ? WHERE tracking_number_id = ?", [latestEvent, latestEventTimestamp, latestEventHasTime, package["id"]])
+			# Lets the website tell anyone who has the package list open (see updates.py)
+			cur.execute("INSERT INTO package_updates (tracking_number_id, time_created) VALUES (?, ?)", [package["id"], now])
 		cur.close()
 		con.commit()
-		con.close()
-
-	# Checks if any packages haven't been updated for more than 6 hours. If so, adds them to the queue
-	# Cant use the decorator here because the sqlite connection will be on a nother thread
-	def addOldPackagesToQueue(self):		
-		# Create a cursor with results in dictionary format, and get all packages that haven't been
-		# updated for 6 hours, and are not already in the queue.
-		con = sqlite3.connect(self.dbPath)
-		cur = con.cursor()
+		if insertedCount > 0 or deletedCount > 0:
+			self.forgetPackageData([package["id"]])
+		SCRAPE_DURATION.observe(perf_counter() - storeStart, "store")
+		SCRAPES.inc("success")
+		return True
+
+	# Releases the claim on a queue row after its scrape failed, and pushes it back with an exponential backoff so the
+	# other numbers in the queue go first. Once it has failed too many times in a row it is dead lettered: it stays in the
+	# queue (so the scheduler wont add it again) but is never claimed, and the number stops being scheduled.
+	def recordScrapeFailure(self, package, error):
+		cur = self.con.cursor()
+		attempts = package["attempts"] + 1
+		dead = attempts >= self.MAX_SCRAPE_ATTEMPTS
+		retryAt = time() + min(self.RETRY_DELAY * 2 ** (attempts - 1), self.MAX_RETRY_DELAY)
+		cur.execute("UPDATE queue SET claimed_by = NULL, lease_expires = ?, attempts = ?, last_error = ?, dead = ? WHERE id = ?", [retryAt, attempts, repr(error), int(dead), package["queue_id"]])
+		if dead:
+			cur.execute("UPDATE tracking_numbers SET next_due_at = NULL WHERE id = ?", [package["id"]])
+		cur.close()
+
+	# Adds every tracking number that is due for a refresh to the queue, in one statement. Numbers that are already in the
+	# queue are skipped. The index on next_due_at means this only ever touches the numbers that are due.
+	@createDBConnection
+	def addOldPackagesToQueue(self):
+		cur = self.con.cursor()
+		now = time()
+		cur.execute("INSERT INTO queue (tracking_number_id, queued_at) SELECT id, ? FROM tracking_numbers WHERE next_due_at <= ? ON CONFLICT (tracking_number_id) DO NOTHING", [now, now])
+		cur.close()
+
+	# Returns how many numbers are waiting in the queue, how many have been dead lettered and when the oldest waiting one
+	# was queued (None if the queue is empty), for the metrics. The (dead, queued_at) index covers all of it.
+	@createDBConnection
+	def getQueueStats(self):
+		cur = self.con.cursor()
+		cur.execute("SELECT dead, COUNT(*), MIN(queued_at) FROM queue GROUP BY dead")
+		stats = {"waiting": 0, "dead": 0, "oldestQueuedAt": None}
+		for dead, count, oldestQueuedAt in cur.fetchall():
+			if dead:
+				stats["dead"] = count
+			else:
+				stats["waiting"] = count
+				stats["oldestQueuedAt"] = oldestQueuedAt
+		cur.close()
+		return stats
+
+	# How long (in seconds) package_updates rows are kept. The website processes read them within a second or two.
+	PACKAGE_UPDATE_AGE = 600
+
+	# Returns the updates to the user's packages after the package_updates row afterID, along with the id of the newest
+	# row to ask from next time. This is for pages that couldn't get an update stream (see UpdateBroker) and poll instead.
+	# Without afterID there are no updates, only the id to start from.
+	@createDBConnection
+	def getPackageUpdates(self, userID, afterID=None):
+		cur = self.con.cursor()
 		cur.row_factory = sqlite3.Row # Dictionary format
-		cur.execute("SELECT id FROM packages WHERE (? - last_updated) >= 21600 AND id NOT IN (SELECT package_id FROM queue)", [time()])
-		result = cur.fetchall()
+		cur.execute("SELECT COALESCE(MAX(id), 0) AS id FROM package_updates")
+		newestID = cur.fetchone()["id"]
+		if afterID is None or afterID >= newestID:
+			cur.close()
+			return [], newestID
+
+		cur.execute("SELECT packages.id AS id, packages.latest_event AS latest_event, packages.latest_event_ts AS latest_event_ts, packages.latest_event_has_time AS latest_event_has_time, tracking_numbers.last_updated AS last_updated FROM package_updates INNER JOIN packages ON packages.tracking_number_id = package_updates.tracking_number_id INNER JOIN tracking_numbers ON tracking_numbers.id = package_updates.tracking_number_id WHERE package_updates.id > ? AND package_updates.id <= ? AND packages.user_id = ? ORDER BY package_updates.id", [afterID, newestID, userID])
+		updates = [formatUpdate(row) for row in cur.fetchall()]
+		cur.close()
+		return updates, newestID
 
-		# Loop through each result and add the ID to the queue
-		for row in result:
-			cur.execute("INSERT INTO queue (package_id) VALUES (?)", [row["id"]])
-			con.commit()
+	@createDBConnection
+	def removeOldPackageUpdates(self):
+		cur = self.con.cursor()
+		cur.execute("DELETE FROM package_updates WHERE time_created < ?", [time() - self.PACKAGE_UPDATE_AGE])
 		cur.close()
-		con.close()
+
+	# How long (in seconds) a package can go without new data before its owner is warned, and before it is deleted
+	REMINDER_AGE = 2419200
+	DELETION_AGE = 2678400
 
 	# Will find any packages that have not had new data for a long time.
-	# Some are deleted, and some prompt a reminder email to the user that owns them.
+	# Some are deleted, and the rest prompt a reminder email to the user that owns them. Everything happens in a handful
+	# of set-based statements in one transaction, and each user gets a single email listing all of their old packages.
+	@createDBConnection
 	def checkForDeadPackages(self):
-		con = sqlite3.connect(self.dbPath)
-		cur = con.cursor()
+		cur = self.con.cursor()
 		cur.row_factory = sqlite3.Row # Dictionary format
-
-		# This joins users to pacakges, returns the email, title and id for each package that has not had new data for around a month
-		cur.execute("SELECT COALESCE(packages.title, packages.trackingNumber) AS title, packages.last_new_data AS last_new_data, packages.id AS id, users.email AS user_email FROM packages INNER JOIN users ON users.id = packages.user_id WHERE (? - packages.last_new_data) >= 2419200 AND packages.email_sent = 0", [time()])
-		result = cur.fetchall()
-
-		# Loop through results - we need to either send a reminder email or delete the package
-		for row in result:
-			# If the difference is greater than a month then this package should be deleted
-			if time() - row["last_new_data"] > 2678400:
-				cur.execute("DELETE FROM packages WHERE id = ?", [row["id"]])
-			# Otherwise it is getting close to deletion, so we send an email
-			else:
-				self.emailHandler.sendPackageReminderEmail(row["user_email"], row["title"], row["id"])
-				cur.execute("UPDATE packages SET email_sent = 1 WHERE id = ?", [row["id"]])
-			con.commit()
+		now = time()
+
+		# Packages that have been quiet for more than a month are deleted. A tracking number that none of the remaining
+		# packages use is deleted too, along with its events and queue entry. These run before the packages are deleted,
+		# because they need to know which tracking numbers the dead packages were using.
+		# A number that a worker has leased is left alone until the next run, otherwise the worker would write its events
+		# for a number that no longer exists. Its packages are kept too, so the number isn't left without any.
+		deadBefore = now - self.DELETION_AGE
+		notLeased = "NOT EXISTS (SELECT 1 FROM queue AS leased WHERE leased.tracking_number_id = {} AND leased.claimed_by IS NOT NULL AND leased.lease_expires > ?)"
+		cur.execute("DELETE FROM queue WHERE tracking_number_id IN (SELECT tracking_number_id FROM packages WHERE last_new_data <= ?) AND NOT EXISTS (SELECT 1 FROM packages AS alive WHERE alive.tracking_number_id = queue.tracking_number_id AND alive.last_new_data > ?) AND " + notLeased.format("queue.tracking_number_id"), [deadBefore, deadBefore, now])
+		cur.execute("DELETE FROM package_data WHERE tracking_number_id IN (SELECT tracking_number_id FROM packages WHERE last_new_data <= ?) AND NOT EXISTS (SELECT 1 FROM packages AS alive WHERE alive.tracking_number_id = package_data.tracking_number_id AND alive.last_new_data > ?) AND " + notLeased.format("package_data.tracking_number_id"), [deadBefore, deadBefore, now])
+		cur.execute("DELETE FROM tracking_numbers WHERE id IN (SELECT tracking_number_id FROM packages WHERE last_new_data <= ?) AND NOT EXISTS (SELECT 1 FROM packages AS alive WHERE alive.tracking_number_id = tracking_numbers.id AND alive.last_new_data > ?) AND " + notLeased.format("tracking_numbers.id"), [deadBefore, deadBefore, now])
+		cur.execute("DELETE FROM packages WHERE last_new_data <= ? AND " + notLeased.format("packages.tracking_number_id"), [deadBefore, now])
+
+		# Everything that is left and hasn't been warned about yet is getting close to deletion, so we warn the owners.
+		# This joins users to packages, returns the email, title and id for each package that has not had new data for around a month
+		cur.execute("SELECT COALESCE(packages.title, packages.trackingNumber) AS title, packages.id AS id, users.email AS user_email FROM packages INNER JOIN users ON users.id = packages.user_id WHERE packages.last_new_data <= ? AND packages.email_sent = 0 ORDER BY packages.user_id", [now - self.REMINDER_AGE])
+		packagesByUser = {}
+		for row in cur.fetchall():
+			packagesByUser.setdefault(row["user_email"], []).append({"id": row["id"], "title": row["title"]})
+		cur.execute("UPDATE packages SET email_sent = 1 WHERE last_new_data <= ? AND email_sent = 0", [now - self.REMINDER_AGE])
+
+		# One email per user. The emails go in the outbox as part of this transaction, so they are only sent if it commits.
+		for userEmail, userPackages in packagesByUser.items():
+			self.emailHandler.sendPackageReminderEmail(userEmail, userPackages)
 
 		cur.close()
-		con.close()
 
+	# Adds a package for the passed tracking number. Returns the result that importPackages gives it: "added", "flagged"
+	# if it was added but looks like it has a typo in it, "alreadyTracked" if the user is already tracking it, or "invalid".
 	@createDBConnection
 	def createNewPackage(self, trackingNumber, userID):
-		# First we check if the user is already tracking this package
+		return self.importPackages([(1, trackingNumber)], userID)[0]["result"]
+
+	# The most tracking numbers that can be imported at once. Anything after that is left out, so a huge upload can't
+	# hold the database's write lock for too long.
+	MAX_IMPORT_SIZE = 1000
+
+	# Adds a package for every tracking number in the passed (line number, tracking number) list, like the one from
+	# readTrackingNumbers. Returns a result for each line, with the result being one of:
+	# - added: a new package was created
+	# - flagged: a new package was created, but the number has the wrong check digit for its carrier (see carriers.py)
+	# - alreadyTracked: the user was already tracking that number
+	# - repeated: the number came up earlier in the same list
+	# - invalid: it can't be a tracking number, so nothing was added
+	# Every number that is added also gets its carrier (None if we don't know it). All of it happens in one transaction. The numbers the user already tracks are found with one lookup, and the
+	# tracking numbers, packages and queue entries are each inserted with a single executemany.
+	@createDBConnection
+	def importPackages(self, lines, userID):
+		results = []
+		newNumbers = {} # Normalised tracking number -> its result, for every number that still needs adding
+		carriers = {} # Normalised tracking number -> (carrier, malformed)
+		for lineNumber, trackingNumber in lines:
+			# Tracking numbers are shared between users, so "1z 999" and "1Z999" need to end up as the same number
+			trackingNumber = normaliseTrackingNumber(trackingNumber)
+			result = {"line": lineNumber, "trackingNumber": trackingNumber}
+			results.append(result)
+			if not isPossibleTrackingNumber(trackingNumber):
+				result["result"] = "invalid"
+			elif trackingNumber in newNumbers:
+				result["result"] = "repeated"
+			else:
+				newNumbers[trackingNumber] = result
+				carriers[trackingNumber] = detectCarrier(trackingNumber)
+		if not newNumbers:
+			return results
+
+		# Leave out the numbers the user is already tracking. The (user_id, trackingNumber) index answers this in one go.
 		cur = self.con.cursor()
-		cur.row_factory = sqlite3.Row # Dictionary format
-		cur.execute("SELECT id FROM packages WHERE user_id = ? AND trackingNumber = ?", [userID, trackingNumber])
-		result = cur.fetchone()
+		trackingNumbers = list(newNumbers)
+		cur.execute("SELECT trackingNumber FROM packages WHERE user_id = ? AND trackingNumber IN (" + ", ".join("?" * len(trackingNumbers)) + ")", [userID] + trackingNumbers)
+		for (trackingNumber,) in cur.fetchall():
+			newNumbers.pop(trackingNumber)["result"] = "alreadyTracked"
+		if not newNumbers:
+			cur.close()
+			return results
+
+		# Every tracking number is only stored (and scraped) once no matter how many users track it, so the shared
+		# numbers that don't exist yet are created, and then the ids of all of them are looked up.
+		now = time()
+		trackingNumbers = list(newNumbers)
+		cur.executemany("INSERT INTO tracking_numbers (number, last_new_data, carrier) VALUES (?, ?, ?) ON CONFLICT (number) DO NOTHING", [(trackingNumber, now, carriers[trackingNumber][0]) for trackingNumber in trackingNumbers])
+		cur.execute("SELECT number, id, last_updated FROM tracking_numbers WHERE number IN (" + ", ".join("?" * len(trackingNumbers)) + ")", trackingNumbers)
+		trackingNumberRows = {number: (trackingNumberID, lastUpdated) for number, trackingNumberID, lastUpdated in cur.fetchall()}
+
+		# If a number has been scraped before then its package starts off with its newest event
+		cur.executemany("INSERT INTO packages (trackingNumber, tracking_number_id, user_id, last_new_data, latest_event, latest_event_ts, latest_event_has_time) SELECT ?, ?, ?, ?, latest.data, latest.event_ts, latest.has_time FROM (SELECT 1) LEFT JOIN (SELECT data, event_ts, has_time FROM package_data WHERE tracking_number_id = ? ORDER BY event_ts DESC, id DESC LIMIT 1) AS latest", [(trackingNumber, trackingNumberRows[trackingNumber][0], userID, now, trackingNumberRows[trackingNumber][0]) for trackingNumber in trackingNumbers])
+
+		# If a number has already been scraped for someone else then the user gets the cached history straight away.
+		# Otherwise it goes to the front of the queue (or gets bumped to the front if it is already waiting). If it was
+		# backing off or dead lettered after failing, it gets a fresh set of attempts straight away (and a dead lettered
+		# number counts as having been queued just now).
+		cur.executemany("INSERT INTO queue (tracking_number_id, priority, queued_at) VALUES (?, 1, ?) ON CONFLICT (tracking_number_id) DO UPDATE SET priority = 1, attempts = 0, dead = 0, lease_expires = CASE WHEN claimed_by IS NULL THEN 0 ELSE lease_expires END, queued_at = CASE WHEN dead = 1 THEN excluded.queued_at ELSE queued_at END", [(trackingNumberID, now) for trackingNumberID, lastUpdated in trackingNumberRows.values() if lastUpdated == 0])
 		cur.close()
-		if result:
-			return False
 
-		# If they aren't tracking the package, then we insert it into the db
-		cur = self.con.cursor() # New cursor to avoid conflicts with different operation types
-		cur.execute("INSERT INTO packages (trackingNumber, user_id, last_new_data) VALUES (?, ?, ?)", [trackingNumber, userID, time()])
-		self.con.commit()
-		cur.execute("INSERT INTO queue (package_id, priority) VALUES ((SELECT MAX(id) FROM packages), 1)")
-		self.con.commit()
-		cur.close()
-		return True
+		for trackingNumber, result in newNumbers.items():
+			carrier, malformed = carriers[trackingNumber]
+			result["result"] = "flagged" if malformed else "added"
+			result["carrier"] = carrier
+		return results
 
+	# How many packages are shown on the package list at a time. More are loaded as the user scrolls down.
+	PAGE_SIZE = 50
+
+	# Returns a page of the user's packages, newest first, as a (packages, before) tuple. Pass before back in to get the
+	# next page, it is None when there are no more pages. Each page starts where the last one finished (keyset
+	# pagination), so getting a page is a single range read of the user_id index no matter how far down it is.
 	@createDBConnection
-	def getListOfPackages(self, userID):
-		# This is pretty self explanatory. We get a cursor, select all packages, close the cursor and return
+	def getListOfPackages(self, userID, before=None):
 		cur = self.con.cursor()
 		cur.row_factory = sqlite3.Row # Dictionary format
-		
+
 		# The result set needs to have the title, but if the title is null we use the tracking number
-		cur.execute("SELECT id, COALESCE(title, trackingNumber) AS title, last_new_data, ? AS current_time FROM packages WHERE user_id = ? ORDER BY id DESC", [time(), userID])
+		# last_updated lets the browser tell if the data it has cached for a package is still up to date
+		# One extra row is read, which tells us if there is another page after this one
+		cur.execute("SELECT packages.id AS id, packages.user_id AS user_id, COALESCE(packages.title, packages.trackingNumber) AS title, packages.last_new_data AS last_new_data, packages.latest_event AS latest_event, packages.latest_event_ts AS latest_event_ts, packages.latest_event_has_time AS latest_event_has_time, tracking_numbers.last_updated AS last_updated, tracking_numbers.carrier AS carrier, ? AS current_time FROM packages INNER JOIN tracking_numbers ON tracking_numbers.id = packages.tracking_number_id WHERE packages.user_id = ? AND packages.id < ? ORDER BY packages.id DESC LIMIT ?", [time(), userID, before if before is not None else 2 ** 63 - 1, self.PAGE_SIZE + 1])
 		result = cur.fetchall()
 		cur.close()
-		return result
+
+		if len(result) > self.PAGE_SIZE:
+			result = result[:self.PAGE_SIZE]
+			return result, result[-1]["id"]
+		return result, None
 
 	# @createDBConnection
 	# def getPackageData(self, packageID, userID):
@@ -203,52 +403,116 @@ class PackageHandler():
 	# 	result[0]["data"] = strftime("%a %d %b %Y", gmtime(result[0]["data"]))
 	# 	return result
 
+	# Returns the data of the package as an (etag, json) tuple, or None if the user doesn't own it. The json is ready to
+	# send - the title of the package at the top, followed by every event in its journey, newest first.
+	# The json only changes when the number is scraped or the title is changed, so it is cached. The cache entry knows
+	# who owns the package, so a cached package doesn't cost a single query (see PACKAGE_DATA_MAX_AGE).
+	# minLastUpdated is the last_updated the browser already knows about. Cached data from before then is out of date,
+	# even if this process hasn't heard about the scrape yet.
+	def getPackageData(self, packageID, userID, minLastUpdated=0):
+		try:
+			packageID = int(packageID)
+		except ValueError:
+			return None
+
+		cached = self.packageDataCache.get(packageID, lambda entry: time() - entry["cached_at"] < self.PACKAGE_DATA_MAX_AGE and entry["last_updated"] >= minLastUpdated)
+		if cached:
+			return (cached["etag"], cached["json"]) if cached["user_id"] == userID else None
+		return self.loadPackageData(packageID, userID)
+
+	# Reads the package from the database and caches it, for getPackageData
 	@createDBConnection
-	def getPackageData(self, packageID, userID):
-		# Make sure user has access
-		if self.isPackageAssociatedWithUser(packageID, userID) == False:
-			return {"success": False}
-
+	def loadPackageData(self, packageID, userID):
 		cur = self.con.cursor() # Dictionary format cursor
 		cur.row_factory = sqlite3.Row
-
-		# Return all stages in the packages journey with date, time and the description of the event
-		# The package title is added to the top of the result. Order by reverse order so data is in date order
-		cur.execute("SELECT id, date, time, data FROM package_data WHERE package_id = ? UNION SELECT 0, COALESCE(title, trackingNumber) AS title, trackingNumber, ROUND(last_updated) FROM packages WHERE id = ?", [packageID, packageID])
-		result = cur.fetchall()
+		cur.execute("SELECT packages.user_id AS user_id, COALESCE(packages.title, packages.trackingNumber) AS title, packages.trackingNumber AS trackingNumber, packages.tracking_number_id AS tracking_number_id, tracking_numbers.last_updated AS last_updated FROM packages INNER JOIN tracking_numbers ON tracking_numbers.id = packages.tracking_number_id WHERE packages.id = ?", [packageID])
+		package = cur.fetchone()
+		# Make sure user has access
+		if not package or package["user_id"] != userID:
+			cur.close()
+			return None
+
+		# Newest event first, straight out of the (tracking_number_id, event_ts) index. Events with the same time are in
+		# the order they were inserted. The events are shared between everyone tracking the same number.
+		cur.execute("SELECT id, event_ts, has_time, data FROM package_data WHERE tracking_number_id = ? ORDER BY event_ts DESC, id DESC", [package["tracking_number_id"]])
+		events = [formatEventRow(row) for row in cur.fetchall()]
 		cur.close()
 
-		# We need to parse the seconds then reassign them to the row. However, this cannot be done to the
-		# Row object directly, so we need to convert it to a dictionary first.
-		result = [dict(row) for row in result]
-		result[0]["data"] = strftime("%a %d %b %Y", gmtime(result[0]["data"]))
-		# Return as neat object so I can serialize it
-		return {"success": True, "data": result}
-	
-	# This checks if the specified user id has access to the specified package
-	def isPackageAssociatedWithUser(self, packageID, userID):
+		cached = self.cachePackageData(packageID, package, events)
+		return cached["etag"], cached["json"]
+
+	# The most packages that can be asked for in one go with getPackageDataBatch
+	MAX_BATCH_SIZE = 100
+
+	# Does the same thing as getPackageData, but for lots of packages at once with a fixed number of queries. Packages the
+	# user doesn't own are left out. Returns the json for all of them together, with the last_updated of each package
+	# alongside its data so the browser can cache it:
+	# {"success": true, "packages": {"<id>": {"lastUpdated": ..., "packageData": <same as getPackageData>}, ...}}
+	@createDBConnection
+	def getPackageDataBatch(self, packageIDs, userID):
+		packageIDs = packageIDs[:self.MAX_BATCH_SIZE]
 		cur = self.con.cursor()
-		# Check that the package is associated with this user. If not, return false.
-		cur.execute("SELECT id FROM packages WHERE user_id = ? AND id = ?", [userID, packageID])
-		result = cur.fetchone()
+		cur.row_factory = sqlite3.Row
+		cur.execute("SELECT packages.id AS id, packages.user_id AS user_id, COALESCE(packages.title, packages.trackingNumber) AS title, packages.trackingNumber AS trackingNumber, packages.tracking_number_id AS tracking_number_id, tracking_numbers.last_updated AS last_updated FROM packages INNER JOIN tracking_numbers ON tracking_numbers.id = packages.tracking_number_id WHERE packages.user_id = ? AND packages.id IN (" + ", ".join("?" * len(packageIDs)) + ")", [userID] + packageIDs)
+		packages = cur.fetchall()
+
+		results = {}
+		uncached = []
+		for package in packages:
+			cached = self.getCachedPackageData(package["id"], package)
+			if cached:
+				results[package["id"]] = cached
+			else:
+				uncached.append(package)
+
+		# Get the events for every package that wasn't cached in one query, then split them up by tracking number
+		if uncached:
+			trackingNumberIDs = list({package["tracking_number_id"] for package in uncached})
+			cur.execute("SELECT tracking_number_id, id, event_ts, has_time, data FROM package_data WHERE tracking_number_id IN (" + ", ".join("?" * len(trackingNumberIDs)) + ") ORDER BY tracking_number_id, event_ts DESC, id DESC", trackingNumberIDs)
+			eventsByTrackingNumber = {}
+			for row in cur.fetchall():
+				eventsByTrackingNumber.setdefault(row["tracking_number_id"], []).append(formatEventRow(row))
+			for package in uncached:
+				results[package["id"]] = self.cachePackageData(package["id"], package, eventsByTrackingNumber.get(package["tracking_number_id"], []))
 		cur.close()
 
-		if not result:
-			return False
-		return True
-
-	# This function will update the specified package's title after verifying that the user has access to it
+		# The cached json is already serialized, so it is dropped straight in rather than being parsed and dumped again
+		return '{"success": true, "packages": {' + ", ".join('"' + str(packageID) + '": {"lastUpdated": ' + dumps(cached["last_updated"]) + ', "etag": "' + cached["etag"] + '", "packageData": ' + cached["json"] + '}' for packageID, cached in results.items()) + '}}'
+
+	# Returns the cached data for the package, as long as it was made from the same scrape (last_updated) and with the same title.
+	# getPackageDataBatch has just read the package anyway, so it can check against it instead of trusting the cache.
+	def getCachedPackageData(self, packageID, package):
+		return self.packageDataCache.get(packageID, lambda entry: entry["last_updated"] == package["last_updated"] and entry["title"] == package["title"])
+
+	# Serializes the data of the package and caches it. Returns the cache entry.
+	def cachePackageData(self, packageID, package, events):
+		# The package details go at the top, as if they were an event with an ID of 0
+		result = [{"id": 0, "date": package["title"], "time": package["trackingNumber"], "data": strftime("%a %d %b %Y", gmtime(round(package["last_updated"])))}] + events
+		json = dumps({"success": True, "data": result})
+		entry = {"user_id": package["user_id"], "tracking_number_id": package["tracking_number_id"], "last_updated": package["last_updated"], "title": package["title"], "cached_at": time(), "etag": sha1(json.encode("utf-8")).hexdigest(), "json": json}
+		self.packageDataCache.put(packageID, entry)
+		return entry
+
+	# Throws out the cached data of every package that tracks one of the passed numbers, after their events changed
+	def forgetPackageData(self, trackingNumberIDs):
+		trackingNumberIDs = set(trackingNumberIDs)
+		self.packageDataCache.invalidateWhere(lambda entry: entry["tracking_number_id"] in trackingNumberIDs)
+	
+	# This function will update the specified package's title, as long as the user owns it.
+	# Ownership is checked by the statements themselves (user_id is part of every WHERE), so there is no separate query
+	# for it. The same goes for deletePackage and renewPackage.
 	@createDBConnection
 	def updatePackageTitle(self, packageID, userID, title):
-		# Make sure they own this package
-		if self.isPackageAssociatedWithUser(packageID, userID) == False:
-			return "0"
-
 		# Assign none to the title if the string is empty - we want to insert NULL into the db not an empty string
 		newTitle = title.strip() if len(title.strip()) > 0 else None
 		cur = self.con.cursor()
-		cur.execute("UPDATE packages SET title = ? WHERE id = ?", [newTitle, packageID]) #Update and close connection
+		cur.execute("UPDATE packages SET title = ? WHERE id = ? AND user_id = ?", [newTitle, packageID, userID])
+		# Nothing was updated if they don't own this package
+		if cur.rowcount == 0:
+			cur.close()
+			return "0"
 		self.con.commit()
+		self.packageDataCache.invalidate(int(packageID))
 		
 		# If the title was an empty string, then the title for this package should now default back to the
 		# tracking number. We need to perform an additional query to get the tracking number.
@@ -262,28 +526,41 @@ class PackageHandler():
 
 	@createDBConnection
 	def deletePackage(self, packageID, userID):
-		# Make sure they own this package
-		if self.isPackageAssociatedWithUser(packageID, userID) == False:
+		# Make sure they own this package. Their package's tracking number is needed for the clean up below anyway.
+		cur = self.con.cursor()
+		cur.execute("SELECT tracking_number_id FROM packages WHERE id = ? AND user_id = ?", [packageID, userID])
+		row = cur.fetchone()
+		if not row:
+			cur.close()
 			return "0"
-		
+
 		# If they are authorised to delete this package then delete it.
-		cur = self.con.cursor()
-		cur.execute("DELETE FROM queue WHERE package_id = ?", [packageID])
-		cur.execute("DELETE FROM package_data WHERE package_id = ?", [packageID])
+		trackingNumberID = row[0]
 		cur.execute("DELETE FROM packages WHERE id = ?", [packageID])
+		self.removeUnwatchedTrackingNumber(cur, trackingNumberID)
 		self.con.commit()
+		self.packageDataCache.invalidate(int(packageID))
 		cur.close()
 		return "1"
 
+	# If nobody tracks the passed tracking number any more then it is deleted, along with its events and queue entry.
+	# Uses the passed cursor so it happens in the same transaction as the package deletion.
+	def removeUnwatchedTrackingNumber(self, cur, trackingNumberID):
+		cur.execute("SELECT 1 FROM packages WHERE tracking_number_id = ? LIMIT 1", [trackingNumberID])
+		if cur.fetchone():
+			return
+
+		cur.execute("DELETE FROM queue WHERE tracking_number_id = ?", [trackingNumberID])
+		cur.execute("DELETE FROM package_data WHERE tracking_number_id = ?", [trackingNumberID])
+		cur.execute("DELETE FROM tracking_numbers WHERE id = ?", [trackingNumberID])
+
 	@createDBConnection
 	def renewPackage(self, packageID, userID):
-		if self.isPackageAssociatedWithUser(packageID, userID) == False:
-			return False
-
-		# If they have access to it, reset the last_new_data to the current time, and reset the email_sent flag
+		# If they own it, reset the last_new_data to the current time, and reset the email_sent flag
 		# This will make the system wait another few weeks before warning the user, and will allow it to resend the email.
 		cur = self.con.cursor()
-		cur.execute("UPDATE packages SET last_new_data = ?, email_sent = 0 WHERE id = ?", [time(), packageID])
+		cur.execute("UPDATE packages SET last_new_data = ?, email_sent = 0 WHERE id = ? AND user_id = ?", [time(), packageID, userID])
+		renewed = cur.rowcount > 0
 		self.con.commit()
 		cur.close()
-		return True
\ No newline at end of file
+		return renewed
\ No newline at end of file
@@ -0,0 +1,161 @@
+from calendar import timegm
+from csv import reader
+from html.parser import HTMLParser
+from re import compile, IGNORECASE
+from time import strftime, strptime, gmtime
+
+# The text parcelsapp shows when it can't find the package anywhere, and what we show the user instead
+NO_INFORMATION_PREFIX = "No information about your package. We've checked all relevant couriers"
+NO_INFORMATION_MESSAGE = "There is no tracking information for your package. Please make sure the tracking code is correct."
+
+# This is run inside the browser with execute_script. It is passed the <ul> holding the events and pulls out the
+# date, time and description of every event in one go, so we only make a single round-trip to chromedriver instead of
+# several for every <li>. The result comes back as a list of dicts.
+EXTRACT_EVENTS_SCRIPT = """
+const text = element => element ? element.innerText.trim() : "";
+return Array.from(arguments[0].querySelectorAll("li")).map(listItem => {
+	const dateTimeDiv = listItem.querySelector("div.event-time");
+	return {
+		date: text(dateTimeDiv && dateTimeDiv.querySelector("strong")),
+		time: text(dateTimeDiv && dateTimeDiv.querySelector("span")),
+		data: text(listItem.querySelector("div.event-content strong"))
+	};
+});
+"""
+
+# Turns a single raw event (as returned by EXTRACT_EVENTS_SCRIPT) into an (eventTimestamp, hasTime, data) tuple.
+# The timestamp is the time shown on the website as if it was UTC. The website shows the local time wherever the event
+# happened and doesn't say which timezone that is, so this keeps exactly what was shown while still being sortable.
+def parseEvent(rawEvent):
+	# We join the date and time together in 1 string, then pass it to this time parsing function
+	# If the package number is incorrect or something, then the scraping will return something
+	# along the lines of "no package data for <<country>>". If this happens it doesn't return a time,
+	# only a date. If there is only a date then this block will catch it, and the event is marked as not having a time.
+	try:
+		parsedTime = strptime(rawEvent["date"] + " " + rawEvent["time"], "%d %b %Y %H:%M")
+		hasTime = True
+	except ValueError:
+		parsedTime = strptime(rawEvent["date"], "%d %b %Y")
+		hasTime = False
+
+	# The data is what the package stage is actually about, things like Delivered, In Transit To Local Depot, Arrive at destination country etc.
+	data = rawEvent["data"]
+	if data.startswith(NO_INFORMATION_PREFIX):
+		data = NO_INFORMATION_MESSAGE
+
+	return (timegm(parsedTime), hasTime, data)
+
+def parseEvents(rawEvents):
+	return [parseEvent(rawEvent) for rawEvent in rawEvents]
+
+# These turn an event timestamp back into what we show the user. Events that only had a date get an empty time.
+def formatEventDate(eventTimestamp):
+	return strftime("%a %d %b %Y", gmtime(eventTimestamp))
+
+def formatEventTime(eventTimestamp, hasTime):
+	return strftime("%I:%M %p", gmtime(eventTimestamp)) if hasTime else ""
+
+# The date and time in the format the package_data date and time columns have always been stored in. A date only
+# event has a time of 12:00 AM here, the same as it always has, so event fingerprints stay the same as before.
+def formatStoredEvent(eventTimestamp):
+	return strftime("%a %d %b %Y", gmtime(eventTimestamp)), strftime("%I:%M %p", gmtime(eventTimestamp))
+
+# Matches event descriptions that say the package has arrived, without matching things like "Undelivered" or "Out for delivery"
+DELIVERED_PATTERN = compile(r"(?<!un)(?<!not )\bdelivered\b", IGNORECASE)
+
+# Checks if the passed event description means that the package has been delivered
+def isDeliveredEvent(data):
+	return DELIVERED_PATTERN.search(data) is not None
+
+# These tags never have a closing tag, so they should never be pushed onto the tag stack
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+
+# Does the same job as EXTRACT_EVENTS_SCRIPT but on a saved page, without a browser.
+# This lets the parsing be tested and benchmarked against HTML fixtures, and lets pages be fetched without selenium.
+class EventListParser(HTMLParser):
+	def __init__(self):
+		super().__init__()
+		self.stack = [] # Each open tag as a (tag, classes) tuple
+		self.events = []
+		self.foundList = False # Tells apart a page with no events list from one with an empty list
+		self.strongCount = 0 # Only the first <strong> in the event content is the description
+
+	def handle_starttag(self, tag, attrs):
+		if tag in VOID_TAGS:
+			return
+		classes = (dict(attrs).get("class") or "").split()
+		self.stack.append((tag, classes))
+
+		if tag == "ul" and "events" in classes:
+			self.foundList = True
+		elif tag == "li" and self.inside("ul", "events"):
+			self.events.append({"date": "", "time": "", "data": ""})
+		elif tag == "strong" and self.inside("div", "event-content"):
+			self.strongCount += 1
+		elif tag == "div" and "event-content" in classes:
+			self.strongCount = 0
+
+	def handle_endtag(self, tag):
+		# Pop back to the matching tag, this copes with any tags that were left unclosed
+		for i in range(len(self.stack) - 1, -1, -1):
+			if self.stack[i][0] == tag:
+				del self.stack[i:]
+				return
+
+	def handle_data(self, data):
+		if not self.events or not self.inside("ul", "events"):
+			return
+
+		field = None
+		if self.inside("div", "event-time"):
+			if self.inside("strong"):
+				field = "date"
+			elif self.inside("span"):
+				field = "time"
+		elif self.inside("div", "event-content") and self.inside("strong") and self.strongCount == 1:
+			field = "data"
+
+		if field:
+			event = self.events[-1]
+			# Collapse whitespace the same way the browser does for innerText
+			event[field] = " ".join((event[field] + " " + data).split())
+
+	# Checks if we are currently inside the passed tag, optionally only counting tags that have the passed class
+	def inside(self, tag, cssClass=None):
+		return any(openTag == tag and (cssClass is None or cssClass in classes) for openTag, classes in self.stack)
+
+# Returns the raw events from the events list of a tracking page, in the same format as EXTRACT_EVENTS_SCRIPT.
+# Returns None if the page doesn't have an events list at all.
+def extractEventsFromHTML(html):
+	parser = EventListParser()
+	parser.feed(html)
+	parser.close()
+	return parser.events if parser.foundList else None
+
+# Returns the raw events from a shipment sent back by parcelsapp's tracking API (see ParcelsAppAPIBackend), in the same
+# format as EXTRACT_EVENTS_SCRIPT and newest first like the page. The dates are ISO 8601, and the time in them is kept
+# as it is, the same as the time shown on the page. A shipment that parcelsapp has nothing on (or None) gets the
+# "no information" event the page would show, dated today.
+def extractEventsFromShipment(shipment):
+	states = (shipment or {}).get("states") or []
+	if not states:
+		return [{"date": strftime("%d %b %Y", gmtime()), "time": "", "data": NO_INFORMATION_PREFIX}]
+
+	events = []
+	for state in sorted(states, key=lambda state: state.get("date", ""), reverse=True):
+		stateTime = strptime(state.get("date", "")[:16], "%Y-%m-%dT%H:%M")
+		events.append({"date": strftime("%d %b %Y", stateTime), "time": strftime("%H:%M", stateTime), "data": state.get("status", "")})
+	return events
+
+# Reads tracking numbers out of an uploaded list, which is either one number per line or a CSV file with the numbers
+# in the first column. lines can be any iterable of text lines (like a file), and it is only read as far as needed.
+# Yields (line number, tracking number) tuples. Blank lines are skipped, and so is a header row - a first row with no
+# digits in it can't be a tracking number.
+def readTrackingNumbers(lines):
+	rows = reader(lines)
+	for row in rows:
+		if not row or not row[0].strip():
+			continue
+		if rows.line_num == 1 and not any(character.isdigit() for character in row[0]):
+			continue
+		yield rows.line_num, row[0]
@@ -0,0 +1,126 @@
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from threading import BoundedSemaphore, Lock
+from time import time
+
+from passlib.context import CryptContext
+
+from connections import createDBConnection
+
+# Raised when a password can't be checked right now. The request should ask the user to try again in a bit.
+class TooManyAttempts(Exception):
+	pass
+
+# Raised when a password can't be hashed right now: every hashing process is busy and the queue waiting for them is
+# full, the hash took too long, or a hashing process died. The request should ask the user to try again in a bit.
+class PasswordHasherBusy(Exception):
+	pass
+
+# How passwords are hashed. Any stored hash that doesn't use exactly this many rounds is flagged as needing an update,
+# so changing the rounds upgrades every user's hash the next time they log in.
+def createCryptContext(rounds):
+	return CryptContext(schemes=["sha256_crypt"], sha256_crypt__default_rounds=rounds, sha256_crypt__min_rounds=rounds, sha256_crypt__max_rounds=rounds)
+
+# Each hashing process builds its own context when it starts. These run in the hashing processes, not in the website.
+cryptContext = None
+
+def startHashingProcess(rounds):
+	global cryptContext
+	cryptContext = createCryptContext(rounds)
+
+def hashInProcess(password):
+	return cryptContext.hash(password)
+
+# Returns (valid, newHash). newHash is None unless the password was right and the stored hash needs upgrading.
+def verifyInProcess(password, passwordHash):
+	return cryptContext.verify_and_update(password, passwordHash)
+
+# Hashes and verifies passwords in a small pool of separate processes. Hashing is slow on purpose (that is the point
+# of it), and doing it on the request thread would hold up every other request running in the same process.
+# At most maxPending passwords can be waiting for the pool at once, anything more raises PasswordHasherBusy straight
+# away instead of letting a flood of logins build up a huge queue. Every failure raises PasswordHasherBusy, so the
+# routes only have one thing to handle.
+class PasswordHasher():
+	def __init__(self, rounds=535000, maxWorkers=2, maxPending=16, timeout=10):
+		self.rounds = rounds
+		self.maxWorkers = maxWorkers
+		self.timeout = timeout
+		self.slots = BoundedSemaphore(maxPending)
+		self.poolLock = Lock()
+		self.pool = self.createPool()
+
+	# spawn instead of fork, because forking a process that has threads running can deadlock the child.
+	# The processes are only started when the first password is hashed.
+	def createPool(self):
+		return ProcessPoolExecutor(self.maxWorkers, mp_context=get_context("spawn"), initializer=startHashingProcess, initargs=(self.rounds,))
+
+	def hash(self, password):
+		return self.run(hashInProcess, password)
+
+	def verifyAndUpdate(self, password, passwordHash):
+		return self.run(verifyInProcess, password, passwordHash)
+
+	# Runs the passed function in the pool and waits for the result
+	def run(self, function, *args):
+		if not self.slots.acquire(blocking=False):
+			raise PasswordHasherBusy()
+		pool = self.pool
+		try:
+			return pool.submit(function, *args).result(self.timeout)
+		# The hashing process keeps going, but nobody is waiting for it any more
+		except FutureTimeoutError as e:
+			raise PasswordHasherBusy() from e
+		# A hashing process died (like being killed for using too much memory). The pool can't be used again after
+		# that, so the next password gets a new one.
+		except BrokenProcessPool as e:
+			self.replacePool(pool)
+			raise PasswordHasherBusy() from e
+		finally:
+			self.slots.release()
+
+	def replacePool(self, brokenPool):
+		with self.poolLock:
+			# Another request might have already replaced it
+			if self.pool is brokenPool:
+				self.pool = self.createPool()
+		brokenPool.shutdown(wait=False)
+
+	def shutdown(self):
+		self.pool.shutdown(cancel_futures=True)
+
+# Counts failed attempts for each key (like an email address or an IP address) over a sliding window. Once a key has
+# failed maxAttempts times within the window it is blocked until the oldest of those failures falls out of the window.
+# The failures are kept in the database, so every website process counts towards the same limit. kind keeps the keys
+# of different limiters apart. Authenticator.removeExpiredTokens clears out failures that have left the window.
+class AttemptLimiter():
+	def __init__(self, connections, kind, maxAttempts, window):
+		self.connections = connections
+		self.kind = kind
+		self.maxAttempts = maxAttempts
+		self.window = window
+
+	@property
+	def con(self):
+		return self.connections.getConnection()
+
+	@createDBConnection
+	def isAllowed(self, key):
+		cur = self.con.cursor()
+		# There is no need to count past maxAttempts
+		cur.execute("SELECT COUNT(*) FROM (SELECT 1 FROM login_failures WHERE kind = ? AND key = ? AND time_created > ? LIMIT ?)", [self.kind, key, time() - self.window, self.maxAttempts])
+		failures = cur.fetchone()[0]
+		cur.close()
+		return failures < self.maxAttempts
+
+	@createDBConnection
+	def recordFailure(self, key):
+		cur = self.con.cursor()
+		cur.execute("INSERT INTO login_failures (kind, key, time_created) VALUES (?, ?, ?)", [self.kind, key, time()])
+		cur.close()
+
+	@createDBConnection
+	def reset(self, key):
+		cur = self.con.cursor()
+		cur.execute("DELETE FROM login_failures WHERE kind = ? AND key = ?", [self.kind, key])
+		cur.close()
@@ -0,0 +1,255 @@
+from threading import Thread, Event, BoundedSemaphore, Lock
+from time import time
+from urllib.parse import urlparse
+from uuid import uuid4
+import psutil
+
+from errors import ScrapeError
+
+# These create the browser and set the required options needed for it to function with parcelsapp
+from selenium.webdriver import Chrome
+from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
+from selenium.webdriver.chrome.options import Options
+from selenium.common.exceptions import WebDriverException
+
+# Content that isn't needed to read the tracking events. Blocking it makes pages load faster and keeps memory down.
+BLOCKED_URL_PATTERNS = ["*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico", "*.woff", "*.woff2", "*.ttf", "*.otf", "*.css"]
+
+# Starts up a new headless chrome instance that is set up to work with parcelsapp
+def createBrowser(chromeDriverName):
+	# Dont wait for full page load
+	caps = DesiredCapabilities().CHROME
+	caps["pageLoadStrategy"] = "none"
+	# This option needs to be set otherwise the automated browser will be detected by the website
+	opts = Options()
+	opts.add_argument("--disable-blink-features=AutomationControlled")
+	opts.add_argument("--headless") # Runs faster - no rendering
+	# Don't bother downloading images or fonts. Stylesheets are blocked per tab with CDP (see BrowserManager.blockResources)
+	opts.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2, "profile.managed_default_content_settings.fonts": 2})
+	browser = Chrome(chromeDriverName, desired_capabilities=caps, chrome_options=opts)
+	# Nothing the browser does is allowed to hang forever
+	browser.set_page_load_timeout(30)
+	browser.set_script_timeout(30)
+	return browser
+
+# Looks after the browser for a single scraper worker. Chrome slowly eats more and more memory the longer it runs and
+# can crash, so the manager:
+# - restarts it after maxPages pages, or once it uses more than maxMemoryMB
+# - checks that it is still responding before handing it out, and restarts it if not
+# - blocks images, fonts and stylesheets, which aren't needed for scraping
+# - keeps a few tabs open and rotates between them. The tab that was just used is sent to about:blank so the old page
+#   stops running, and the next scrape starts in a tab that is already idle.
+class BrowserManager():
+	def __init__(self, chromeDriverName, maxPages=200, maxMemoryMB=1024, warmTabs=2):
+		self.chromeDriverName = chromeDriverName
+		self.maxPages = maxPages
+		self.maxMemoryMB = maxMemoryMB
+		self.warmTabs = warmTabs
+		self.browser = None
+		self.tabs = []
+		self.currentTab = 0
+		self.pageCount = 0
+
+	# Returns a healthy browser, switched to an idle tab and ready to navigate
+	def getBrowser(self):
+		if self.browser is None or self.pageCount >= self.maxPages or self.memoryUsageMB() > self.maxMemoryMB or not self.isHealthy():
+			self.restart()
+
+		self.currentTab = (self.currentTab + 1) % len(self.tabs)
+		self.browser.switch_to.window(self.tabs[self.currentTab])
+		return self.browser
+
+	# Called once a page has been scraped. Counts the page towards the restart limit and stops the page from running.
+	def pageDone(self):
+		# The browser is gone if getBrowser failed to restart it
+		if self.browser is None:
+			return
+		self.pageCount += 1
+		try:
+			# With the "none" page load strategy this returns straight away
+			self.browser.execute_script("window.location.replace('about:blank');")
+		except WebDriverException:
+			pass # The health check will deal with it next time
+
+	def isHealthy(self):
+		try:
+			return self.browser.execute_script("return 1;") == 1
+		except WebDriverException:
+			return False
+
+	# Adds up the memory used by chromedriver and every chrome process it started
+	def memoryUsageMB(self):
+		try:
+			driverProcess = psutil.Process(self.browser.service.process.pid)
+			processes = [driverProcess] + driverProcess.children(recursive=True)
+			return sum(process.memory_info().rss for process in processes) / 1048576
+		except psutil.Error:
+			return 0 # The health check will notice if chrome has gone
+
+	def restart(self):
+		self.quit()
+		self.browser = createBrowser(self.chromeDriverName)
+		self.pageCount = 0
+
+		# The browser starts with one tab, open the rest
+		try:
+			self.tabs = [self.browser.current_window_handle]
+			self.blockResources()
+			for i in range(self.warmTabs - 1):
+				self.browser.execute_script("window.open('about:blank');")
+				self.tabs.append(self.browser.window_handles[-1])
+				self.browser.switch_to.window(self.tabs[-1])
+				self.blockResources()
+		except WebDriverException:
+			# Don't keep a half set up browser around, the next getBrowser starts again from scratch
+			self.quit()
+			raise
+
+	# CDP commands only apply to the tab that is currently selected, so this needs running in every tab
+	def blockResources(self):
+		self.browser.execute_cdp_cmd("Network.enable", {})
+		self.browser.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS})
+
+	def quit(self):
+		if self.browser is not None:
+			try:
+				self.browser.quit()
+			except WebDriverException:
+				pass # It has already crashed
+			self.browser = None
+
+# Stops all of the workers from scraping when the website is failing for everyone, instead of every worker burning
+# through the queue and pushing every number into backoff. After failureThreshold failures in a row (from any worker)
+# the breaker opens and no scrapes are allowed for cooldown seconds. After that, a single scrape is let through to
+# test the water - if it works the breaker closes again, if not it stays open for another cooldown.
+class CircuitBreaker():
+	def __init__(self, failureThreshold=5, cooldown=300):
+		self.failureThreshold = failureThreshold
+		self.cooldown = cooldown
+		self.consecutiveFailures = 0
+		self.openedAt = None # None means the breaker is closed
+		self.trialRunning = False
+		self.lock = Lock()
+
+	# Checks if a worker is allowed to scrape right now
+	def allowRequest(self):
+		with self.lock:
+			if self.openedAt is None:
+				return True
+			# Only one worker gets to run the trial scrape
+			if not self.trialRunning and time() - self.openedAt >= self.cooldown:
+				self.trialRunning = True
+				return True
+			return False
+
+	def recordSuccess(self):
+		with self.lock:
+			if self.openedAt is not None:
+				print("Scraping has recovered, closing the circuit breaker")
+			self.consecutiveFailures = 0
+			self.openedAt = None
+			self.trialRunning = False
+
+	def recordFailure(self):
+		with self.lock:
+			self.consecutiveFailures += 1
+			# A failed trial re-opens the breaker for another cooldown
+			if self.trialRunning or (self.openedAt is None and self.consecutiveFailures >= self.failureThreshold):
+				print("Scraping keeps failing, pausing it for " + str(self.cooldown) + " seconds")
+				self.openedAt = time()
+			self.trialRunning = False
+
+	# For when the worker got nowhere near the website, because the queue was empty or something else went wrong.
+	# That doesn't tell us anything about the website, so a trial ends without a result and another one is allowed
+	# after a fresh cooldown.
+	def recordInconclusive(self):
+		with self.lock:
+			if self.trialRunning:
+				self.openedAt = time()
+			self.trialRunning = False
+
+# Stops the workers from all hammering the same website at once. Each host gets its own semaphore,
+# so at most maxPerHost workers can be loading a page from that host at any one time.
+class UpstreamLimiter():
+	def __init__(self, maxPerHost):
+		self.maxPerHost = maxPerHost
+		self.semaphores = {}
+		self.lock = Lock()
+
+	# Returns the semaphore for the host of the passed URL. Use it in a with block around the page load.
+	def forURL(self, url):
+		host = urlparse(url).hostname
+		with self.lock:
+			if host not in self.semaphores:
+				self.semaphores[host] = BoundedSemaphore(self.maxPerHost)
+			return self.semaphores[host]
+
+# A single scraper. It runs on its own thread with its own backend (see backends.py), and keeps claiming and scraping
+# packages from the queue until it is stopped. Every worker has a unique ID which is used to lease queue rows.
+class ScraperWorker(Thread):
+	def __init__(self, packageHandler, backendFactory, upstreamLimiter, circuitBreaker, idleInterval):
+		super().__init__(daemon=True)
+		self.packageHandler = packageHandler
+		self.backendFactory = backendFactory
+		self.upstreamLimiter = upstreamLimiter
+		self.circuitBreaker = circuitBreaker
+		self.idleInterval = idleInterval
+		self.workerID = uuid4().hex
+		self.stopEvent = Event()
+		self.backend = None
+
+	def run(self):
+		# The backend is created on the worker's own thread, so a slow browser start doesn't hold up the others
+		self.backend = self.backendFactory()
+		while not self.stopEvent.is_set():
+			# While the website is down, don't scrape at all
+			if not self.circuitBreaker.allowRequest():
+				self.stopEvent.wait(self.idleInterval)
+				continue
+
+			try:
+				scraped = self.packageHandler.scrapeNextInQueue(self.backend, self.workerID, self.upstreamLimiter)
+				if scraped:
+					self.circuitBreaker.recordSuccess()
+				else:
+					self.circuitBreaker.recordInconclusive()
+			except ScrapeError as e:
+				# The failure has been recorded against the number, and it will be retried after a backoff
+				print("Scraper " + self.workerID + ": " + str(e))
+				self.circuitBreaker.recordFailure()
+				scraped = True # Still go straight on to the next number
+			except Exception as e:
+				# The lease on the queue row will run out, so another worker (or this one) will pick it up again later
+				print("Scraper " + self.workerID + " failed: " + repr(e))
+				self.circuitBreaker.recordInconclusive()
+				scraped = False
+
+			# If the queue was empty then there is no point hammering the db, so we wait a bit.
+			# Otherwise we go straight on to the next package.
+			if not scraped:
+				self.stopEvent.wait(self.idleInterval)
+
+		self.backend.close()
+
+	def stop(self):
+		self.stopEvent.set()
+
+# Holds all of the scraper workers. The number of workers and how many of them can hit the same
+# website at once are both configurable. backendFactory is called once by every worker to create its backend.
+class ScraperPool():
+	def __init__(self, packageHandler, backendFactory, workerCount, maxPerHost, idleInterval=5):
+		self.upstreamLimiter = UpstreamLimiter(maxPerHost)
+		# Shared by every worker, so failures from all of them count towards tripping it
+		self.circuitBreaker = CircuitBreaker()
+		self.workers = [ScraperWorker(packageHandler, backendFactory, self.upstreamLimiter, self.circuitBreaker, idleInterval) for i in range(workerCount)]
+
+	def start(self):
+		for worker in self.workers:
+			worker.start()
+
+	# Waits for the workers to finish what they are scraping, so that every backend gets closed (and no browsers are left behind)
+	def stop(self, timeout=60):
+		for worker in self.workers:
+			worker.stop()
+		for worker in self.workers:
+			worker.join(timeout)
@@ -70,76 +70,324 @@ function handleModalSubmit(modalName) {
 }
 
 function removePackageFromList(id) {
-	// First, remove it from the list
+	// First, remove it from the list (and the cache)
 	$("#packageListAccordionItem-" + id).remove();
+	sessionStorage.removeItem("packageData-" + id);
 	// If there are no more packages, then we need to add the default prompt
 	if($("#packageListAccordion").children().length == 0)
 		$("#main-container").append("<h6>You are not tracking any packages. Add one!</h6>");
 }
 
+// Package data that has been loaded is kept in sessionStorage, so it is still there when the page reloads. Each package
+// is stored with the last_updated it had when it was loaded, and its ETag. The page tells us the current last_updated of
+// every package, so if they don't match then the package has been scraped since and the stored data can't be used
+// without asking the backend first (see fetchSinglePackageData).
+function getStoredPackageData(packageID) {
+	let stored = sessionStorage.getItem("packageData-" + packageID);
+	return stored ? JSON.parse(stored) : undefined;
+}
+
+function getPageLastUpdated(packageID) {
+	return parseFloat($("#packageListAccordionItem-" + packageID).attr("data-last-updated"));
+}
+
+// Returns the stored data of the package, as long as it is still up to date
+function getCachedPackageData(packageID) {
+	let stored = getStoredPackageData(packageID);
+	if(!stored || stored["lastUpdated"] !== getPageLastUpdated(packageID))
+		return undefined;
+	return stored["packageData"];
+}
+
+function cachePackageData(packageID, lastUpdated, etag, packageData) {
+	try {
+		sessionStorage.setItem("packageData-" + packageID, JSON.stringify({lastUpdated: lastUpdated, etag: etag, packageData: packageData}));
+	}
+	catch(e) {
+		// Storage is full - it just wont be cached
+	}
+}
+
+// Package IDs that have a request on the way, mapped to the functions waiting for their data
+let waitingForData = {};
+// The most packages the backend will send in one request
+const MAX_BATCH_SIZE = 100;
+
+// Loads the data of all of the passed packages from the backend in a single request. Everything waiting for them is
+// called with the data when it arrives, or with undefined if it couldn't be loaded.
+function fetchPackageData(packageIDs) {
+	packageIDs.forEach(packageID => waitingForData[packageID] = waitingForData[packageID] || []);
+
+	var xhttp = new XMLHttpRequest();
+	xhttp.onreadystatechange = () => {
+		// State = 4 means request has completed
+		if (xhttp.readyState == 4) {
+			let packages = {};
+			if(xhttp.status == 200) {
+				let response = JSON.parse(xhttp.responseText);
+				if(response["success"] == true)
+					packages = response["packages"];
+			}
+
+			packageIDs.forEach(packageID => {
+				let loaded = packages[packageID];
+				if(loaded)
+					cachePackageData(packageID, loaded["lastUpdated"], loaded["etag"], loaded["packageData"]);
+
+				let callbacks = waitingForData[packageID];
+				delete waitingForData[packageID];
+				callbacks.forEach(callback => callback(loaded ? loaded["packageData"] : undefined));
+			});
+		}
+	}
+
+	xhttp.open("POST", "packageDataBatch", true);
+	xhttp.setRequestHeader("Content-type", "application/x-www-form-urlencoded");
+	xhttp.send("packageIDs=" + encodeURIComponent(packageIDs.join(",")));
+}
+
+// Loads the data of a single package. If we have stored data for it that might be out of date, its ETag is sent along
+// and the backend answers with an empty 304 if it hasn't changed. Most scrapes don't find anything new, so the stored
+// data can usually be kept.
+function fetchSinglePackageData(packageID) {
+	waitingForData[packageID] = waitingForData[packageID] || [];
+	let stored = getStoredPackageData(packageID);
+
+	var xhttp = new XMLHttpRequest();
+	xhttp.onreadystatechange = () => {
+		// State = 4 means request has completed
+		if (xhttp.readyState == 4) {
+			let packageData = undefined;
+			let etag = undefined;
+			if(xhttp.status == 304 && stored) {
+				packageData = stored["packageData"];
+				etag = stored["etag"];
+			}
+			else if(xhttp.status == 200) {
+				packageData = JSON.parse(xhttp.responseText);
+				etag = (xhttp.getResponseHeader("ETag") || "").replace(/"/g, "");
+			}
+			if(packageData && packageData["success"] == true)
+				cachePackageData(packageID, getPageLastUpdated(packageID), etag, packageData);
+
+			let callbacks = waitingForData[packageID];
+			delete waitingForData[packageID];
+			callbacks.forEach(callback => callback(packageData));
+		}
+	}
+
+	xhttp.open("GET", "packageData?packageID=" + encodeURIComponent(packageID) + "&lastUpdated=" + encodeURIComponent(getPageLastUpdated(packageID) || 0), true);
+	if(stored && stored["etag"])
+		xhttp.setRequestHeader("If-None-Match", '"' + stored["etag"] + '"');
+	xhttp.send();
+}
+
+// Calls callback with the data of the package, straight away if it is cached or once it has been loaded
+function whenPackageDataLoaded(packageID, callback) {
+	let cached = getCachedPackageData(packageID);
+	if(cached)
+		return callback(cached);
+
+	// If it is already being loaded (like by the prefetch) then we just wait for that
+	if(!(packageID in waitingForData))
+		fetchSinglePackageData(packageID);
+	waitingForData[packageID].push(callback);
+}
+
+// Loads the data of every package on the page in the background, so it is already there when the user opens them
+function prefetchPackageData() {
+	let packageIDs = $(".accordion-item").map((i, item) => item.id.split("-")[1]).get();
+	packageIDs = packageIDs.filter(packageID => !(packageID in waitingForData) && !getCachedPackageData(packageID));
+	for(let i = 0; i < packageIDs.length; i += MAX_BATCH_SIZE)
+		fetchPackageData(packageIDs.slice(i, i + MAX_BATCH_SIZE));
+}
+
+// The event descriptions come from another website, so they need escaping before they go anywhere near the html
+function escapeHTML(text) {
+	return $("<div>").text(text).html();
+}
+
 // This function is the logic for the accordion. It is called when the accordion expands.
-// It does the UI stuff and loads the package data from the backend.
+// It does the UI stuff and gets the package data, from the cache if we have it or from the backend if we don't.
 function accordionExpanding(packageID) {
 	// Show a loading icon
 	$("#accordion-body-" + packageID).append('<div class="spinner-border text-primary" id="' + packageID + '-loadingSpinner" role="status"><span class="visually-hidden">Loading...</span></div>');
-	
-	// This will send the request to the flask endpoint
+
+	whenPackageDataLoaded(packageID, packageData => showPackageData(packageID, packageData));
+}
+
+// Puts the package's events into its accordion body, replacing whatever was there
+function showPackageData(packageID, packageData) {
+	// The user might have closed it again while we were waiting
+	if(!$("#collapse-" + packageID).hasClass("show"))
+		return;
+
+	let html;
+	// If it failed then we show a neat little information thing that will be hidden when the accordion collapses
+	if(!packageData || packageData["success"] != true) {
+		html = "<p class='text-danger'>Something went wrong. Please try again.</p>";
+	}
+	else if(packageData["data"].length < 2) {
+		html = "<ul class='list-group'><li class='list-group-item' style='border: 1px solid black; margin-bottom: 5px;'>There is no tracking data for this package yet. It will show up here as soon as we have some.</li></ul>";
+	}
+	// If there is tracking data, then we build the whole list and add it in one go, rather than one event at a time.
+	// Slice at 1 to remove my metadata that I added to my SQL query
+	else {
+		html = "<ul class='list-group'>" + packageData["data"].slice(1).map(data => `
+			<li class="list-group-item" style="border: 1px solid black; margin-bottom: 5px;">
+				<p class="fst-italic" style="margin-bottom: 5px;">${escapeHTML(data["date"])}</p>
+				${data["time"] ? `<span class="badge rounded-pill bg-primary">${escapeHTML(data["time"])}</span>` : ""}
+				<p style="margin-top: 5px;">${escapeHTML(data["data"])}</p>
+			</li>
+		`).join("") + "</ul>";
+	}
+
+	// Replaces the spinner too
+	$("#accordion-body-" + packageID).html(html);
+}
+
+// Called when the backend tells us (through the packageUpdates stream) that one of the user's packages has new data.
+// The package's newest event is updated straight away, and if it is open then its events are reloaded in place.
+function packageUpdated(update) {
+	let packageID = update["packageID"];
+	let item = $("#packageListAccordionItem-" + packageID);
+	// It might be on a page that hasn't been loaded yet
+	if(item.length == 0)
+		return;
+
+	// The stored data no longer matches, so it gets checked with the backend the next time it is needed
+	item.attr("data-last-updated", update["lastUpdated"]);
+
+	let latestEvent = $("#packageLatestEvent-" + packageID);
+	if(update["latestEvent"]) {
+		latestEvent.html(`<span class="fst-italic">${escapeHTML(update["latestEventDate"])} ${escapeHTML(update["latestEventTime"])}</span> - ${escapeHTML(update["latestEvent"])}`);
+		latestEvent.removeClass("d-none");
+	}
+	else {
+		latestEvent.html("");
+		latestEvent.addClass("d-none");
+	}
+
+	if($("#collapse-" + packageID).hasClass("show"))
+		whenPackageDataLoaded(packageID, packageData => showPackageData(packageID, packageData));
+}
+
+// How often the page checks for updates when it can't have an update stream, in milliseconds
+const UPDATE_POLL_INTERVAL = 30000;
+// The after value from the last poll, which the next one asks for the updates since
+let lastUpdateID = undefined;
+
+// Listens to the packageUpdates stream. The browser reconnects by itself if the connection drops. If the backend turns
+// the stream away (the user has too many pages open, or the server has too many streams) then it is closed for good,
+// and the page polls for updates instead.
+function listenForUpdates() {
+	if(!window.EventSource)
+		return pollForUpdates();
+
+	let updates = new EventSource("packageUpdates");
+	updates.addEventListener("packageUpdated", e => packageUpdated(JSON.parse(e.data)));
+	updates.onerror = () => {
+		if(updates.readyState == EventSource.CLOSED)
+			pollForUpdates();
+	};
+}
+
+function pollForUpdates() {
 	var xhttp = new XMLHttpRequest();
 	xhttp.onreadystatechange = () => {
 		// State = 4 means request has completed
 		if (xhttp.readyState == 4) {
-			// Hide spinner
-			$("#accordion-body-" + packageID).find("#" + packageID + "-loadingSpinner").remove();
+			if(xhttp.status == 200) {
+				let response = JSON.parse(xhttp.responseText);
+				// They have been logged out, so there is nothing to poll for
+				if(response["success"] != true)
+					return;
+				lastUpdateID = response["after"];
+				response["updates"].forEach(packageUpdated);
+			}
+			setTimeout(pollForUpdates, UPDATE_POLL_INTERVAL);
+		}
+	}
 
-			let packageData = undefined;
+	xhttp.open("GET", "packageUpdatesSince" + (lastUpdateID !== undefined ? "?after=" + lastUpdateID : ""), true);
+	xhttp.send();
+}
+
+// Set while the next page of packages is being loaded, so scrolling doesn't ask for the same page twice
+let loadingPage = false;
+// Watches the bottom of the list for infinite scroll
+let pageObserver = undefined;
+
+// Loads the next page of the package list and adds it to the bottom of the accordion
+function loadNextPage() {
+	let loadMore = $("#packageList-loadMore");
+	if(loadingPage || loadMore.length == 0)
+		return;
+	loadingPage = true;
+	loadMore.html('<div class="spinner-border text-primary" role="status"><span class="visually-hidden">Loading...</span></div>');
+
+	var xhttp = new XMLHttpRequest();
+	xhttp.onreadystatechange = () => {
+		// State = 4 means request has completed
+		if (xhttp.readyState == 4) {
+			loadingPage = false;
+			let page = undefined;
 			if(xhttp.status == 200)
-				packageData = JSON.parse(xhttp.responseText);
+				page = JSON.parse(xhttp.responseText);
 
-			// Only accept if there was both a succesfull response (200) and the backend didnt give us an error
-			if(packageData && packageData["success"] == true) {
-				$("#accordion-body-" + packageID).append("<ul class='list-group'></ul>");
-			
-				if(packageData["data"].length < 2) {
-					$("#accordion-body-" + packageID + " > ul").append("<li class='list-group-item' style='border: 1px solid black; margin-bottom: 5px;'>There is no tracking data for this package yet. Please try again in a few minutes.</li>");
-				}
-				// If there is tracking data, then we add it to the <ul>
-				// Slice at 1 to remove my metadata that I added to my SQL query
+			if(page && page["success"] == true) {
+				$("#packageListAccordion").append(page["html"]);
+				// Keep going until there are no pages left
+				if(page["before"] === null)
+					loadMore.remove();
 				else {
-					packageData["data"].slice(1).forEach(data => {
-						// Had to move this here from the jinja template to make it doable
-						$("#accordion-body-" + packageID + " > ul").append(`
-						<li class="list-group-item" style="border: 1px solid black; margin-bottom: 5px;">
-							<p class="fst-italic" style="margin-bottom: 5px;">${data["date"]}</p>
-							<span class="badge rounded-pill bg-primary">${data["time"]}</span>
-							<p style="margin-top: 5px;">${data["data"]}</p>
-						</li>
-						`);
-					});
+					loadMore.attr("data-before", page["before"]);
+					loadMore.html("");
+					// Observing again makes the observer check straight away, so if the bottom of the list is still in
+					// view then the next page is loaded too
+					pageObserver.unobserve(loadMore[0]);
+					pageObserver.observe(loadMore[0]);
 				}
+				prefetchPackageData();
 			}
-			// If it failed then we show a neat little information thing that will be hidden when the accordion collapses
 			else {
-				$("#accordion-body-" + packageID).append("<p class='text-danger'>Something went wrong. Please try again.</p>");
+				loadMore.html("<p class='text-danger'>Couldn't load more packages. Please try again.</p>");
 			}
 		}
 	}
 
-	//Yeet
-	xhttp.open("POST", "packageData", true);
-	xhttp.setRequestHeader("Content-type", "application/x-www-form-urlencoded");
-	xhttp.send("packageID=" + encodeURIComponent(packageID));
+	xhttp.open("GET", "packageListPage?before=" + encodeURIComponent(loadMore.attr("data-before")), true);
+	xhttp.send();
 }
 
 // Need to register events for accordion expansion and collapse
 $(document).ready(() => {
+	// The events are registered on the accordion rather than each item, so they work for items that are loaded later
 	// Accordion is collapsing - remove all data and error labels
-	$(".accordion-item").on("hidden.bs.collapse", e => {
+	$("#packageListAccordion").on("hidden.bs.collapse", ".accordion-item", e => {
 		let packageID = e.currentTarget.id.split("-")[1];
 		$("#accordion-body-" + packageID).children().remove("*");
 	});
 
-	$(".accordion-item").on("shown.bs.collapse", e => {
+	$("#packageListAccordion").on("shown.bs.collapse", ".accordion-item", e => {
 		let packageID = e.currentTarget.id.split("-")[1];
 		accordionExpanding(packageID);
 	});
+
+	// Infinite scroll - load the next page whenever the bottom of the list comes into view
+	let loadMore = document.getElementById("packageList-loadMore");
+	if(loadMore) {
+		pageObserver = new IntersectionObserver(entries => {
+			if(entries[0].isIntersecting)
+				loadNextPage();
+		}, {rootMargin: "500px"});
+		pageObserver.observe(loadMore);
+	}
+
+	// Listen for packages being updated while the page is open
+	if($("#packageListAccordion").length > 0)
+		listenForUpdates();
+
+	// Start loading everything once the page has finished loading
+	setTimeout(prefetchPackageData, 0);
 });
\ No newline at end of file
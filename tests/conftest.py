@@ -0,0 +1,49 @@
+import sqlite3
+from os import path
+
+import pytest
+
+from connections import ConnectionManager
+from database.migrate import migrate
+from emails import EmailHandler
+from packages import PackageHandler
+
+ROOT_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+
+# Creates a database at dbPath from the schema file, without any of the migrations. This is what a database from before
+# the migrations looks like.
+def createBaselineDatabase(dbPath):
+	with sqlite3.connect(dbPath) as con:
+		with open(path.join(ROOT_DIR, "database", "database_schema.sql")) as schemaFile:
+			con.executescript(schemaFile.read())
+	con.close()
+	return dbPath
+
+# A database from before the migrations, which haven't been run on it yet
+@pytest.fixture
+def baselineDBPath(tmp_path):
+	return createBaselineDatabase(str(tmp_path / "baseline.db"))
+
+# An empty database at the latest version, built the same way dbCreator does
+@pytest.fixture
+def dbPath(tmp_path):
+	dbPath = createBaselineDatabase(str(tmp_path / "database.db"))
+	migrate(dbPath)
+	return dbPath
+
+# This thread's connections to the test database, closed again afterwards
+@pytest.fixture
+def connections(dbPath):
+	connections = ConnectionManager(dbPath)
+	yield connections
+	connections.closeConnection()
+
+# A PackageHandler on the test database, which has two users (ids 1 and 2) and nothing else. Emails only go as far as
+# the outbox, nothing sends them.
+@pytest.fixture
+def packageHandler(connections, dbPath, monkeypatch):
+	monkeypatch.setenv("EMAIL_ADDRESS", "tracker@example.com")
+	with sqlite3.connect(dbPath) as con:
+		con.executemany("INSERT INTO users (email, password) VALUES (?, '')", [["a@example.com"], ["b@example.com"]])
+	con.close()
+	return PackageHandler(connections, EmailHandler(connections))
@@ -0,0 +1,151 @@
+import sqlite3
+from json import loads
+from threading import Thread
+
+import pytest
+from selenium.common.exceptions import WebDriverException
+
+import scraper
+from backends import SeleniumBackend, HTTPBackend, ParcelsAppAPIBackend, createBackend, API_URL
+from errors import FetchError, ScrapeError
+from fixtures.fakeTrackingSite import createServer, PATH_PREFIX, API_PATH
+from parsing import NO_INFORMATION_MESSAGE
+from scraper import UpstreamLimiter
+
+def test_browser_restart_failure_is_a_fetch_error(monkeypatch):
+	def createBrowser(chromeDriverName):
+		raise WebDriverException("chromedriver crashed")
+	monkeypatch.setattr(scraper, "createBrowser", createBrowser)
+
+	backend = SeleniumBackend("chromedriver", 1)
+	with pytest.raises(FetchError):
+		backend.fetchEvents(backend.urlFor("1Z999"))
+	assert backend.browserManager.browser is None
+
+# The fake tracking site, on a free port
+@pytest.fixture
+def trackingSite():
+	server = createServer(port=0)
+	Thread(target=server.serve_forever, daemon=True).start()
+	yield "http://127.0.0.1:" + str(server.server_address[1]) + PATH_PREFIX
+	server.shutdown()
+	server.server_close()
+
+# Adds a package for the number and returns its id
+def addPackage(packageHandler, trackingNumber):
+	assert packageHandler.createNewPackage(trackingNumber, 1) == "added"
+	return packageHandler.getListOfPackages(1)[0][0]["id"]
+
+def getEvents(packageHandler, packageID):
+	return loads(packageHandler.getPackageData(packageID, 1)[1])["data"][1:]
+
+def getQueueRow(dbPath):
+	with sqlite3.connect(dbPath) as con:
+		row = con.execute("SELECT attempts, claimed_by, last_error FROM queue").fetchone()
+	con.close()
+	return row
+
+def test_http_backend_scrape(trackingSite, packageHandler, dbPath):
+	packageID = addPackage(packageHandler, "TEST12345678")
+	backend = HTTPBackend(10, trackingSite)
+	try:
+		assert packageHandler.scrapeNextInQueue(backend, "worker", UpstreamLimiter(1))
+	finally:
+		backend.close()
+
+	events = getEvents(packageHandler, packageID)
+	assert len(events) > 0
+	assert getQueueRow(dbPath) is None
+	package = packageHandler.getListOfPackages(1)[0][0]
+	assert package["latest_event"] == events[0]["data"]
+
+def test_http_backend_server_error(trackingSite, packageHandler, dbPath):
+	addPackage(packageHandler, "FAIL12345678")
+	backend = HTTPBackend(10, trackingSite)
+	try:
+		with pytest.raises(ScrapeError) as error:
+			packageHandler.scrapeNextInQueue(backend, "worker", UpstreamLimiter(1))
+	finally:
+		backend.close()
+
+	assert isinstance(error.value.__cause__, FetchError)
+	attempts, claimedBy, lastError = getQueueRow(dbPath)
+	assert attempts == 1
+	assert claimedBy is None
+	assert "500" in lastError
+
+def test_http_backend_refuses_parcelsapp():
+	with pytest.raises(ValueError):
+		createBackend("http", None, 10)
+
+# The fake tracking site's stand-in for parcelsapp's tracking API
+@pytest.fixture
+def trackingAPI(trackingSite, monkeypatch):
+	monkeypatch.setattr(ParcelsAppAPIBackend, "POLL_INTERVAL", 0)
+	return trackingSite[:-len(PATH_PREFIX)] + API_PATH
+
+def scrapeWith(packageHandler, backend):
+	try:
+		return packageHandler.scrapeNextInQueue(backend, "worker", UpstreamLimiter(1))
+	finally:
+		backend.close()
+
+# The API has the same events as the page
+def test_api_backend_scrape(trackingSite, trackingAPI, packageHandler, dbPath):
+	pagePackageID = addPackage(packageHandler, "TEST12345678")
+	assert scrapeWith(packageHandler, HTTPBackend(10, trackingSite))
+	apiPackageID = addPackage(packageHandler, "TEST87654321")
+	assert scrapeWith(packageHandler, ParcelsAppAPIBackend(10, trackingAPI, "key"))
+
+	withoutIDs = lambda events: [(event["date"], event["time"], event["data"]) for event in events]
+	assert withoutIDs(getEvents(packageHandler, apiPackageID)) == withoutIDs(getEvents(packageHandler, pagePackageID))
+	assert getQueueRow(dbPath) is None
+
+def test_api_backend_no_information(trackingAPI, packageHandler):
+	packageID = addPackage(packageHandler, "NOINFO12345678")
+	assert scrapeWith(packageHandler, ParcelsAppAPIBackend(10, trackingAPI, "key"))
+	assert [event["data"] for event in getEvents(packageHandler, packageID)] == [NO_INFORMATION_MESSAGE]
+
+def test_api_backend_server_error(trackingAPI, packageHandler, dbPath):
+	addPackage(packageHandler, "FAIL12345678")
+	with pytest.raises(ScrapeError) as error:
+		scrapeWith(packageHandler, ParcelsAppAPIBackend(10, trackingAPI, "key"))
+	assert isinstance(error.value.__cause__, FetchError)
+	assert "500" in getQueueRow(dbPath)[2]
+
+def test_api_backend_needs_key():
+	with pytest.raises(ValueError):
+		createBackend("api", None, 10)
+	backend = createBackend("api", None, 10, apiKey="key")
+	assert isinstance(backend, ParcelsAppAPIBackend)
+	assert backend.trackingURL == API_URL
+	backend.close()
+
+class EmptyPageBackend():
+	def __init__(self, trackingURL):
+		self.trackingURL = trackingURL
+
+	def urlFor(self, trackingNumber):
+		return self.trackingURL + trackingNumber
+
+	def fetchEvents(self, url):
+		return []
+
+# A page that comes back without any events must not wipe out the events we already have
+def test_empty_page_keeps_events(trackingSite, packageHandler, dbPath):
+	packageID = addPackage(packageHandler, "TEST12345678")
+	backend = HTTPBackend(10, trackingSite)
+	try:
+		packageHandler.scrapeNextInQueue(backend, "worker", UpstreamLimiter(1))
+	finally:
+		backend.close()
+	events = getEvents(packageHandler, packageID)
+
+	with sqlite3.connect(dbPath) as con:
+		con.execute("INSERT INTO queue (tracking_number_id) SELECT id FROM tracking_numbers")
+	con.close()
+	with pytest.raises(ScrapeError):
+		packageHandler.scrapeNextInQueue(EmptyPageBackend(trackingSite), "worker", UpstreamLimiter(1))
+
+	assert getEvents(packageHandler, packageID) == events
+	assert packageHandler.getListOfPackages(1)[0][0]["latest_event"] == events[0]["data"]
@@ -0,0 +1,49 @@
+import pytest
+
+from carriers import detectCarrier, isPossibleTrackingNumber
+
+# A number with the right check digit (or the right length) for every format
+@pytest.mark.parametrize("trackingNumber, carrier", [
+	("1Z999AA10123456784", "UPS"),
+	("RR123456785NZ", "NZ Post"),
+	("LB123456785CN", "China Post"),
+	("9200100000000000000008", "USPS"),
+	("420123459200100000000000000008", "USPS"),
+	("TBA123456789012", "Amazon Logistics"),
+	("LP12345678901234", "Cainiao"),
+	("YT1234567890123456", "YunExpress"),
+	("GM1234567890123456", "DHL eCommerce"),
+	("123456789012", "FedEx"),
+	("9612345678901234567897", "FedEx"),
+	("1234567891", "DHL Express"),
+])
+def test_valid_number(trackingNumber, carrier):
+	assert isPossibleTrackingNumber(trackingNumber)
+	assert detectCarrier(trackingNumber) == (carrier, False)
+
+# The same numbers with the check digit changed, or the wrong length for formats without one
+@pytest.mark.parametrize("trackingNumber, result", [
+	("1Z999AA10123456785", ("UPS", True)),
+	("RR123456784NZ", ("NZ Post", True)),
+	("9200100000000000000009", ("USPS", True)),
+	("TBA12345678901", (None, False)),
+	("LP1234567890123", (None, False)),
+	("YT123456789012345", (None, False)),
+	("GM123456789012345", (None, False)),
+	# Lots of other couriers use plain digits, so these are just unknown rather than malformed
+	("123456789013", (None, False)),
+	("9612345678901234567898", (None, False)),
+	("1234567892", (None, False)),
+])
+def test_invalid_number(trackingNumber, result):
+	assert detectCarrier(trackingNumber) == result
+
+def test_dashes_are_ignored():
+	assert detectCarrier("1Z-999-AA1-0123456784") == ("UPS", False)
+
+def test_possible_tracking_numbers():
+	assert isPossibleTrackingNumber("AB-1234")
+	assert not isPossibleTrackingNumber("------")
+	assert not isPossibleTrackingNumber("12345")
+	assert not isPossibleTrackingNumber("A" * 41)
+	assert not isPossibleTrackingNumber("1Z999AA1 0123456784")
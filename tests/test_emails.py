@@ -0,0 +1,84 @@
+import socket
+import sqlite3
+from email import message_from_bytes
+from os import path
+
+import pytest
+from aiosmtpd.controller import Controller
+
+from connections import ConnectionManager
+from emails import EmailHandler
+
+ROOT_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+
+# The controller checks that its server started by connecting to it, so it needs to be told a real port
+def freePort():
+	with socket.socket() as freeSocket:
+		freeSocket.bind(("127.0.0.1", 0))
+		return freeSocket.getsockname()[1]
+
+# Keeps every email the local SMTP server receives
+class ReceivedEmails():
+	def __init__(self):
+		self.emails = []
+
+	async def handle_DATA(self, server, session, envelope):
+		self.emails.append(envelope)
+		return "250 Message accepted for delivery"
+
+@pytest.fixture
+def smtpServer():
+	received = ReceivedEmails()
+	controller = Controller(received, hostname="127.0.0.1", port=freePort())
+	controller.start()
+	yield controller, received
+	controller.stop()
+
+@pytest.fixture
+def emailHandler(dbPath, smtpServer, monkeypatch):
+	controller, received = smtpServer
+	monkeypatch.chdir(ROOT_DIR) # The email templates are found from the root of the project
+	monkeypatch.setenv("EMAIL_ADDRESS", "tracker@example.com")
+	monkeypatch.setenv("SMTP_HOST", "127.0.0.1")
+	monkeypatch.setenv("SMTP_PORT", str(controller.port))
+	monkeypatch.setenv("SMTP_SSL", "0")
+	monkeypatch.delenv("EMAIL_PASSWORD", raising=False)
+	connections = ConnectionManager(dbPath)
+	emailHandler = EmailHandler(connections)
+	yield emailHandler
+	emailHandler.disconnect()
+	connections.closeConnection()
+
+def outboxRows(dbPath):
+	con = sqlite3.connect(dbPath)
+	rows = con.execute("SELECT recipient, status, attempts FROM email_outbox").fetchall()
+	con.close()
+	return rows
+
+def test_queued_email_is_sent(dbPath, emailHandler, smtpServer):
+	controller, received = smtpServer
+	emailHandler.sendPasswordResetEmail("someone@example.com", "abc123")
+	assert outboxRows(dbPath) == [("someone@example.com", "pending", 0)]
+
+	# One pass of the background sender
+	assert emailHandler.sendQueuedEmails() == 1
+
+	assert len(received.emails) == 1
+	envelope = received.emails[0]
+	assert envelope.mail_from == "tracker@example.com"
+	assert envelope.rcpt_tos == ["someone@example.com"]
+	message = message_from_bytes(envelope.content)
+	assert message["Subject"] == "Password reset request"
+	assert "abc123" in message.get_payload()[0].get_payload(decode=True).decode("utf-8")
+	# Sent emails are taken out of the outbox
+	assert outboxRows(dbPath) == []
+
+def test_failed_email_is_retried_later(dbPath, emailHandler):
+	emailHandler.sendVerificationEmail("someone@example.com", "abc123")
+	# Nothing is listening on this port
+	emailHandler.smtpPort = freePort()
+
+	assert emailHandler.sendQueuedEmails() == 1
+	assert outboxRows(dbPath) == [("someone@example.com", "pending", 1)]
+	# It isn't tried again until its backoff is over
+	assert emailHandler.sendQueuedEmails() == 0
@@ -0,0 +1,56 @@
+import sqlite3
+from io import BytesIO
+from json import loads
+from re import search
+
+import pytest
+
+from main import create_app
+from packages import PackageHandler
+
+# Logged in as user 1 from the packageHandler fixture
+@pytest.fixture
+def client(dbPath, packageHandler, monkeypatch):
+	monkeypatch.setenv("FLASK_KEY", "test")
+	app = create_app(dbPath)
+	client = app.test_client()
+	with client.session_transaction() as session:
+		session["userID"] = 1
+	yield client
+	if app.handlers.connections is not None:
+		app.handlers.updateRelay.stop()
+
+# The CSRF token from the add package form on the package list
+@pytest.fixture
+def csrfToken(client):
+	return search(r'name="csrf_token" type="hidden" value="([^"]+)"', client.get("/packageList").get_data(as_text=True)).group(1)
+
+def importText(client, text, headers):
+	return loads(client.post("/importPackages", data=text, content_type="text/plain", headers=headers).data)
+
+def test_import_text(client, csrfToken):
+	response = importText(client, "Tracking number\n1Z999AA10123456784\n\nLB123456785CN\n1Z999AA10123456784\n", {"X-CSRFToken": csrfToken})
+	assert response["success"] and not response["truncated"]
+	assert [(result["line"], result["result"]) for result in response["results"]] == [(2, "added"), (4, "added"), (5, "repeated")]
+
+def test_import_file(client, csrfToken):
+	upload = (BytesIO(b"\xef\xbb\xbf1Z999AA10123456784,Example shop\n"), "orders.csv")
+	response = loads(client.post("/importPackages", data={"file": upload, "csrf_token": csrfToken}, content_type="multipart/form-data").data)
+	assert response["success"]
+	assert [(result["trackingNumber"], result["result"]) for result in response["results"]] == [("1Z999AA10123456784", "added")]
+
+def test_import_is_truncated(client, csrfToken, monkeypatch):
+	monkeypatch.setattr(PackageHandler, "MAX_IMPORT_SIZE", 3)
+	response = importText(client, "".join("TEST" + str(i).zfill(8) + "\n" for i in range(5)), {"X-CSRFToken": csrfToken})
+	assert response["success"] and response["truncated"]
+	assert [result["trackingNumber"] for result in response["results"]] == ["TEST00000000", "TEST00000001", "TEST00000002"]
+
+# Another website can post a plain text form for a logged in user, but it can't get their token
+def test_import_needs_csrf_token(client, csrfToken, dbPath):
+	assert importText(client, "1Z999AA10123456784\n", {}) == {"success": False}
+	assert importText(client, "1Z999AA10123456784\n", {"X-CSRFToken": "wrong"}) == {"success": False}
+	upload = (BytesIO(b"1Z999AA10123456784\n"), "orders.csv")
+	assert loads(client.post("/importPackages", data={"file": upload}, content_type="multipart/form-data").data) == {"success": False}
+	con = sqlite3.connect(dbPath)
+	assert con.execute("SELECT COUNT(*) FROM packages").fetchone() == (0,)
+	con.close()
@@ -0,0 +1,78 @@
+import sqlite3
+
+from database.migrate import migrate, latestVersion
+from main import create_app
+
+# A database from before the migrations, with two users tracking the same number (written differently), events that
+# were stored twice, a queued package and an event left behind by a deleted package
+def fillBaselineDatabase(con):
+	con.execute("INSERT INTO users (id, email, password) VALUES (1, 'a@example.com', 'x'), (2, 'b@example.com', 'x')")
+	con.execute("INSERT INTO packages (id, title, trackingNumber, user_id, last_updated, last_new_data, email_sent) VALUES (1, 'Shoes', '1z 999aa1', 1, 100, 50, 0), (2, NULL, '1Z999AA1', 2, 200, 60, 1), (3, NULL, 'RR123', 1, 0, 70, 0)")
+	# Deleted packages used ids 4 and 5
+	con.execute("UPDATE sqlite_sequence SET seq = 5 WHERE name = 'packages'")
+	events = [
+		(1, "Mon 12 Apr 2021", "10:47 PM", "Arrived at destination country"),
+		(1, "Wed 14 Apr 2021", "09:12 AM", "Arrived at local delivery depot"),
+		(1, "Wed 14 Apr 2021", "09:12 AM", "Arrived at local delivery depot"),
+		(2, "Mon 12 Apr 2021", "10:47 PM", "Arrived at destination country"),
+		(2, "Wed 14 Apr 2021", "09:12 AM", "Arrived at local delivery depot"),
+		(2, "Thu 15 Apr 2021", "01:58 PM", "Delivered"),
+		(4, "Thu 15 Apr 2021", "01:58 PM", "Delivered"),
+	]
+	con.executemany("INSERT INTO package_data (package_id, date, time, data) VALUES (?, ?, ?, ?)", events)
+	con.execute("INSERT INTO queue (package_id, priority) VALUES (3, 1), (1, 0), (2, 1), (5, 0)")
+	con.commit()
+
+def test_baseline_database_is_upgraded(baselineDBPath):
+	dbPath = baselineDBPath
+	con = sqlite3.connect(dbPath)
+	fillBaselineDatabase(con)
+
+	assert migrate(dbPath) == latestVersion()
+
+	# Both ways of writing the first number are one tracking number, last updated when the newest of them was
+	numbers = con.execute("SELECT id, number, last_updated, last_new_data FROM tracking_numbers ORDER BY id").fetchall()
+	assert numbers == [(1, "1Z999AA1", 200, 60), (2, "RR123", 0, 70)]
+	packages = con.execute("SELECT id, title, trackingNumber, tracking_number_id, user_id, email_sent FROM packages ORDER BY id").fetchall()
+	assert packages == [(1, "Shoes", "1Z999AA1", 1, 1, 0), (2, None, "1Z999AA1", 1, 2, 1), (3, None, "RR123", 2, 1, 0)]
+	# A new package doesn't get the id of a deleted one
+	con.execute("INSERT INTO packages (trackingNumber, tracking_number_id, user_id, last_new_data) VALUES ('RR123', 2, 2, 0)")
+	assert con.execute("SELECT MAX(id) FROM packages").fetchone()[0] == 6
+
+	# The events of both packages are merged, each event once. The deleted package's event is gone.
+	events = con.execute("SELECT tracking_number_id, data FROM package_data ORDER BY id").fetchall()
+	assert events == [(1, "Arrived at destination country"), (1, "Arrived at local delivery depot"), (1, "Delivered")]
+	assert con.execute("SELECT COUNT(*) FROM package_data WHERE event_ts IS NULL OR fingerprint = ''").fetchone()[0] == 0
+	# The newest event is copied onto both packages
+	assert con.execute("SELECT latest_event FROM packages WHERE tracking_number_id = 1").fetchall() == [("Delivered",), ("Delivered",)]
+
+	# Each number is queued once, at the highest priority any of its packages had
+	queue = con.execute("SELECT tracking_number_id, priority FROM queue ORDER BY tracking_number_id").fetchall()
+	assert queue == [(1, 1), (2, 1)]
+	con.close()
+
+def test_upgraded_database_matches_new_one(baselineDBPath, dbPath):
+	con = sqlite3.connect(baselineDBPath)
+	fillBaselineDatabase(con)
+	con.close()
+	migrate(baselineDBPath)
+
+	def describeSchema(path):
+		con = sqlite3.connect(path)
+		tables = {name: con.execute("PRAGMA table_info('" + name + "')").fetchall() for name, in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+		indexes = con.execute("SELECT name, tbl_name FROM sqlite_master WHERE type = 'index' ORDER BY name").fetchall()
+		con.close()
+		return tables, indexes
+
+	assert describeSchema(baselineDBPath) == describeSchema(dbPath)
+
+def test_migrating_twice_changes_nothing(dbPath):
+	assert migrate(dbPath) == latestVersion()
+
+# Migrating is a deploy step, so building the app mustn't touch the database
+def test_app_does_not_migrate(baselineDBPath, monkeypatch):
+	monkeypatch.setenv("FLASK_KEY", "test")
+	create_app(baselineDBPath)
+	con = sqlite3.connect(baselineDBPath)
+	assert con.execute("PRAGMA user_version").fetchone()[0] == 0
+	con.close()
@@ -0,0 +1,48 @@
+import sqlite3
+from json import loads
+
+import pytest
+
+from updates import UpdateBroker, UpdateRelay
+
+# Every test starts with a package for user 1 that has a single event
+@pytest.fixture(autouse=True)
+def package(packageHandler, dbPath):
+	packageHandler.createNewPackage("TEST12345678", 1)
+	addEvent(dbPath, "Picked up")
+
+def addEvent(dbPath, data):
+	with sqlite3.connect(dbPath) as con:
+		con.execute("INSERT INTO package_data (tracking_number_id, date, time, event_ts, has_time, data, fingerprint) VALUES (1, '', '', 1600000000, 1, ?, ?)", [data, data])
+		con.execute("INSERT INTO package_updates (tracking_number_id, time_created) VALUES (1, 0)")
+	con.close()
+
+def getEvents(packageData):
+	return [event["data"] for event in loads(packageData[1])["data"][1:]]
+
+def test_cached_package_data_skips_the_database(packageHandler, connections):
+	etag, json = packageHandler.getPackageData(1, 1)
+	statements = []
+	connections.getConnection().set_trace_callback(statements.append)
+	assert packageHandler.getPackageData("1", 1) == (etag, json)
+	assert packageHandler.getPackageData(1, 2) is None
+	assert statements == []
+
+def test_package_data_is_refreshed_by_the_relay(packageHandler, connections, dbPath):
+	relay = UpdateRelay(connections, UpdateBroker(), packageHandler)
+	relay.relayNewUpdates()
+	assert getEvents(packageHandler.getPackageData(1, 1)) == ["Picked up"]
+
+	addEvent(dbPath, "Delivered")
+	assert getEvents(packageHandler.getPackageData(1, 1)) == ["Picked up"]
+	relay.relayNewUpdates()
+	assert getEvents(packageHandler.getPackageData(1, 1)) == ["Delivered", "Picked up"]
+
+# The browser knows about a scrape that this process hasn't heard of yet
+def test_package_data_newer_than_cache(packageHandler, dbPath):
+	packageHandler.getPackageData(1, 1)
+	addEvent(dbPath, "Delivered")
+	with sqlite3.connect(dbPath) as con:
+		con.execute("UPDATE tracking_numbers SET last_updated = 1700000000")
+	con.close()
+	assert getEvents(packageHandler.getPackageData(1, 1, 1700000000)) == ["Delivered", "Picked up"]
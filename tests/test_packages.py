@@ -0,0 +1,216 @@
+import sqlite3
+from json import loads
+from os import path
+from threading import Thread
+from time import time
+
+import pytest
+
+from conftest import ROOT_DIR
+from errors import FetchError, ScrapeError
+from packages import PackageHandler, calculateNextRefresh
+from parsing import extractEventsFromHTML
+from scraper import UpstreamLimiter
+
+def execute(dbPath, query, parameters=()):
+	with sqlite3.connect(dbPath) as con:
+		rows = con.execute(query, parameters).fetchall()
+	con.close()
+	return rows
+
+def addPackages(packageHandler, count, userID=1):
+	for i in range(count):
+		assert packageHandler.createNewPackage("TEST" + str(i).zfill(8), userID) == "added"
+
+def claim(packageHandler, workerID):
+	return packageHandler.claimNextInQueue(packageHandler.con, workerID)
+
+# Several workers claiming at once, each on its own thread and connection like the scraper workers
+def test_workers_never_claim_the_same_row(packageHandler, connections):
+	addPackages(packageHandler, 40)
+	claimed = {}
+
+	def work(workerID):
+		claimed[workerID] = []
+		while True:
+			package = claim(packageHandler, workerID)
+			if package is None:
+				break
+			claimed[workerID].append(package["queue_id"])
+		connections.closeConnection()
+
+	workers = [Thread(target=work, args=("worker" + str(i),)) for i in range(4)]
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+
+	queueIDs = [queueID for workerClaims in claimed.values() for queueID in workerClaims]
+	assert len(queueIDs) == len(set(queueIDs)) == 40
+
+def test_expired_lease_is_reclaimed(packageHandler, dbPath):
+	addPackages(packageHandler, 1)
+	first = claim(packageHandler, "first")
+	assert first is not None
+	# Still leased to the first worker
+	assert claim(packageHandler, "second") is None
+
+	execute(dbPath, "UPDATE queue SET lease_expires = 1")
+	second = claim(packageHandler, "second")
+	assert second["queue_id"] == first["queue_id"]
+	assert execute(dbPath, "SELECT claimed_by FROM queue") == [("second",)]
+
+# Serves the events of one of the saved tracking pages for every number
+class SavedPageBackend():
+	def __init__(self, pageName):
+		with open(path.join(ROOT_DIR, "fixtures", "pages", pageName + ".html"), encoding="utf-8") as pageFile:
+			self.events = extractEventsFromHTML(pageFile.read())
+
+	def urlFor(self, trackingNumber):
+		return "https://example.com/" + trackingNumber
+
+	def fetchEvents(self, url):
+		return self.events
+
+def scrape(packageHandler, backend):
+	return packageHandler.scrapeNextInQueue(backend, "worker", UpstreamLimiter(1))
+
+def test_unchanged_rescrape_writes_nothing(packageHandler, dbPath):
+	addPackages(packageHandler, 1)
+	backend = SavedPageBackend("inTransit")
+	assert scrape(packageHandler, backend)
+	events = execute(dbPath, "SELECT id, fingerprint FROM package_data ORDER BY id")
+	assert len(events) > 0
+	updates = execute(dbPath, "SELECT COUNT(*) FROM package_updates")
+	execute(dbPath, "UPDATE tracking_numbers SET last_new_data = 1000, last_updated = 0")
+	execute(dbPath, "UPDATE packages SET last_new_data = 1000")
+
+	execute(dbPath, "INSERT INTO queue (tracking_number_id) VALUES (1)")
+	assert scrape(packageHandler, backend)
+	assert execute(dbPath, "SELECT id, fingerprint FROM package_data ORDER BY id") == events
+	assert execute(dbPath, "SELECT COUNT(*) FROM package_updates") == updates
+	assert execute(dbPath, "SELECT last_new_data, last_updated > 0 FROM tracking_numbers") == [(1000, 1)]
+	assert execute(dbPath, "SELECT last_new_data FROM packages") == [(1000,)]
+
+NOW = 1700000000
+DAY = 86400
+
+def test_delivered_package_is_not_refreshed():
+	assert calculateNextRefresh(NOW, NOW, True) is None
+	assert calculateNextRefresh(NOW, NOW - 30 * DAY, True, invalid=True) is None
+
+def test_active_package_uses_active_interval():
+	assert calculateNextRefresh(NOW, NOW - 3600, False) == NOW + PackageHandler.ACTIVE_REFRESH_INTERVAL
+	# Invalid numbers are treated like any other for their first day
+	assert calculateNextRefresh(NOW, NOW - 3600, False, invalid=True) == NOW + PackageHandler.ACTIVE_REFRESH_INTERVAL
+
+def test_quiet_package_backs_off_up_to_limit():
+	assert calculateNextRefresh(NOW, NOW - DAY, False) == NOW + PackageHandler.QUIET_REFRESH_INTERVAL
+	assert calculateNextRefresh(NOW, NOW - 2 * DAY, False) == NOW + PackageHandler.QUIET_REFRESH_INTERVAL * 2
+	assert calculateNextRefresh(NOW, NOW - 30 * DAY, False) == NOW + PackageHandler.MAX_REFRESH_INTERVAL
+
+def test_invalid_package_uses_invalid_interval():
+	assert calculateNextRefresh(NOW, NOW - DAY, False, invalid=True) == NOW + PackageHandler.INVALID_REFRESH_INTERVAL
+
+def scrapeAll(packageHandler):
+	backend = SavedPageBackend("inTransit")
+	while scrape(packageHandler, backend):
+		pass
+
+def ageUserPackages(dbPath, userID, age):
+	execute(dbPath, "UPDATE packages SET last_new_data = ? WHERE user_id = ?", [time() - age, userID])
+
+def test_dead_packages_are_deleted(packageHandler, dbPath):
+	# User 1 has a dead number of their own, one they share with user 2 and one that a worker is busy scraping
+	addPackages(packageHandler, 3)
+	assert packageHandler.createNewPackage("TEST00000001", 2) == "added"
+	scrapeAll(packageHandler)
+	ageUserPackages(dbPath, 1, PackageHandler.DELETION_AGE + DAY)
+	execute(dbPath, "INSERT INTO queue (tracking_number_id) SELECT id FROM tracking_numbers WHERE number = 'TEST00000002'")
+	assert claim(packageHandler, "worker")["trackingNumber"] == "TEST00000002"
+
+	packageHandler.checkForDeadPackages()
+	assert execute(dbPath, "SELECT number FROM tracking_numbers ORDER BY number") == [("TEST00000001",), ("TEST00000002",)]
+	assert execute(dbPath, "SELECT user_id, trackingNumber FROM packages ORDER BY id") == [(1, "TEST00000002"), (2, "TEST00000001")]
+	assert execute(dbPath, "SELECT DISTINCT number FROM package_data INNER JOIN tracking_numbers ON tracking_numbers.id = package_data.tracking_number_id ORDER BY number") == [("TEST00000001",), ("TEST00000002",)]
+	assert execute(dbPath, "SELECT claimed_by FROM queue") == [("worker",)]
+
+	# Once the worker is done with it, the leased number goes on the next run
+	execute(dbPath, "UPDATE queue SET claimed_by = NULL, lease_expires = 0")
+	packageHandler.checkForDeadPackages()
+	assert execute(dbPath, "SELECT number FROM tracking_numbers") == [("TEST00000001",)]
+	assert execute(dbPath, "SELECT COUNT(*) FROM queue") == [(0,)]
+
+def test_one_reminder_email_per_user(packageHandler, dbPath):
+	addPackages(packageHandler, 2)
+	assert packageHandler.createNewPackage("TEST00000002", 2) == "added"
+	ageUserPackages(dbPath, 1, PackageHandler.REMINDER_AGE + DAY)
+	ageUserPackages(dbPath, 2, PackageHandler.REMINDER_AGE + DAY)
+
+	packageHandler.checkForDeadPackages()
+	emails = execute(dbPath, "SELECT recipient, subject, context FROM email_outbox ORDER BY recipient")
+	assert [(recipient, subject) for recipient, subject, context in emails] == [("a@example.com", "Outdated packages"), ("b@example.com", "Outdated package")]
+	assert [package["title"] for package in loads(emails[0][2])["packages"]] == ["TEST00000000", "TEST00000001"]
+	assert execute(dbPath, "SELECT COUNT(*) FROM packages WHERE email_sent = 0") == [(0,)]
+
+	# Nobody is reminded twice
+	packageHandler.checkForDeadPackages()
+	assert execute(dbPath, "SELECT COUNT(*) FROM email_outbox") == [(2,)]
+
+class BrokenBackend():
+	def urlFor(self, trackingNumber):
+		return "https://example.com/" + trackingNumber
+
+	def fetchEvents(self, url):
+		raise FetchError("The page didn't load")
+
+def test_failed_scrape_backs_off(packageHandler, dbPath):
+	addPackages(packageHandler, 1)
+	start = time()
+	with pytest.raises(ScrapeError):
+		scrape(packageHandler, BrokenBackend())
+	[(claimedBy, leaseExpires, attempts, dead)] = execute(dbPath, "SELECT claimed_by, lease_expires, attempts, dead FROM queue")
+	assert (claimedBy, attempts, dead) == (None, 1, 0)
+	assert start + PackageHandler.RETRY_DELAY <= leaseExpires <= time() + PackageHandler.RETRY_DELAY
+	assert claim(packageHandler, "worker") is None
+
+	# Every failure doubles the delay
+	execute(dbPath, "UPDATE queue SET lease_expires = 0")
+	with pytest.raises(ScrapeError):
+		scrape(packageHandler, BrokenBackend())
+	[(leaseExpires, attempts)] = execute(dbPath, "SELECT lease_expires, attempts FROM queue")
+	assert attempts == 2
+	assert leaseExpires >= start + PackageHandler.RETRY_DELAY * 2
+
+def test_failing_number_is_dead_lettered(packageHandler, dbPath):
+	addPackages(packageHandler, 1)
+	execute(dbPath, "UPDATE queue SET attempts = ?", [PackageHandler.MAX_SCRAPE_ATTEMPTS - 2])
+	with pytest.raises(ScrapeError):
+		scrape(packageHandler, BrokenBackend())
+	assert execute(dbPath, "SELECT dead FROM queue") == [(0,)]
+
+	execute(dbPath, "UPDATE queue SET lease_expires = 0")
+	with pytest.raises(ScrapeError):
+		scrape(packageHandler, BrokenBackend())
+	assert execute(dbPath, "SELECT attempts, dead FROM queue") == [(PackageHandler.MAX_SCRAPE_ATTEMPTS, 1)]
+	assert execute(dbPath, "SELECT next_due_at FROM tracking_numbers") == [(None,)]
+	execute(dbPath, "UPDATE queue SET lease_expires = 0")
+	assert claim(packageHandler, "worker") is None
+
+def test_import_results(packageHandler, dbPath):
+	assert packageHandler.createNewPackage("LB123456785CN", 1) == "added"
+	lines = [(1, "1z999aa1 0123456784"), (2, "1Z999AA10123456785"), (3, "1Z999AA10123456784"), (4, "LB123456785CN"), (5, "not a number!"), (6, "------")]
+	assert [(result["line"], result["trackingNumber"], result["result"]) for result in packageHandler.importPackages(lines, 1)] == [
+		(1, "1Z999AA10123456784", "added"),
+		(2, "1Z999AA10123456785", "flagged"),
+		(3, "1Z999AA10123456784", "repeated"),
+		(4, "LB123456785CN", "alreadyTracked"),
+		(5, "NOTANUMBER!", "invalid"),
+		(6, "------", "invalid"),
+	]
+	assert execute(dbPath, "SELECT trackingNumber FROM packages WHERE user_id = 1 ORDER BY id") == [("LB123456785CN",), ("1Z999AA10123456784",), ("1Z999AA10123456785",)]
+	assert execute(dbPath, "SELECT number, carrier FROM tracking_numbers ORDER BY id") == [("LB123456785CN", "China Post"), ("1Z999AA10123456784", "UPS"), ("1Z999AA10123456785", "UPS")]
+
+	# Another user tracking the same number shares it
+	assert [result["result"] for result in packageHandler.importPackages([(1, "1Z999AA10123456784")], 2)] == ["added"]
+	assert execute(dbPath, "SELECT COUNT(*) FROM tracking_numbers") == [(3,)]
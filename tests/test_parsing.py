@@ -0,0 +1,75 @@
+from calendar import timegm
+from os import path
+
+from parsing import extractEventsFromHTML, parseEvents, parseEvent, isDeliveredEvent, readTrackingNumbers, extractEventsFromShipment, NO_INFORMATION_MESSAGE
+
+# The saved parcelsapp pages that the fake tracking site serves
+PAGES_DIR = path.join(path.dirname(path.dirname(path.abspath(__file__))), "fixtures", "pages")
+
+def loadPage(name):
+	with open(path.join(PAGES_DIR, name + ".html"), encoding="utf-8") as pageFile:
+		return pageFile.read()
+
+def eventsOnPage(name):
+	return parseEvents(extractEventsFromHTML(loadPage(name)))
+
+def timestamp(year, month, day, hour=0, minute=0):
+	return timegm((year, month, day, hour, minute, 0))
+
+def test_in_transit_page():
+	events = eventsOnPage("inTransit")
+	# Newest first, the same order as on the page
+	assert events == [
+		(timestamp(2021, 4, 14, 9, 12), True, "Arrived at local delivery depot"),
+		(timestamp(2021, 4, 12, 22, 47), True, "Arrived at destination country"),
+		(timestamp(2021, 4, 8, 3, 5), True, "Departed from origin country"),
+		(timestamp(2021, 4, 6, 15, 30), True, "Shipment information received"),
+	]
+	assert not isDeliveredEvent(events[0][2])
+
+def test_delivered_page():
+	events = eventsOnPage("delivered")
+	assert len(events) == 3
+	assert events[0] == (timestamp(2021, 4, 15, 13, 58), True, "Delivered")
+	assert isDeliveredEvent(events[0][2])
+	# "Out for delivery" doesn't count as delivered
+	assert not isDeliveredEvent(events[1][2])
+
+# parcelsapp's "no information" event only has a date, and its text is swapped for our own message
+def test_no_information_page():
+	assert eventsOnPage("noInformation") == [(timestamp(2021, 4, 16), False, NO_INFORMATION_MESSAGE)]
+
+def test_date_only_event():
+	assert parseEvent({"date": "03 May 2021", "time": "", "data": "Held at customs"}) == (timestamp(2021, 5, 3), False, "Held at customs")
+
+def test_page_without_events_list():
+	assert extractEventsFromHTML("<html><body><div class=\"container\">Please wait</div></body></html>") is None
+
+def test_empty_events_list():
+	assert extractEventsFromHTML("<ul class=\"list-unstyled events\"></ul>") == []
+
+def test_tracking_number_list():
+	lines = ["1Z999AA10123456784\n", "\n", "  \n", "LB123456785CN\n"]
+	assert list(readTrackingNumbers(lines)) == [(1, "1Z999AA10123456784"), (4, "LB123456785CN")]
+
+def test_tracking_number_csv_with_header():
+	lines = ["Tracking number,Shop\n", "1Z999AA10123456784,Example shop\n", "\"LB123456785CN\",\"Another, shop\"\n"]
+	assert list(readTrackingNumbers(lines)) == [(2, "1Z999AA10123456784"), (3, "LB123456785CN")]
+	# Only the first row can be a header
+	assert list(readTrackingNumbers(["1Z999AA10123456784\n", "Tracking number\n"])) == [(1, "1Z999AA10123456784"), (2, "Tracking number")]
+
+# The API's states come out the same as the events on the page, newest first
+def test_shipment_from_api():
+	shipment = {"trackingId": "TEST12345678", "states": [
+		{"date": "2021-04-12T22:47:00.000Z", "status": "Arrived at destination country", "location": "Auckland"},
+		{"date": "2021-04-14T09:12:00+12:00", "status": "Arrived at local delivery depot", "location": "Wellington"},
+	]}
+	assert parseEvents(extractEventsFromShipment(shipment)) == [
+		(timestamp(2021, 4, 14, 9, 12), True, "Arrived at local delivery depot"),
+		(timestamp(2021, 4, 12, 22, 47), True, "Arrived at destination country"),
+	]
+
+def test_shipment_without_states():
+	for shipment in [None, {"trackingId": "TEST12345678", "states": []}]:
+		[(eventTimestamp, hasTime, data)] = parseEvents(extractEventsFromShipment(shipment))
+		assert not hasTime and data == NO_INFORMATION_MESSAGE
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from connections import ConnectionManager
+from passwords import AttemptLimiter, PasswordHasher, PasswordHasherBusy
+
+# Two limiters on their own connections, like two website processes
+def test_attempt_limiter_is_shared(dbPath):
+	connectionManagers = [ConnectionManager(dbPath), ConnectionManager(dbPath)]
+	first, second = [AttemptLimiter(connections, "ip", 3, 60) for connections in connectionManagers]
+	other = AttemptLimiter(connectionManagers[0], "email", 3, 60)
+
+	for i in range(2):
+		first.recordFailure("10.0.0.1")
+		second.recordFailure("10.0.0.1")
+	assert not first.isAllowed("10.0.0.1")
+	assert not second.isAllowed("10.0.0.1")
+	assert first.isAllowed("10.0.0.2")
+	assert other.isAllowed("10.0.0.1")
+
+	second.reset("10.0.0.1")
+	assert first.isAllowed("10.0.0.1")
+	for connections in connectionManagers:
+		connections.closeConnection()
+
+@pytest.fixture
+def passwordHasher():
+	passwordHasher = PasswordHasher(1000, 1)
+	yield passwordHasher
+	passwordHasher.shutdown()
+
+def test_password_hasher_timeout(passwordHasher):
+	# Starting the hashing process alone takes longer than this
+	passwordHasher.timeout = 0.001
+	with pytest.raises(PasswordHasherBusy):
+		passwordHasher.hash("password")
+
+def test_password_hasher_replaces_broken_pool(passwordHasher):
+	with pytest.raises(PasswordHasherBusy):
+		passwordHasher.run(os._exit, 1)
+	valid, newHash = passwordHasher.verifyAndUpdate("password", passwordHasher.hash("password"))
+	assert valid
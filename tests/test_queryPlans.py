@@ -0,0 +1,22 @@
+import sqlite3
+from os import path
+
+from database.checkQueryPlans import checkQueryPlans, CHECKED_FILES, ROOT_DIR
+
+def findFullScans(dbPath, filePaths):
+	con = sqlite3.connect(dbPath)
+	failures = checkQueryPlans(con, filePaths)
+	con.close()
+	return failures
+
+# Every query the app runs has to be answered from an index, against the schema the migrations build
+def test_no_full_table_scans(dbPath):
+	failures = findFullScans(dbPath, [path.join(ROOT_DIR, fileName) for fileName in CHECKED_FILES])
+	assert failures == [], "\n".join(fileName + ":" + str(lineNumber) + " " + planDetail for fileName, lineNumber, planDetail, query in failures)
+
+# Makes sure the check would actually catch a query without an index, including one built with +
+def test_full_table_scan_is_caught(dbPath, tmp_path):
+	sourcePath = tmp_path / "slowQueries.py"
+	sourcePath.write_text("cur.execute(\"SELECT id FROM packages WHERE title = ?\", [title])\ncur.execute(\"SELECT id FROM packages WHERE id = ?\", [packageID])\ncur.execute(\"SELECT id FROM users WHERE password IN (\" + placeholders + \")\", passwords)\n")
+	failures = findFullScans(dbPath, [str(sourcePath)])
+	assert [(lineNumber, planDetail) for fileName, lineNumber, planDetail, query in failures] == [(1, "SCAN packages"), (3, "SCAN users")]
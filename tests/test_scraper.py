@@ -0,0 +1,95 @@
+import sqlite3
+
+import pytest
+
+import scraper
+from scraper import CircuitBreaker, ScraperWorker, UpstreamLimiter
+
+# Lets the tests move time forward without waiting for the cooldown
+@pytest.fixture
+def clock(monkeypatch):
+	clock = {"now": 1000}
+	monkeypatch.setattr(scraper, "time", lambda: clock["now"])
+	return clock
+
+@pytest.fixture
+def breaker(clock):
+	return CircuitBreaker(failureThreshold=3, cooldown=60)
+
+# Opens the breaker and waits out the cooldown
+def openBreaker(breaker, clock):
+	for i in range(breaker.failureThreshold):
+		breaker.recordFailure()
+	clock["now"] += breaker.cooldown
+
+def startTrial(breaker, clock):
+	openBreaker(breaker, clock)
+	assert breaker.allowRequest()
+
+def test_breaker_opens_after_threshold(breaker, clock):
+	for i in range(breaker.failureThreshold - 1):
+		breaker.recordFailure()
+		assert breaker.allowRequest()
+	breaker.recordFailure()
+	assert not breaker.allowRequest()
+	clock["now"] += breaker.cooldown - 1
+	assert not breaker.allowRequest()
+
+def test_success_resets_failure_count(breaker):
+	for i in range(breaker.failureThreshold - 1):
+		breaker.recordFailure()
+	breaker.recordSuccess()
+	breaker.recordFailure()
+	assert breaker.allowRequest()
+
+def test_only_one_trial_after_cooldown(breaker, clock):
+	startTrial(breaker, clock)
+	assert not breaker.allowRequest()
+
+def test_successful_trial_closes_breaker(breaker, clock):
+	startTrial(breaker, clock)
+	breaker.recordSuccess()
+	assert breaker.allowRequest()
+	assert breaker.allowRequest()
+
+def test_failed_trial_reopens_breaker(breaker, clock):
+	startTrial(breaker, clock)
+	breaker.recordFailure()
+	assert not breaker.allowRequest()
+	clock["now"] += breaker.cooldown
+	assert breaker.allowRequest()
+
+def test_inconclusive_trial_allows_another(breaker, clock):
+	startTrial(breaker, clock)
+	breaker.recordInconclusive()
+	assert not breaker.allowRequest()
+	clock["now"] += breaker.cooldown
+	assert breaker.allowRequest()
+
+class ClosableBackend():
+	def close(self):
+		pass
+
+# Gives the worker one result (or exception) and then stops it
+class OneShotPackageHandler():
+	def __init__(self, result):
+		self.result = result
+		self.worker = None
+
+	def scrapeNextInQueue(self, backend, workerID, upstreamLimiter):
+		self.worker.stop()
+		if isinstance(self.result, Exception):
+			raise self.result
+		return self.result
+
+@pytest.mark.parametrize("result", [False, sqlite3.OperationalError("database is locked")])
+def test_worker_releases_trial_without_scrape(breaker, clock, result):
+	openBreaker(breaker, clock)
+	packageHandler = OneShotPackageHandler(result)
+	worker = ScraperWorker(packageHandler, ClosableBackend, UpstreamLimiter(1), breaker, 0)
+	packageHandler.worker = worker
+	worker.run()
+	assert not breaker.trialRunning
+	assert not breaker.allowRequest()
+	clock["now"] += breaker.cooldown
+	assert breaker.allowRequest()
@@ -0,0 +1,33 @@
+import pytest
+
+from main import create_app
+
+@pytest.fixture
+def client(dbPath, monkeypatch):
+	monkeypatch.setenv("FLASK_KEY", "test")
+	monkeypatch.setenv("EMAIL_ADDRESS", "tracker@example.com")
+	monkeypatch.setenv("PROXY_HOPS", "1")
+	monkeypatch.delenv("METRICS_TOKEN", raising=False)
+	app = create_app(dbPath)
+	yield app.test_client()
+	# Only there if a request got as far as the handlers
+	if app.handlers.connections is not None:
+		app.handlers.updateRelay.stop()
+
+def test_metrics_from_the_server(client):
+	response = client.get("/metrics")
+	assert response.status_code == 200
+	assert b"package_tracker_requests_total" in response.data
+	assert client.get("/cacheStats").status_code == 200
+
+def test_metrics_through_the_proxy(client):
+	# The proxy is on the same machine, so without X-Forwarded-For these would look like they came from the server
+	assert client.get("/metrics", headers={"X-Forwarded-For": "203.0.113.5"}).status_code == 404
+	assert client.get("/cacheStats", headers={"X-Forwarded-For": "127.0.0.1"}).status_code == 404
+	assert client.get("/metrics", environ_base={"REMOTE_ADDR": "203.0.113.5"}).status_code == 404
+
+def test_metrics_token(client, monkeypatch):
+	monkeypatch.setenv("METRICS_TOKEN", "secret")
+	headers = {"X-Forwarded-For": "203.0.113.5"}
+	assert client.get("/metrics", headers=dict(headers, Authorization="Bearer secret")).status_code == 200
+	assert client.get("/metrics", headers=dict(headers, Authorization="Bearer wrong")).status_code == 404
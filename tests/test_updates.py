@@ -0,0 +1,32 @@
+import sqlite3
+
+import pytest
+
+from updates import UpdateBroker, UpdateStreamsFull
+
+def test_broker_limits_streams_per_process():
+	broker = UpdateBroker(2, maxSubscriptions=3)
+	first = broker.subscribe(1)
+	broker.subscribe(1)
+	assert broker.subscribe(1) is None
+	broker.subscribe(2)
+	with pytest.raises(UpdateStreamsFull):
+		broker.subscribe(3)
+
+	first.close()
+	assert broker.subscribe(3) is not None
+
+def test_polling_for_updates(packageHandler, dbPath):
+	packageHandler.createNewPackage("TEST12345678", 1)
+	packageHandler.createNewPackage("TEST87654321", 2)
+
+	updates, afterID = packageHandler.getPackageUpdates(1)
+	assert updates == []
+	with sqlite3.connect(dbPath) as con:
+		con.execute("UPDATE packages SET latest_event = 'Delivered', latest_event_ts = 1600000000, latest_event_has_time = 0")
+		con.executemany("INSERT INTO package_updates (tracking_number_id, time_created) VALUES (?, 0)", [[1], [2]])
+	con.close()
+
+	updates, afterID = packageHandler.getPackageUpdates(1, afterID)
+	assert [(update["packageID"], update["latestEvent"], update["latestEventTime"]) for update in updates] == [(1, "Delivered", "")]
+	assert packageHandler.getPackageUpdates(1, afterID) == ([], afterID)
@@ -0,0 +1,146 @@
+import sqlite3
+from queue import Queue, Empty, Full
+from threading import Thread, Event, Lock
+
+from connections import createDBConnection
+from parsing import formatEventDate, formatEventTime
+
+# Raised when the process already has as many update streams open as it is allowed
+class UpdateStreamsFull(Exception):
+	pass
+
+# Turns a row with a package's id, user_id, last_updated and latest event into the update that is sent to the browser
+def formatUpdate(row):
+	return {
+		"packageID": row["id"],
+		"lastUpdated": row["last_updated"],
+		"latestEvent": row["latest_event"],
+		"latestEventDate": formatEventDate(row["latest_event_ts"]) if row["latest_event_ts"] is not None else None,
+		"latestEventTime": formatEventTime(row["latest_event_ts"], row["latest_event_has_time"]) if row["latest_event_ts"] is not None else None,
+	}
+
+# Passes package updates on to the browsers that are listening for them (see the packageUpdates route). Every open
+# package list page gets a subscription, which is a queue of updates for the user it belongs to. Each subscription holds
+# a connection (and a thread) open for as long as the page is open, so a user can only have a few of them at a time,
+# and the whole process can only have maxSubscriptions of them (None for no limit). Pages that are turned away poll
+# for updates instead.
+class UpdateBroker():
+	def __init__(self, maxSubscriptionsPerUser=4, maxQueuedUpdates=100, maxSubscriptions=None):
+		self.maxSubscriptionsPerUser = maxSubscriptionsPerUser
+		self.maxQueuedUpdates = maxQueuedUpdates
+		self.maxSubscriptions = maxSubscriptions
+		self.subscriptions = {} # User ID -> list of their subscriptions
+		self.subscriptionCount = 0
+		self.lock = Lock()
+
+	# Returns a new subscription for the user, or None if they already have too many. Raises UpdateStreamsFull if the
+	# process has too many.
+	def subscribe(self, userID):
+		with self.lock:
+			if self.maxSubscriptions is not None and self.subscriptionCount >= self.maxSubscriptions:
+				raise UpdateStreamsFull()
+			userSubscriptions = self.subscriptions.setdefault(userID, [])
+			if len(userSubscriptions) >= self.maxSubscriptionsPerUser:
+				return None
+			subscription = Subscription(self, userID, self.maxQueuedUpdates)
+			userSubscriptions.append(subscription)
+			self.subscriptionCount += 1
+			return subscription
+
+	def unsubscribe(self, subscription):
+		with self.lock:
+			userSubscriptions = self.subscriptions.get(subscription.userID, [])
+			if subscription in userSubscriptions:
+				userSubscriptions.remove(subscription)
+				self.subscriptionCount -= 1
+			if not userSubscriptions:
+				self.subscriptions.pop(subscription.userID, None)
+
+	def hasSubscribers(self):
+		with self.lock:
+			return len(self.subscriptions) > 0
+
+	# Only the users that have a page open get anything, updates for everyone else are dropped
+	def publish(self, userID, update):
+		with self.lock:
+			userSubscriptions = list(self.subscriptions.get(userID, []))
+		for subscription in userSubscriptions:
+			subscription.put(update)
+
+class Subscription():
+	def __init__(self, broker, userID, maxQueuedUpdates):
+		self.broker = broker
+		self.userID = userID
+		self.updates = Queue(maxQueuedUpdates)
+
+	# If the browser isn't keeping up then the update is dropped rather than letting the queue grow forever
+	def put(self, update):
+		try:
+			self.updates.put_nowait(update)
+		except Full:
+			pass
+
+	# Waits up to timeout seconds for the next update. Returns None if there wasn't one.
+	def get(self, timeout):
+		try:
+			return self.updates.get(timeout=timeout)
+		except Empty:
+			return None
+
+	def close(self):
+		self.broker.unsubscribe(self)
+
+# The scrapers run in the worker process, so they can't publish to the broker themselves. Instead every scrape that
+# changes a number's events adds a row to package_updates, and this thread (one in each website process) checks the
+# table for new rows and publishes an update for every package that tracks the number. The rows are cleared out by
+# the worker after a few minutes (see PackageHandler.removeOldPackageUpdates). It also throws the changed packages out
+# of this process's package data cache (a PackageHandler's), so the cache can be trusted without checking the database.
+class UpdateRelay(Thread):
+	def __init__(self, connections, broker, packageHandler, pollInterval=1):
+		super().__init__(daemon=True)
+		self.connections = connections
+		self.broker = broker
+		self.packageHandler = packageHandler
+		self.pollInterval = pollInterval
+		self.lastID = None # The newest package_updates row that has been published
+		self.stopEvent = Event()
+
+	@property
+	def con(self):
+		return self.connections.getConnection()
+
+	def run(self):
+		while not self.stopEvent.wait(self.pollInterval):
+			try:
+				self.relayNewUpdates()
+			except sqlite3.Error as e:
+				print("Update relay failed: " + repr(e))
+
+	def stop(self):
+		self.stopEvent.set()
+
+	@createDBConnection
+	def relayNewUpdates(self):
+		cur = self.con.cursor()
+		cur.row_factory = sqlite3.Row # Dictionary format
+		cur.execute("SELECT COALESCE(MAX(id), 0) AS id FROM package_updates")
+		newestID = cur.fetchone()["id"]
+		# Updates from before the relay started are old news
+		if self.lastID is None or newestID == self.lastID:
+			self.lastID = newestID
+			cur.close()
+			return
+
+		cur.execute("SELECT DISTINCT tracking_number_id FROM package_updates WHERE id > ? AND id <= ?", [self.lastID, newestID])
+		self.packageHandler.forgetPackageData([row["tracking_number_id"] for row in cur.fetchall()])
+		# Nobody is listening when there are no subscribers, so there is nothing else to look up
+		if not self.broker.hasSubscribers():
+			self.lastID = newestID
+			cur.close()
+			return
+
+		cur.execute("SELECT packages.id AS id, packages.user_id AS user_id, packages.latest_event AS latest_event, packages.latest_event_ts AS latest_event_ts, packages.latest_event_has_time AS latest_event_has_time, tracking_numbers.last_updated AS last_updated FROM package_updates INNER JOIN packages ON packages.tracking_number_id = package_updates.tracking_number_id INNER JOIN tracking_numbers ON tracking_numbers.id = package_updates.tracking_number_id WHERE package_updates.id > ? AND package_updates.id <= ? ORDER BY package_updates.id", [self.lastID, newestID])
+		for row in cur.fetchall():
+			self.broker.publish(row["user_id"], formatUpdate(row))
+		cur.close()
+		self.lastID = newestID
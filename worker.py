@@ -0,0 +1,142 @@
+from os import environ
+from dotenv import load_dotenv
+from functools import partial
+from signal import signal, SIGTERM, SIGINT
+from threading import Event
+from time import time
+from uuid import uuid4
+
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES
+
+from auth import Authenticator
+from packages import PackageHandler
+from emails import EmailHandler
+from connections import ConnectionManager, createDBConnection
+from passwords import PasswordHasher
+from scraper import ScraperPool
+from backends import createBackend, checkBackendSettings
+from database.migrate import migrate
+from metrics import JOB_DURATION, JOB_ERRORS, JOB_MISFIRES, collectQueueStats, startMetricsServer
+
+# A lock that only one worker process can hold at a time, kept in the worker_locks table. The holder has to keep
+# renewing it before its lease runs out. If the holder dies the lease runs out and another worker takes over.
+class LeaderLock():
+	def __init__(self, connections, name, leaseDuration=60):
+		self.connections = connections
+		self.name = name
+		self.leaseDuration = leaseDuration
+		self.holderID = uuid4().hex
+		self.leaseExpires = 0 # When our own lease runs out, 0 if we don't hold the lock
+
+	@property
+	def con(self):
+		return self.connections.getConnection()
+
+	# Takes the lock if nobody holds it (or their lease has run out), or extends it if we already hold it.
+	# This is a single UPDATE, so two workers can't both take the lock.
+	@createDBConnection
+	def renew(self):
+		cur = self.con.cursor()
+		now = time()
+		cur.execute("UPDATE worker_locks SET holder = ?, lease_expires = ? WHERE name = ? AND (holder = ? OR lease_expires < ?)", [self.holderID, now + self.leaseDuration, self.name, self.holderID, now])
+		wasLeader = self.isLeader()
+		self.leaseExpires = now + self.leaseDuration if cur.rowcount == 1 else 0
+		cur.close()
+
+		if self.isLeader() != wasLeader:
+			print("Worker " + self.holderID + (" is now the leader" if self.isLeader() else " is no longer the leader"))
+
+	# Only trusts the lease until it runs out. If renewing fails (like when the db is busy) we stop acting as the
+	# leader by ourselves, before anyone else can take over.
+	def isLeader(self):
+		return time() < self.leaseExpires
+
+	# Lets another worker take over straight away instead of waiting for the lease to run out
+	@createDBConnection
+	def release(self):
+		cur = self.con.cursor()
+		cur.execute("UPDATE worker_locks SET holder = NULL, lease_expires = 0 WHERE name = ? AND holder = ?", [self.name, self.holderID])
+		cur.close()
+		self.leaseExpires = 0
+
+	# Wraps a scheduled job so it only does anything while this worker is the leader
+	def leaderOnly(self, job):
+		def wrapper():
+			if self.isLeader():
+				job()
+		return wrapper
+
+# Wraps a scheduled job so how long each run takes is recorded in the metrics. The job's name is its id in the scheduler.
+def timedJob(name, job):
+	def wrapper():
+		with JOB_DURATION.time(name):
+			job()
+	return wrapper
+
+# Counts the scheduled job runs that failed or were skipped, by the job's id. A run is skipped if it couldn't start on
+# time, or if the previous run of the same job was still going (every job only runs one at a time).
+def recordJobEvent(event):
+	if event.code in (EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES):
+		JOB_MISFIRES.inc(event.job_id)
+	else:
+		JOB_ERRORS.inc(event.job_id)
+
+# Runs everything that happens in the background, separately from the website:
+# - the scraper workers, which are safe to run in several processes because queue rows are leased
+# - the scheduled jobs and the email sender, which only run in the worker that holds the scheduler lock
+# Run it with: python worker.py
+if __name__ == "__main__":
+	load_dotenv()
+	# How the scraper workers fetch tracking pages: "selenium" (a headless chrome each), "http" (plain HTTP requests) or
+	# "api" (parcelsapp's JSON tracking API). TRACKER_URL can point them at a different site, like the fake tracking site
+	# in fixtures/. Bad settings stop the worker here, before it starts doing anything.
+	trackerBackend = environ.get("TRACKER_BACKEND", "selenium")
+	trackerURL = environ.get("TRACKER_URL")
+	apiKey = environ.get("PARCELSAPP_API_KEY")
+	checkBackendSettings(trackerBackend, trackerURL, apiKey)
+	migrate("database/database.db")
+
+	connections = ConnectionManager("database/database.db")
+	emailHandler = EmailHandler(connections)
+	# The worker never hashes passwords, so the hashing processes are never actually started here
+	authenticator = Authenticator(connections, emailHandler, PasswordHasher(int(environ.get("PASSWORD_HASH_ROUNDS", 535000))))
+	packageHandler = PackageHandler(connections, emailHandler)
+
+	leaderLock = LeaderLock(connections, "scheduler")
+	leaderLock.renew()
+
+	scheduler = BackgroundScheduler()
+	scheduler.add_listener(recordJobEvent, EVENT_JOB_ERROR | EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
+	# Renew well before the lease runs out, so one slow renewal doesn't lose the lock
+	scheduler.add_job(timedJob("renewLeaderLock", leaderLock.renew), "interval", seconds=leaderLock.leaseDuration / 4, id="renewLeaderLock")
+	scheduler.add_job(leaderLock.leaderOnly(timedJob("addOldPackagesToQueue", packageHandler.addOldPackagesToQueue)), "interval", seconds=15, id="addOldPackagesToQueue")
+	scheduler.add_job(leaderLock.leaderOnly(timedJob("checkForDeadPackages", packageHandler.checkForDeadPackages)), "interval", seconds=300, id="checkForDeadPackages")
+	scheduler.add_job(leaderLock.leaderOnly(timedJob("removeOldPackageUpdates", packageHandler.removeOldPackageUpdates)), "interval", seconds=60, id="removeOldPackageUpdates")
+	# Purges any accounts that have not been verified within half an hour
+	scheduler.add_job(leaderLock.leaderOnly(timedJob("removeExpiredTokens", authenticator.removeExpiredTokens)), "interval", seconds=120, id="removeExpiredTokens")
+	scheduler.start()
+
+	# The worker has no website, so it serves its own metrics (scrapes, emails and scheduled jobs) if given a port for them
+	if environ.get("WORKER_METRICS_PORT"):
+		collectQueueStats(packageHandler)
+		startMetricsServer(int(environ["WORKER_METRICS_PORT"]))
+
+	emailHandler.startSender(leaderLock.isLeader)
+
+	backendFactory = partial(createBackend, trackerBackend, environ.get("CHROMEDRIVER_PATH"), 30, trackerURL, apiKey)
+	# The number of scraper workers and how many of them can load pages from the same website at once
+	scraperPool = ScraperPool(packageHandler, backendFactory, int(environ.get("SCRAPER_WORKERS", 2)), int(environ.get("SCRAPES_PER_HOST", 2)))
+	scraperPool.start()
+
+	# Keep going until we are told to stop, then shut everything down cleanly
+	stopEvent = Event()
+	signal(SIGTERM, lambda signalNumber, frame: stopEvent.set())
+	signal(SIGINT, lambda signalNumber, frame: stopEvent.set())
+	stopEvent.wait()
+
+	print("Stopping worker")
+	scraperPool.stop()
+	scheduler.shutdown()
+	emailHandler.stopSender()
+	leaderLock.release()
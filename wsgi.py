@@ -0,0 +1,6 @@
+from main import create_app
+
+# The entry point for running the website in production with a WSGI server. gunicorn.conf.py has the settings:
+# gunicorn --config gunicorn.conf.py wsgi:app
+# gunicorn.conf.py migrates the database first. Any other server needs python database/migrate.py run before it starts.
+app = create_app()